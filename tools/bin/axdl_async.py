@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: axdl_async.py
+Description: asyncio transport and flashing API for the AXDL BSL protocol.
+
+AsyncPort puts an asyncio front end on a blocking port (USBSerialPort or
+axdl_sim.SimulatedDevice).  OUT transfers are queued and written in order by
+one writer task, so several of them can be outstanding while an IN transfer
+is pending.  run_steps_async() carries out the protocol steps of
+axdl_tool (the flow of axdl_tool.FlashSession) on top of it, so both
+transports share every protocol decision; AsyncFlashSession is the
+session API, and flash_devices_async() flashes many boards from one event
+loop, with per-transfer and per-device timeouts and clean cancellation.
+
+pyusb only has blocking transfers, so a pending transfer still waits in a
+thread of one shared executor; no thread is tied to a board, and nothing
+polls.
+
+# SPDX-FileCopyrightText: 2024 M5Stack Technology CO LTD
+#
+# SPDX-License-Identifier: MIT
+
+use: sudo python3 axdl_tool.py --axp ./M5_LLM_ubuntu22.04_20250210.axp --all --async
+
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import time
+
+from axdl_tool import (
+    BUS_SAMPLE_TIME,
+    DEVICE_WAIT_TIMEOUT,
+    BlockingCall,
+    DataSlot,
+    DeviceLogAdapter,
+    FlashError,
+    FlashPlan,
+    FlashSession,
+    FlashStatus,
+    PacketReader,
+    PortDrain,
+    PortPacket,
+    PortSend,
+    PortSent,
+    PortWrite,
+    decode_packet,
+)
+
+# Seconds an executor call may overrun its own transfer timeout before the
+# awaiting coroutine gives up on it
+TIMEOUT_SLACK = 2.0
+
+
+class AsyncPort:
+    """
+    asyncio front end of a blocking port.
+
+    send() queues an OUT transfer and returns a future, so a caller can keep
+    several writes outstanding while it awaits read().  Once a write fails,
+    every queued and later write fails with the same error.
+    """
+
+    def __init__(self, port, executor=None, timer=None):
+        """
+        :param port: Blocking port with open/read/write/close
+        :param executor: concurrent.futures executor running the blocking
+            calls (the loop's default executor when None)
+        :param timer: Optional PhaseTimer counting every bulk transfer
+        """
+        self.port = port
+        self.executor = executor
+        self.timer = timer
+        self._queue = None
+        self._writer = None
+        self._error = None
+
+    @property
+    def path(self):
+        return getattr(self.port, "path", None)
+
+    @property
+    def serial_number(self):
+        return getattr(self.port, "serial_number", None)
+
+    @property
+    def topology(self):
+        return getattr(self.port, "topology", None)
+
+    async def _call(self, fn, timeout=None):
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, fn)
+        if timeout is None:
+            return await fut
+        return await asyncio.wait_for(fut, timeout)
+
+    async def open(self, timeout=DEVICE_WAIT_TIMEOUT):
+        await self._call(functools.partial(self.port.open, timeout=timeout))
+        self._error = None
+        self._queue = asyncio.Queue()
+        self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._writer
+            self._writer = None
+        while self._queue is not None and not self._queue.empty():
+            fut = self._queue.get_nowait()[2]
+            if not fut.done():
+                fut.cancel()
+        await self._call(self.port.close)
+
+    def send(self, data, timeout=2000) -> asyncio.Future:
+        """Queue an OUT transfer; the future completes once it is written."""
+        fut = asyncio.get_running_loop().create_future()
+        if self._error is not None:
+            fut.set_exception(self._error)
+        else:
+            self._queue.put_nowait((data, timeout, fut))
+        return fut
+
+    async def write(self, data, timeout=2000):
+        return await self.send(data, timeout)
+
+    async def read(self, size=512, timeout=120000) -> bytes:
+        data = await self._call(
+            functools.partial(self.port.read, size, timeout=timeout),
+            timeout=timeout / 1000.0 + TIMEOUT_SLACK,
+        )
+        if self.timer:
+            self.timer.count_transfer("in", len(data), data)
+        return data
+
+    async def _write_loop(self):
+        while True:
+            data, timeout, fut = await self._queue.get()
+            if fut.done():
+                continue
+            if self._error is not None:
+                fut.set_exception(self._error)
+                continue
+            try:
+                await self._call(
+                    functools.partial(self.port.write, data, timeout=timeout),
+                    timeout=timeout / 1000.0 + TIMEOUT_SLACK,
+                )
+            except Exception as e:
+                self._error = e
+                if not fut.done():
+                    fut.set_exception(e)
+                continue
+            if self.timer:
+                self.timer.count_transfer("out", len(data), data)
+            if not fut.done():
+                fut.set_result(len(data))
+
+
+class AsyncPacketReader(PacketReader):
+    """Async counterpart of axdl_tool.PacketReader."""
+
+    def __init__(self, port: AsyncPort, read_size=512):
+        super().__init__(None, port, read_size)
+
+    async def next_packet(self, timeout: int):
+        """Return the next (cmd, payload) tuple, or None on timeout/invalid data."""
+        while True:
+            pkt = self.split()
+            if pkt is not None:
+                return decode_packet(pkt)
+            data = await self.port.read(self.read_size, timeout=timeout)
+            if not data:
+                return None
+            self._buf += data
+
+
+async def run_steps_async(steps, port: AsyncPort, tool):
+    """
+    Async counterpart of axdl_tool.run_steps on an opened AsyncPort.  A
+    PortSend returns the future of the queued write; blocking calls run in
+    the port's executor, and a board waiting for a data slot polls the
+    scheduler (see acquire_data_slot).  Writes still queued when the steps
+    end are cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    reader = AsyncPacketReader(port)
+    queued = set()
+    result, error = None, None
+
+    def written(fut):
+        queued.discard(fut)
+        # A failed write also fails every later one, which reports it
+        if not fut.cancelled():
+            fut.exception()
+
+    try:
+        while True:
+            try:
+                op = steps.throw(error) if error is not None else steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                if isinstance(op, PortPacket):
+                    reader.read_size = op.read_size
+                    result = await reader.next_packet(op.timeout)
+                elif isinstance(op, PortWrite):
+                    await port.write(op.data, op.timeout)
+                elif isinstance(op, PortSend):
+                    result = port.send(op.data, op.timeout)
+                    queued.add(result)
+                    result.add_done_callback(written)
+                elif isinstance(op, PortSent):
+                    await asyncio.gather(*op.handles)
+                elif isinstance(op, PortDrain):
+                    while await port.read(512, timeout=100):
+                        pass
+                    reader = AsyncPacketReader(port)
+                elif isinstance(op, BlockingCall):
+                    result = await loop.run_in_executor(port.executor, op.fn, *op.args)
+                elif isinstance(op, DataSlot):
+                    result = await acquire_data_slot(
+                        tool.scheduler, op.controller, tool.timer, op.on_wait
+                    )
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+        for fut in list(queued):
+            fut.cancel()
+
+
+async def acquire_data_slot(scheduler, controller, timer, on_wait=None):
+    """
+    BusScheduler.acquire() for a coroutine: the scheduler is asked again
+    every BUS_SAMPLE_TIME / 2 seconds, as its blocking waiters are.
+    """
+    slot = scheduler.try_acquire(controller, timer)
+    if slot is None and on_wait is not None:
+        on_wait()
+    while slot is None:
+        await asyncio.sleep(BUS_SAMPLE_TIME / 2)
+        slot = scheduler.try_acquire(controller, timer)
+    return slot
+
+
+class AsyncFlashSession(FlashSession):
+    """
+    axdl_tool.FlashSession on an AsyncPort: the same phases, settings and
+    FlashErrors, with every phase method (and run) returning a coroutine.
+    Used as an async context manager, the session opens and closes the
+    port.
+    """
+
+    def __init__(self, plan, port: AsyncPort, tool=None, logger=None, **kwargs):
+        super().__init__(plan, port, tool, logger, **kwargs)
+        # The AsyncPort counts its transfers itself
+        self.port = port
+        if port.timer is None:
+            port.timer = self.tool.timer
+
+    async def __aenter__(self):
+        await self.raw_port.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.raw_port.close()
+
+    def _run(self, steps):
+        return run_steps_async(steps, self.port, self.tool)
+
+
+async def flash_device_async(
+    tool,
+    port: AsyncPort,
+    logger,
+    cfg: dict,
+    image_sources: dict,
+    fdl1_src,
+    fdl2_src,
+    reset=False,
+    status=None,
+) -> bool:
+    """
+    Async counterpart of axdl_tool.flash_device on an opened AsyncPort
+    (see AsyncFlashSession).  Every step is recorded as a phase in
+    tool.timer.
+
+    :return: True on success, False (after logging it) on a FlashError
+    """
+    plan = FlashPlan(cfg, image_sources, fdl1_src, fdl2_src)
+    session = AsyncFlashSession(plan, port, tool, logger, status=status)
+    try:
+        await session.run(reset=reset)
+    except FlashError as e:
+        session.status.error = str(e)
+        logger.error(str(e))
+        return False
+    return True
+
+
+async def _flash_devices(
+    logger, device_paths, flash_args, make_port, make_tool, reset, timeout
+):
+    statuses = [FlashStatus(path or "usb") for path in device_paths]
+    # Each board has at most one read and one write pending at a time.
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=2 * len(device_paths) + 2
+    )
+
+    async def worker(index, path, status):
+        dev_logger = DeviceLogAdapter(logger, {"device": status.device})
+        tool = make_tool()
+        tool.progress_prefix = f"{status.device} "
+        tool.progress_position = index
+        port = AsyncPort(make_port(path, dev_logger), executor, tool.timer)
+        status.started = time.monotonic()
+        try:
+            await port.open()
+            status.ok = await asyncio.wait_for(
+                flash_device_async(
+                    tool,
+                    port,
+                    dev_logger,
+                    *flash_args,
+                    reset=reset,
+                    status=status,
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            status.error = f"timed out after {timeout}s"
+            dev_logger.error(f"Flashing timed out during {status.phase}.")
+        except Exception as e:
+            status.error = str(e)
+            dev_logger.error(f"Flashing failed during {status.phase}: {e}")
+        finally:
+            with contextlib.suppress(Exception):
+                await port.close()
+            status.finished = time.monotonic()
+            status.phases = tool.timer.report()
+            status.commands = tool.timer.command_report()
+        if status.ok:
+            status.phase = "done"
+
+    try:
+        await asyncio.gather(
+            *(
+                worker(index, path, status)
+                for index, (path, status) in enumerate(zip(device_paths, statuses))
+            )
+        )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return statuses
+
+
+def flash_devices_async(
+    logger,
+    device_paths: list,
+    flash_args: tuple,
+    make_port,
+    make_tool,
+    reset=False,
+    timeout=None,
+) -> list:
+    """
+    Flash every device in device_paths from one event loop; same arguments
+    and result as axdl_tool.flash_devices.  A path of None opens the first
+    board found.
+
+    :param timeout: Seconds after which a device's session is cancelled
+    """
+    return asyncio.run(
+        _flash_devices(
+            logger, device_paths, flash_args, make_port, make_tool, reset, timeout
+        )
+    )
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: axdl_bench.py
+Description: flashing benchmark for axdl_tool.py against the device simulator.
+
+Builds a synthetic AXP with a configurable partition mix, runs the full
+axdl_tool.main() flow against axdl_sim.SimulatedDevice and reports the wall
+time of every phase (AXP open, XML parse, ROM handshake, FDL1/FDL2 upload,
+repartition, erase, each partition's data transfer), MB/s per partition,
+round-trips per MB and CPU time.  The simulator runs in-process, so CPU time
+includes its (small) share of the work.  Results are written as JSON so runs
+can be compared across commits.
+
+# SPDX-FileCopyrightText: 2024 M5Stack Technology CO LTD
+#
+# SPDX-License-Identifier: MIT
+
+use: python3 axdl_bench.py --partitions spl:768K,kernel:16M:erase,rootfs:512M:deflate \
+        --sim latency_ms=0.25,bandwidth_mbps=40,flash_mbps=25 --runs 3 --out bench.json
+
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import axdl_sim
+import axdl_sparse
+import axdl_tool
+
+DEFAULT_PARTITIONS = "spl:768K,uboot:1536K,kernel:16M:erase,rootfs:256M:deflate"
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+FDL1_SIZE = 60 * 1024
+FDL2_SIZE = 384 * 1024
+
+
+def parse_size(text: str) -> int:
+    """Parse '768K', '16M', '1G' or a plain byte count."""
+    text = text.strip().upper()
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text, 0)
+
+
+def parse_partitions(spec: str) -> list:
+    """
+    Parse 'name:size[:deflate][:erase][:sparse],...' into a list of dicts.
+    deflate stores the image compressed in the AXP; erase adds an ERASEFLASH
+    entry before the image; sparse stores it as an Android sparse image of
+    that expanded size (built in memory), which only a simulator with
+    unsparse=1 accepts (main() adds it).
+    """
+    partitions = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        fields = item.strip().split(":")
+        if len(fields) < 2:
+            raise ValueError(f"Bad partition spec '{item}' (expected name:size)")
+        flags = set(fields[2:])
+        unknown = flags - {"deflate", "erase", "sparse"}
+        if unknown:
+            raise ValueError(f"Unknown partition flag(s) {sorted(unknown)} in '{item}'")
+        partitions.append(
+            {
+                "id": fields[0],
+                "size": parse_size(fields[1]),
+                "deflate": "deflate" in flags,
+                "erase": "erase" in flags,
+                "sparse": "sparse" in flags,
+            }
+        )
+    return partitions
+
+
+def _image_bytes(rng: random.Random, size: int, fill: str) -> bytes:
+    if fill == "zero":
+        return bytes(size)
+    if fill == "mixed":
+        # Half random, half zero, in 64 KiB runs: compresses to roughly 50%.
+        run = 64 * 1024
+        out = bytearray()
+        while len(out) < size:
+            n = min(run, size - len(out))
+            out += rng.randbytes(n) if (len(out) // run) % 2 == 0 else bytes(n)
+        return bytes(out)
+    return rng.randbytes(size)
+
+
+def make_synthetic_axp(path: str, partitions: list, fill="random", seed=0):
+    """
+    Write an AXP with FDL1/FDL2 blobs, one image per partition and a
+    matching XML (unit=2, i.e. KiB).  Every partition is sized to its image
+    rounded up to 1 MiB.
+    """
+    rng = random.Random(seed)
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        "<Config>",
+        '  <Project name="axdl_bench">',
+        '    <Partitions unit="2">',
+    ]
+    for p in partitions:
+        size_kib = ((p["size"] + (1 << 20) - 1) >> 20) << 10
+        lines.append(f'      <Partition id="{p["id"]}" size="{size_kib}" gap="0"/>')
+    lines += ["    </Partitions>", "    <ImgList>"]
+    for img_id, base, fname in (
+        ("FDL1", "0x3000000", "fdl1.bin"),
+        ("FDL2", "0x5C000000", "fdl2.bin"),
+    ):
+        lines.append(
+            f'      <Img flag="3" select="1"><ID>{img_id}</ID><Type>{img_id}</Type>'
+            f"<Block><Base>{base}</Base></Block><File>{fname}</File></Img>"
+        )
+    for p in partitions:
+        if p["erase"]:
+            lines.append(
+                f'      <Img flag="0" select="1"><ID>ERASE_{p["id"].upper()}</ID>'
+                f'<Type>ERASEFLASH</Type><Block id="{p["id"]}"><Base>0x0</Base>'
+                f"</Block><File></File></Img>"
+            )
+        lines.append(
+            f'      <Img flag="1" select="1"><ID>{p["id"].upper()}</ID><Type>CODE</Type>'
+            f'<Block id="{p["id"]}"><Base>0x0</Base></Block>'
+            f'<File>{p["id"]}.img</File></Img>'
+        )
+    lines += ["    </ImgList>", "  </Project>", "</Config>"]
+
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("axdl_bench.xml", "\n".join(lines), zipfile.ZIP_DEFLATED)
+        zf.writestr("fdl1.bin", rng.randbytes(FDL1_SIZE), zipfile.ZIP_STORED)
+        zf.writestr("fdl2.bin", rng.randbytes(FDL2_SIZE), zipfile.ZIP_STORED)
+        for p in partitions:
+            info = zipfile.ZipInfo(f"{p['id']}.img", time.localtime()[:6])
+            info.compress_type = (
+                zipfile.ZIP_DEFLATED if p["deflate"] else zipfile.ZIP_STORED
+            )
+            if p["sparse"]:
+                raw = _image_bytes(rng, -(-p["size"] // 4096) * 4096, fill)
+                zf.writestr(info, axdl_sparse.make_sparse(raw))
+                continue
+            # Write in 64 MiB pieces so large images do not sit in memory twice.
+            with zf.open(info, "w", force_zip64=p["size"] >= (1 << 31)) as member:
+                remain = p["size"]
+                while remain:
+                    n = min(remain, 64 << 20)
+                    member.write(_image_bytes(rng, n, fill))
+                    remain -= n
+
+
+def summarize_run(report: dict, wall: float, cpu: float) -> dict:
+    """Reduce one --timings report to per-phase numbers."""
+    phases = {}
+    for p in report["setup"]:
+        phases[p["name"]] = {"wall": p["wall"], "cpu": p["cpu"]}
+    dev = report["devices"][0]
+    for p in dev["phases"]:
+        entry = {
+            "wall": p["wall"],
+            "cpu": p["cpu"],
+            "round_trips": p["reads"],
+            "retries": p.get("retries", 0),
+        }
+        if p["name"].startswith("image:") and p["bytes"]:
+            mb = p["bytes"] / 1e6
+            entry["bytes"] = p["bytes"]
+            entry["mb_per_s"] = mb / p["wall"] if p["wall"] else None
+            entry["round_trips_per_mb"] = p["reads"] / mb
+        phases[p["name"]] = entry
+    data_bytes = sum(p.get("bytes", 0) for p in phases.values())
+    data_reads = sum(
+        p["round_trips"] for name, p in phases.items() if name.startswith("image:")
+    )
+    return {
+        "ok": dev["ok"],
+        "failed_phase": None if dev["ok"] else dev["phase"],
+        "wall": wall,
+        "cpu": cpu,
+        "data_bytes": data_bytes,
+        "round_trips_per_mb": data_reads / (data_bytes / 1e6) if data_bytes else None,
+        "phases": phases,
+    }
+
+
+def aggregate(runs: list) -> dict:
+    """Median/min/max of wall, cpu and MB/s over the successful runs."""
+
+    def stats(values):
+        values = [v for v in values if v is not None]
+        if not values:
+            return None
+        return {
+            "median": statistics.median(values),
+            "min": min(values),
+            "max": max(values),
+        }
+
+    ok_runs = [r for r in runs if r["ok"]]
+    summary = {
+        "runs": len(runs),
+        "failed": len(runs) - len(ok_runs),
+        "wall": stats(r["wall"] for r in ok_runs),
+        "cpu": stats(r["cpu"] for r in ok_runs),
+        "round_trips_per_mb": stats(r["round_trips_per_mb"] for r in ok_runs),
+        "phases": {},
+    }
+    names = []
+    for r in ok_runs:
+        names += [n for n in r["phases"] if n not in names]
+    for name in names:
+        entries = [r["phases"][name] for r in ok_runs if name in r["phases"]]
+        summary["phases"][name] = {
+            key: stats(e.get(key) for e in entries)
+            for key in ("wall", "cpu", "mb_per_s", "round_trips_per_mb")
+            if any(e.get(key) is not None for e in entries)
+        }
+    return summary
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def print_summary(summary: dict):
+    print(f"{'PHASE':<24} {'WALL(s)':>9} {'CPU(s)':>8} {'MB/s':>8} {'RT/MB':>7}")
+    for name, entry in summary["phases"].items():
+        wall = entry.get("wall")
+        cpu = entry.get("cpu")
+        rate = entry.get("mb_per_s")
+        rtpm = entry.get("round_trips_per_mb")
+        print(
+            f"{name:<24} {wall['median'] if wall else 0:>9.3f}"
+            f" {cpu['median'] if cpu else 0:>8.3f}"
+            f" {rate['median'] if rate else 0:>8.2f}"
+            f" {rtpm['median'] if rtpm else 0:>7.1f}"
+        )
+    if summary["wall"]:
+        print(
+            f"total: {summary['wall']['median']:.3f}s wall, "
+            f"{summary['cpu']['median']:.3f}s CPU "
+            f"({summary['runs'] - summary['failed']}/{summary['runs']} runs ok)"
+        )
+    else:
+        print(f"total: all {summary['runs']} runs failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark axdl_tool.py against the device simulator.",
+    )
+    parser.add_argument(
+        "--partitions",
+        default=DEFAULT_PARTITIONS,
+        help=f"name:size[:deflate][:erase][:sparse],... (default {DEFAULT_PARTITIONS})",
+    )
+    parser.add_argument(
+        "--fill",
+        choices=("random", "zero", "mixed"),
+        default="random",
+        help="Content of the synthetic images.",
+    )
+    parser.add_argument("--axp", help="Benchmark this AXP instead of a synthetic one.")
+    parser.add_argument(
+        "--sim",
+        default="latency_ms=0.25,bandwidth_mbps=40,flash_mbps=25",
+        help="Simulator options (see axdl_sim.parse_sim_spec); unsparse=1 is"
+        " added when a synthetic partition is sparse.",
+    )
+    parser.add_argument("--runs", type=int, default=1, help="Number of runs.")
+    parser.add_argument(
+        "--tool-args",
+        default="",
+        help="Extra axdl_tool.py arguments, e.g. '--window 4'.",
+    )
+    parser.add_argument("--out", help="Write the results as JSON to this file.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+
+    sim_spec = args.sim
+    with tempfile.TemporaryDirectory() as tmpdir:
+        axp_path = args.axp
+        partitions = None
+        if not axp_path:
+            partitions = parse_partitions(args.partitions)
+            axp_path = os.path.join(tmpdir, "axdl_bench.axp")
+            make_synthetic_axp(axp_path, partitions, fill=args.fill)
+            # A sparse image is larger than the partition it expands into.
+            sparse = any(p["sparse"] for p in partitions)
+            if sparse and "unsparse" not in axdl_sim.parse_sim_spec(sim_spec):
+                sim_spec = f"{sim_spec},unsparse=1" if sim_spec else "unsparse=1"
+
+        runs = []
+        for i in range(args.runs):
+            timings_path = os.path.join(tmpdir, f"run{i}.json")
+            argv = [
+                "--axp",
+                axp_path,
+                "--sim",
+                sim_spec,
+                "--timings",
+                timings_path,
+                "--no-progress",
+            ] + args.tool_args.split()
+            wall0 = time.monotonic()
+            cpu0 = time.process_time()
+            try:
+                axdl_tool.main(argv)
+            except SystemExit as e:
+                if e.code not in (None, 0) and not os.path.exists(timings_path):
+                    print(f"run {i + 1}: axdl_tool exited with {e.code}")
+                    sys.exit(1)
+            wall = time.monotonic() - wall0
+            cpu = time.process_time() - cpu0
+            with open(timings_path, "r", encoding="utf-8") as f:
+                runs.append(summarize_run(json.load(f), wall, cpu))
+            if runs[-1]["ok"]:
+                print(f"run {i + 1}/{args.runs}: {wall:.3f}s")
+            else:
+                print(
+                    f"run {i + 1}/{args.runs}: FAILED in phase "
+                    f"{runs[-1]['failed_phase']} after {wall:.3f}s"
+                )
+
+    result = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "axp": args.axp,
+            "partitions": partitions,
+            "fill": args.fill,
+            "sim": sim_spec,
+            "tool_args": args.tool_args,
+        },
+        "summary": aggregate(runs),
+        "runs": runs,
+    }
+    print_summary(result["summary"])
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if result["summary"]["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
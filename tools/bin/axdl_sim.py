@@ -0,0 +1,953 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: axdl_sim.py
+Description: in-process simulator of the ROM/FDL side of the AXDL BSL protocol.
+
+SimulatedDevice has the same open/read/write/close interface as
+axdl_tool.USBSerialPort, so AXDLTool can flash it without hardware.  Partition
+data is written into a sparse backing file, so a flash can be checked byte for
+byte afterwards.  Per-transfer latency, link bandwidth and flash write speed
+are modelled with real sleeps, which makes the simulator usable for
+throughput benchmarks.
+
+# SPDX-FileCopyrightText: 2024 M5Stack Technology CO LTD
+#
+# SPDX-License-Identifier: MIT
+
+use: python3 axdl_sim.py --axp ./M5_LLM_ubuntu22.04_20250210.axp
+
+"""
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import json
+import logging
+import math
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from axdl_tool import (
+    AXDLGlobData,
+    AXDLTool,
+    AXPError,
+    BSL_CMD_CONNECT,
+    BSL_CMD_ENDED_DATA,
+    BSL_CMD_ERASE_FLASH,
+    BSL_CMD_EXEC_DATA,
+    BSL_CMD_MIDST_DATA,
+    BSL_CMD_READ_FLASH_END,
+    BSL_CMD_READ_FLASH_MIDST,
+    BSL_CMD_READ_FLASH_START,
+    BSL_CMD_REPARTITION,
+    BSL_CMD_RESET,
+    BSL_CMD_START_DATA,
+    BSL_REP_ACK,
+    BSL_REP_DOWN_SIZE_ERROR,
+    BSL_REP_FLASH_DATA,
+    BSL_REP_INVALID_CMD,
+    BSL_REP_OPERATION_FAILED,
+    BSL_REP_UNKNOW_CMD,
+    BSL_REP_VER,
+    BSL_REP_VERIFY_ERROR,
+    CMD_HANDSHAKE_BYTE,
+    DEFAULT_DATA_WINDOW,
+    DEVICE_WAIT_TIMEOUT,
+    FlashError,
+    FlashPlan,
+    FlashSession,
+    PARTITION_MAGIC,
+    UNIT_SIZE_TABLE,
+    data_checksum16,
+)
+from axdl_sparse import (
+    SPARSE_HEADER,
+    SparseFormatError,
+    SparseReader,
+    expand,
+    is_sparse,
+)
+
+STAGE_ROM = "ROM CODE"
+STAGE_FDL1 = "FDL1"
+STAGE_FDL2 = "FDL2"
+STAGE_RESET = "RESET"
+
+# Capacity given to a partition declared with a negative size ("rest of flash").
+DEFAULT_CAPACITY = 32 << 30
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def _punch_hole(fd, offset: int, length: int):
+    """Deallocate [offset, offset + length) of a file, zero-filling as fallback."""
+    libc_name = ctypes.util.find_library("c")
+    if libc_name:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        fallocate = getattr(libc, "fallocate", None)
+        if fallocate is not None:
+            fallocate.argtypes = [
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.c_int64,
+                ctypes.c_int64,
+            ]
+            mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+            if fallocate(fd, mode, offset, length) == 0:
+                return
+    zeros = b"\x00" * (1 << 20)
+    end = offset + length
+    while offset < end:
+        n = min(len(zeros), end - offset)
+        os.pwrite(fd, zeros[:n], offset)
+        offset += n
+
+
+class SimBus:
+    """
+    USB bus shared by simulated boards: their transfers go over it one after
+    the other at rate bytes/s, so boards on one bus split its bandwidth.
+    Interleaving transfers of different boards costs switch_time seconds
+    each time, like the scheduling overhead of a busy host controller.
+    """
+
+    def __init__(self, rate: float, switch_time: float = 0.0):
+        self.rate = rate
+        self.switch_time = switch_time
+        self._lock = threading.Lock()
+        self._free_at = 0.0
+        self._owner = None
+
+    def reserve(self, owner, nbytes: int) -> float:
+        """Book nbytes for owner on the bus; returns the time they are through."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._free_at)
+            if self._free_at > now and owner is not self._owner:
+                start += self.switch_time
+            self._owner = owner
+            self._free_at = start + nbytes / self.rate
+            return self._free_at
+
+
+# SimBus of each (bus number, rate, switch time), shared by the boards of a process
+_sim_buses = {}
+
+
+class SimulatedDevice:
+    """
+    Software model of a board in download mode.
+
+    The device walks through the same stages as real hardware: ROM CODE
+    (handshake, FDL1 upload), FDL1 (handshake, FDL2 upload) and FDL2
+    (repartition, erase, partition download and read-back, reset).  Every
+    packet's
+    checksum16 is verified; bad packets are answered with
+    BSL_REP_VERIFY_ERROR.  Each run of 0x3C handshake bytes between packets
+    is answered with BSL_REP_VER, in any stage.
+
+    Timing model (all optional, 0 disables):
+    - latency: seconds added to every bulk transfer in either direction
+    - bandwidth: link speed in bytes/s, applied to OUT transfers and to the
+      data of READ_FLASH replies
+    - flash_rate: flash write speed in bytes/s; data chunks are written in
+      the background and at most rx_buffers chunks can wait for the flash
+      before further OUT transfers stall
+    - erase_time: seconds per ERASE_FLASH command
+    - boot_time: seconds an FDL takes to start after EXEC_DATA; meanwhile
+      handshake bytes for FDL1 are lost and OUT transfers to FDL2 stall
+    - bus_link: SimBus the board shares with others on its bus (number bus);
+      OUT transfers and READ_FLASH data also have to get through it
+
+    Fault injection: corrupt_rate is the probability that a received
+    partition data chunk has one byte flipped, as a link error would.  With
+    per-chunk checksums the chunk is rejected, without them it is written
+    corrupted.
+    disconnect_after makes the device vanish (every transfer raises
+    IOError) once that many MIDST_DATA payload bytes have been received.
+    stall_after makes it stop answering at that point instead, as a hung
+    FDL would, for stall_time seconds (0 = for good).
+
+    With unsparse the device unpacks Android sparse images written to a
+    partition, as an FDL with sparse support does: the received stream is
+    spooled and expanded into the partition on ENDED_DATA (DONT_CARE blocks
+    keep their old content).
+
+    The ROM and FDL1 stages take FDL chunks of up to fdl_chunk_max bytes
+    (0 = any size) and answer larger MIDST_DATA headers with
+    BSL_REP_DOWN_SIZE_ERROR.  With fdl_split they drop whatever follows a
+    MIDST_DATA header in the same OUT transfer, so the data of a chunk must
+    be sent on its own.  fdl_ack_time delays their ACK of each FDL data
+    chunk.
+
+    With a backing_path the flash survives the device object: the backing
+    file is not truncated on open and the partition table is kept next to
+    it in backing_path + ".parts", so a later session sees the old content.
+    serial_number is the USB iSerialNumber reported, None for a board
+    without one.
+    """
+
+    def __init__(
+        self,
+        path="sim-1",
+        backing_path=None,
+        serial_number=None,
+        latency=0.0,
+        bandwidth=0,
+        flash_rate=0,
+        erase_time=0.0,
+        boot_time=0.0,
+        rx_buffers=2,
+        capacity=DEFAULT_CAPACITY,
+        secureboot=False,
+        corrupt_rate=0.0,
+        disconnect_after=0,
+        stall_after=0,
+        stall_time=0.0,
+        unsparse=False,
+        fdl_chunk_max=0,
+        fdl_split=False,
+        fdl_ack_time=0.0,
+        bus=1,
+        bus_link=None,
+        logger=None,
+    ):
+        """
+        :param path: Name reported as the device's bus-port path
+        :param backing_path: File receiving the flash contents; a temporary
+            file is used when None
+        :param serial_number: USB serial number reported (None = none)
+        :param capacity: Size given to a partition with a negative size
+        :param secureboot: Report "secureboot" in the ROM handshake
+        :param corrupt_rate: Probability of corrupting a received data chunk
+        :param disconnect_after: MIDST_DATA payload bytes after which the device
+            disconnects (0 = never)
+        :param stall_after: MIDST_DATA payload bytes after which the device
+            stops answering (0 = never)
+        :param stall_time: Seconds the stall lasts (0 = for good)
+        :param unsparse: Expand sparse images into their partition
+        :param fdl_chunk_max: Largest FDL chunk the ROM/FDL1 stages take
+        :param fdl_split: ROM/FDL1 drop the rest of a transfer after a header
+        :param fdl_ack_time: Seconds ROM/FDL1 take to ACK each FDL data chunk
+        :param bus: USB bus number reported in the topology
+        :param bus_link: SimBus shared with the other boards on the bus
+        """
+        self.path = path
+        self.backing_path = backing_path
+        self.serial_number = serial_number
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flash_rate = flash_rate
+        self.erase_time = erase_time
+        self.boot_time = boot_time
+        self._booted_at = 0.0
+        self.rx_buffers = max(1, rx_buffers)
+        self.capacity = capacity
+        self.secureboot = secureboot
+        self.corrupt_rate = corrupt_rate
+        self.disconnect_after = disconnect_after
+        self.stall_after = stall_after
+        self.stall_time = stall_time
+        self._stall_until = None
+        self.unsparse = unsparse
+        self.fdl_chunk_max = fdl_chunk_max
+        self.fdl_split = fdl_split
+        self.fdl_ack_time = fdl_ack_time
+        self.bus = bus
+        self.bus_link = bus_link
+        self._rng = random.Random()
+        self.logger = logger if logger else logging.getLogger("SimulatedDevice")
+        self.codec = AXDLTool()
+
+        self.is_open = False
+        self._backing = None
+        self._cond = threading.Condition()
+        self._responses = collections.deque()  # (ready_time, bytes)
+        self._last_ready = 0.0
+        self._flash_busy = collections.deque()  # completion times of chunks
+        self._rx = bytearray()
+        self.reset_state()
+
+        # Counters, e.g. for round-trip statistics in benchmarks
+        self.stats = collections.Counter()
+
+    def reset_state(self):
+        """Return to the ROM CODE stage, forgetting partitions and uploads."""
+        self.stage = STAGE_ROM
+        self.awaiting_handshake = True
+        self.partitions = collections.OrderedDict()  # name -> (offset, size)
+        self.fdl_images = {}  # stage -> bytes uploaded during that stage
+        self._download = None
+        self._midst = None
+        self._read = None  # partition being read back: (name, offset, size)
+
+    # ---- port interface ----
+
+    def open(self, timeout=DEVICE_WAIT_TIMEOUT):
+        if self.backing_path:
+            fd = os.open(self.backing_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._backing = os.fdopen(fd, "r+b")
+            self._load_partitions()
+        else:
+            self._backing = tempfile.TemporaryFile()
+        self.is_open = True
+        self.logger.info(f"SimulatedDevice {self.path} open.")
+
+    def close(self):
+        if self.is_open:
+            self._backing.close()
+            self._backing = None
+            self.is_open = False
+            self.logger.info(f"SimulatedDevice {self.path} closed.")
+
+    def write(self, data, timeout=2000):
+        if not self.is_open:
+            raise IOError("Cannot write: SimulatedDevice is not open.")
+        self._check_connected()
+        data = bytes(data)
+        self.stats["out_transfers"] += 1
+        self.stats["out_bytes"] += len(data)
+        if self._midst is not None and self.flash_rate:
+            self._wait_rx_buffer(timeout)
+        booting = self._booted_at - time.monotonic()
+        if booting > 0 and self.awaiting_handshake:
+            self.stats["lost_while_booting"] += 1
+            return len(data)
+        if booting > 0:
+            time.sleep(booting)
+        delay = self.latency
+        if self.bandwidth:
+            delay += len(data) / self.bandwidth
+        if self.bus_link is not None:
+            delay = max(
+                delay, self.bus_link.reserve(self, len(data)) - time.monotonic()
+            )
+        if delay:
+            time.sleep(delay)
+        with self._cond:
+            self._rx += data
+            self._process()
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size=512, timeout=120000) -> bytes:
+        if not self.is_open:
+            raise IOError("Cannot read: SimulatedDevice is not open.")
+        self._check_connected()
+        deadline = time.monotonic() + timeout / 1000.0
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._responses and self._responses[0][0] <= now:
+                    ready, resp = self._responses.popleft()
+                    if len(resp) > size:
+                        # The rest stays for the next read
+                        self._responses.appendleft((ready, resp[size:]))
+                        resp = resp[:size]
+                    self.stats["in_transfers"] += 1
+                    self.stats["in_bytes"] += len(resp)
+                    return resp
+                if now >= deadline:
+                    self.stats["read_timeouts"] += 1
+                    return b""
+                wake = deadline
+                if self._responses:
+                    wake = min(wake, self._responses[0][0])
+                self._cond.wait(wake - now)
+
+    @property
+    def topology(self) -> dict:
+        """Same shape as axdl_tool.usb_topology(); each bus is its own controller."""
+        return {
+            "path": self.path,
+            "bus": self.bus,
+            "ports": [],
+            "hub": f"sim-usb{self.bus}",
+            "controller": f"sim-usb{self.bus}",
+            "speed": "high",
+        }
+
+    # ---- flash contents ----
+
+    def read_partition(self, name: str, pos=0, length=None) -> bytes:
+        """Return length bytes (default: up to the end) of a partition from pos."""
+        offset, size = self.partitions[name]
+        if length is None or pos + length > size:
+            length = max(0, size - pos)
+        return os.pread(self._backing.fileno(), length, offset + pos)
+
+    # ---- internals ----
+
+    def _check_connected(self):
+        if self.disconnect_after and self.stats["data_bytes"] >= self.disconnect_after:
+            raise IOError(f"SimulatedDevice {self.path} disconnected.")
+
+    def _parts_path(self):
+        return self.backing_path + ".parts"
+
+    def _load_partitions(self):
+        try:
+            with open(self._parts_path(), "r", encoding="utf-8") as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.partitions = collections.OrderedDict(
+            (name, (offset, size)) for name, offset, size in table
+        )
+
+    def _save_partitions(self):
+        table = [[name, off, size] for name, (off, size) in self.partitions.items()]
+        with open(self._parts_path(), "w", encoding="utf-8") as f:
+            json.dump(table, f)
+
+    def _wait_rx_buffer(self, timeout):
+        deadline = time.monotonic() + timeout / 1000.0
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while self._flash_busy and self._flash_busy[0] <= now:
+                    self._flash_busy.popleft()
+                if len(self._flash_busy) < self.rx_buffers:
+                    return
+                wake = self._flash_busy[0]
+            if wake > deadline:
+                raise IOError("Simulated OUT transfer timed out (flash busy).")
+            time.sleep(max(0.0, wake - time.monotonic()))
+
+    def _respond(self, cmd: int, payload: bytes = b"", ready=None):
+        now = time.monotonic()
+        if ready is None:
+            ready = now
+        if self._stall_until is not None:
+            ready = max(ready, self._stall_until)
+        ready = max(ready + self.latency, self._last_ready)
+        self._last_ready = ready
+        self._responses.append((ready, self.codec.build_packet(cmd, payload)))
+
+    def _process(self):
+        while self._rx:
+            if self.stage == STAGE_RESET:
+                self._rx.clear()
+                return
+            if self._midst is not None:
+                if not self._take_midst_data():
+                    return
+                continue
+            # Every run of handshake bytes gets its BSL_REP_VER, also one
+            # sent again before the first answer got back
+            if self._rx[0] == CMD_HANDSHAKE_BYTE:
+                while self._rx and self._rx[0] == CMD_HANDSHAKE_BYTE:
+                    del self._rx[0]
+                self._handshake()
+                continue
+            if len(self._rx) < 8:
+                return
+            magic, length = struct.unpack_from("<IH", self._rx, 0)
+            if magic != AXDLGlobData.MAGIC_NUMBER:
+                # Resynchronise on the next magic number
+                self.stats["bad_packets"] += 1
+                idx = self._rx.find(struct.pack("<I", AXDLGlobData.MAGIC_NUMBER), 1)
+                del self._rx[: idx if idx > 0 else len(self._rx)]
+                self._respond(BSL_REP_INVALID_CMD)
+                continue
+            total = 4 + 2 + 2 + length + 2
+            if len(self._rx) < total:
+                return
+            pkt = bytes(self._rx[:total])
+            del self._rx[:total]
+            parsed = self.codec.parse_packet(pkt)
+            if parsed is None:
+                self.stats["bad_packets"] += 1
+                self._respond(BSL_REP_VERIFY_ERROR)
+                continue
+            self.stats["commands"] += 1
+            self._command(*parsed)
+
+    def _handshake(self):
+        version = f"AX620E {self.stage}"
+        if self.stage == STAGE_ROM and self.secureboot:
+            version += " secureboot"
+        self.awaiting_handshake = False
+        self._respond(BSL_REP_VER, version.encode("utf-8"))
+
+    def _command(self, cmd: int, payload: bytes):
+        if cmd == BSL_CMD_CONNECT:
+            self._respond(BSL_REP_ACK)
+        elif cmd == BSL_CMD_START_DATA:
+            self._start_data(payload)
+        elif cmd == BSL_CMD_MIDST_DATA:
+            self._midst_header(payload)
+        elif cmd == BSL_CMD_ENDED_DATA:
+            self._ended_data()
+        elif cmd == BSL_CMD_EXEC_DATA:
+            self._exec_data()
+        elif cmd == BSL_CMD_REPARTITION and self.stage == STAGE_FDL2:
+            self._repartition(payload)
+        elif cmd == BSL_CMD_ERASE_FLASH and self.stage == STAGE_FDL2:
+            self._erase(payload)
+        elif cmd == BSL_CMD_READ_FLASH_START and self.stage == STAGE_FDL2:
+            self._read_flash_start(payload)
+        elif cmd == BSL_CMD_READ_FLASH_MIDST and self.stage == STAGE_FDL2:
+            self._read_flash_midst(payload)
+        elif cmd == BSL_CMD_READ_FLASH_END and self.stage == STAGE_FDL2:
+            self._read = None
+            self._respond(BSL_REP_ACK)
+        elif cmd == BSL_CMD_RESET:
+            self._respond(BSL_REP_ACK)
+            self.logger.debug(f"{self.path}: reset")
+            self.stage = STAGE_RESET
+        else:
+            self._respond(BSL_REP_UNKNOW_CMD)
+
+    def _start_data(self, payload: bytes):
+        if self.stage == STAGE_FDL2:
+            if len(payload) < 72 + 8:
+                self._respond(BSL_REP_INVALID_CMD)
+                return
+            name = bytes(payload[:72]).decode("utf-16-le").rstrip("\x00")
+            (size,) = struct.unpack_from("<Q", payload, 72)
+            if name not in self.partitions:
+                self.logger.debug(f"{self.path}: unknown partition '{name}'")
+                self._respond(BSL_REP_OPERATION_FAILED)
+                return
+            offset, part_size = self.partitions[name]
+            # With unsparse a sparse image may be larger than the partition
+            # it expands into; its first chunk tells (see _take_midst_data).
+            if size > part_size and not self.unsparse:
+                self._respond(BSL_REP_DOWN_SIZE_ERROR)
+                return
+            self._download = {"name": name, "offset": offset, "size": size, "pos": 0}
+            if size > part_size:
+                self._download["check_size"] = part_size
+        else:
+            if len(payload) == 8:
+                base, size = struct.unpack("<II", payload)
+            elif len(payload) == 16:
+                base, size = struct.unpack("<QQ", payload)
+            else:
+                self._respond(BSL_REP_INVALID_CMD)
+                return
+            self._download = {
+                "name": self.stage,
+                "base": base,
+                "size": size,
+                "pos": 0,
+                "data": bytearray(),
+            }
+        self._respond(BSL_REP_ACK)
+
+    def _midst_header(self, payload: bytes):
+        if self._download is None or len(payload) < 12:
+            self._respond(BSL_REP_INVALID_CMD)
+            return
+        size, enable, checksum = struct.unpack_from("<III", payload, 0)
+        if self._download["pos"] + size > self._download["size"]:
+            self._respond(BSL_REP_DOWN_SIZE_ERROR)
+            return
+        fdl = "data" in self._download
+        if fdl and self.fdl_chunk_max and size > self.fdl_chunk_max:
+            self._respond(BSL_REP_DOWN_SIZE_ERROR)
+            return
+        if fdl and self.fdl_split and self._rx:
+            self.stats["dropped_bytes"] += len(self._rx)
+            self._rx.clear()
+        self._midst = (size, enable, checksum)
+        self._respond(BSL_REP_ACK)
+
+    def _take_midst_data(self) -> bool:
+        size, enable, checksum = self._midst
+        if len(self._rx) < size:
+            return False
+        chunk = bytes(self._rx[:size])
+        del self._rx[:size]
+        self._midst = None
+        corrupt = self.corrupt_rate and "data" not in self._download
+        if corrupt and self._rng.random() < self.corrupt_rate:
+            self.stats["corrupted_chunks"] += 1
+            pos = self._rng.randrange(size) if size else 0
+            chunk = chunk[:pos] + bytes([chunk[pos] ^ 0xFF]) + chunk[pos + 1 :]
+        if enable and data_checksum16(chunk) != checksum:
+            self.stats["chunk_checksum_errors"] += 1
+            self._respond(BSL_REP_VERIFY_ERROR)
+            return True
+
+        dl = self._download
+        if dl["pos"] == 0 and "check_size" in dl:
+            expanded = None
+            if is_sparse(chunk) and len(chunk) >= SPARSE_HEADER.size:
+                fields = SPARSE_HEADER.unpack_from(chunk)
+                expanded = fields[5] * fields[6]  # blk_sz * total_blks
+            if expanded is None or expanded > dl["check_size"]:
+                self._respond(BSL_REP_DOWN_SIZE_ERROR)
+                return True
+        done = time.monotonic()
+        if "data" in dl:
+            dl["data"] += chunk
+            done += self.fdl_ack_time
+        elif "spool" in dl or (self.unsparse and dl["pos"] == 0 and is_sparse(chunk)):
+            dl.setdefault("spool", tempfile.TemporaryFile()).write(chunk)
+        else:
+            os.pwrite(self._backing.fileno(), chunk, dl["offset"] + dl["pos"])
+            if self.flash_rate:
+                start = max(done, self._flash_busy[-1] if self._flash_busy else done)
+                done = start + size / self.flash_rate
+                self._flash_busy.append(done)
+        dl["pos"] += size
+        self.stats["data_bytes"] += size
+        stalls = self.stall_after and self.stats["data_bytes"] >= self.stall_after
+        if stalls and self._stall_until is None:
+            self.stats["stalls"] += 1
+            self._stall_until = done + self.stall_time if self.stall_time else math.inf
+        self._respond(BSL_REP_ACK, ready=done)
+        return True
+
+    def _ended_data(self):
+        dl = self._download
+        if dl is None or dl["pos"] != dl["size"]:
+            self._respond(BSL_REP_DOWN_SIZE_ERROR)
+            return
+        if "data" in dl:
+            self.fdl_images[self.stage] = bytes(dl["data"])
+        if "spool" in dl:
+            self._download = None
+            if not self._expand_sparse(dl):
+                self._respond(BSL_REP_OPERATION_FAILED)
+                return
+        ready = self._flash_busy[-1] if self._flash_busy else None
+        self._download = None
+        self._respond(BSL_REP_ACK, ready=ready)
+
+    def _expand_sparse(self, dl) -> bool:
+        """Expand the spooled sparse image of dl into its partition."""
+        _, part_size = self.partitions[dl["name"]]
+        fd = self._backing.fileno()
+
+        def write(offset, data):
+            if offset + len(data) > part_size:
+                raise SparseFormatError("Image expands past the end of the partition.")
+            os.pwrite(fd, data, dl["offset"] + offset)
+
+        with dl["spool"] as spool:
+            spool.seek(0)
+            try:
+                expanded = expand(SparseReader(spool), write)
+            except SparseFormatError as e:
+                self.logger.debug(f"{self.path}: bad sparse image: {e}")
+                return False
+        self.stats["sparse_images"] += 1
+        self.stats["sparse_expanded_bytes"] += expanded
+        return True
+
+    def _exec_data(self):
+        if self.stage not in self.fdl_images:
+            self._respond(BSL_REP_OPERATION_FAILED)
+            return
+        self._respond(BSL_REP_ACK)
+        self._booted_at = time.monotonic() + self.boot_time
+        if self.stage == STAGE_ROM:
+            self.stage = STAGE_FDL1
+            self.awaiting_handshake = True
+        elif self.stage == STAGE_FDL1:
+            self.stage = STAGE_FDL2
+        self.logger.debug(f"{self.path}: now running {self.stage}")
+
+    def _repartition(self, payload: bytes):
+        if len(payload) < 8:
+            self._respond(BSL_REP_INVALID_CMD)
+            return
+        magic, version, unit, count = struct.unpack_from("<IBBH", payload, 0)
+        body_size = 72 + 8 + 8
+        if (
+            magic != PARTITION_MAGIC
+            or unit not in UNIT_SIZE_TABLE
+            or len(payload) != 8 + count * body_size
+        ):
+            self._respond(BSL_REP_INVALID_CMD)
+            return
+        unit_size = UNIT_SIZE_TABLE[unit]
+        partitions = collections.OrderedDict()
+        offset = 0
+        for i in range(count):
+            body = payload[8 + i * body_size : 8 + (i + 1) * body_size]
+            name = bytes(body[:72]).decode("utf-16-le").rstrip("\x00")
+            size, gap = struct.unpack_from("<qq", body, 72)
+            size = size * unit_size if size >= 0 else self.capacity
+            partitions[name] = (offset, size)
+            offset += size + max(0, gap) * unit_size
+        self.partitions = partitions
+        self._backing.truncate(offset)
+        if self.backing_path:
+            self._save_partitions()
+        self._respond(BSL_REP_ACK)
+
+    def _erase(self, payload: bytes):
+        if len(payload) < 8 + 72 + 8:
+            self._respond(BSL_REP_INVALID_CMD)
+            return
+        name = bytes(payload[8:80]).decode("utf-16-le").rstrip("\x00")
+        (size,) = struct.unpack_from("<Q", payload, 80)
+        if name not in self.partitions:
+            self._respond(BSL_REP_OPERATION_FAILED)
+            return
+        offset, part_size = self.partitions[name]
+        if size == 0 or size > part_size:
+            size = part_size
+        _punch_hole(self._backing.fileno(), offset, size)
+        ready = time.monotonic() + self.erase_time
+        self._respond(BSL_REP_ACK, ready=ready)
+
+    def _read_flash_start(self, payload: bytes):
+        if len(payload) < 72 + 8:
+            self._respond(BSL_REP_INVALID_CMD)
+            return
+        name = bytes(payload[:72]).decode("utf-16-le").rstrip("\x00")
+        (size,) = struct.unpack_from("<Q", payload, 72)
+        if name not in self.partitions:
+            self._respond(BSL_REP_OPERATION_FAILED)
+            return
+        offset, part_size = self.partitions[name]
+        if size > part_size:
+            self._respond(BSL_REP_DOWN_SIZE_ERROR)
+            return
+        self._read = (name, offset, size)
+        self._respond(BSL_REP_ACK)
+
+    def _read_flash_midst(self, payload: bytes):
+        if self._read is None or len(payload) < 12:
+            self._respond(BSL_REP_INVALID_CMD)
+            return
+        length, pos = struct.unpack_from("<IQ", payload, 0)
+        _, offset, size = self._read
+        if pos + length > size or length > 0xFFFF:
+            self._respond(BSL_REP_DOWN_SIZE_ERROR)
+            return
+        data = os.pread(self._backing.fileno(), length, offset + pos)
+        data += bytes(length - len(data))  # past the end of the backing file
+        self.stats["read_bytes"] += length
+        ready = time.monotonic()
+        if self.bandwidth:
+            ready += length / self.bandwidth
+        if self.bus_link is not None:
+            ready = max(ready, self.bus_link.reserve(self, length))
+        self._respond(BSL_REP_FLASH_DATA, data, ready=ready)
+
+
+def parse_sim_spec(spec: str) -> dict:
+    """
+    Parse "key=value,..." into SimulatedDevice keyword arguments, e.g.
+    "latency_ms=0.5,bandwidth_mbps=40,flash_mbps=20,erase_ms=50,devices=4";
+    boot_ms=X is how long an FDL takes to start.
+    Sizes are in MB/s (10^6 bytes), times in milliseconds; corrupt=0.01
+    corrupts 1% of the received data chunks, disconnect_after=N (bytes)
+    unplugs the device part way through, stall_after=N (bytes) makes it stop
+    answering there for stall_ms=X (for good without it) and unsparse=1
+    expands sparse images.
+    fdl_chunk_max=N (bytes) and fdl_split=1 make the ROM/FDL1 stages pickier
+    about FDL chunks, fdl_ack_ms=X slower to ACK them.  buses=N spreads the
+    boards over N USB buses, round robin, and bus_mbps=X makes the boards on
+    one bus share X MB/s, losing bus_switch_ms=X whenever transfers of two of
+    them interleave.
+    serial=SN gives the boards a USB serial number (SN-<path> with several).
+    """
+    kwargs = {}
+    if not spec:
+        return kwargs
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key == "latency_ms":
+            kwargs["latency"] = float(value) / 1000.0
+        elif key == "bandwidth_mbps":
+            kwargs["bandwidth"] = float(value) * 1e6
+        elif key == "flash_mbps":
+            kwargs["flash_rate"] = float(value) * 1e6
+        elif key == "erase_ms":
+            kwargs["erase_time"] = float(value) / 1000.0
+        elif key == "boot_ms":
+            kwargs["boot_time"] = float(value) / 1000.0
+        elif key == "rx_buffers":
+            kwargs["rx_buffers"] = int(value)
+        elif key == "devices":
+            kwargs["devices"] = int(value)
+        elif key == "buses":
+            kwargs["buses"] = max(1, int(value))
+        elif key == "bus_mbps":
+            kwargs["bus_bandwidth"] = float(value) * 1e6
+        elif key == "bus_switch_ms":
+            kwargs["bus_switch"] = float(value) / 1000
+        elif key == "backing":
+            kwargs["backing_path"] = value
+        elif key == "serial":
+            kwargs["serial_number"] = value
+        elif key == "corrupt":
+            kwargs["corrupt_rate"] = float(value)
+        elif key == "disconnect_after":
+            kwargs["disconnect_after"] = int(float(value))
+        elif key == "stall_after":
+            kwargs["stall_after"] = int(float(value))
+        elif key == "stall_ms":
+            kwargs["stall_time"] = float(value) / 1000
+        elif key == "unsparse":
+            kwargs["unsparse"] = value not in ("0", "false", "no")
+        elif key == "fdl_chunk_max":
+            kwargs["fdl_chunk_max"] = int(float(value))
+        elif key == "fdl_split":
+            kwargs["fdl_split"] = value not in ("0", "false", "no")
+        elif key == "fdl_ack_ms":
+            kwargs["fdl_ack_time"] = float(value) / 1000
+        elif key == "secureboot":
+            kwargs["secureboot"] = value not in ("0", "false", "no")
+        else:
+            raise ValueError(f"Unknown simulator option '{key}'")
+    return kwargs
+
+
+def sim_device_paths(spec: dict) -> list:
+    """Bus-port style names of the simulated boards described by spec."""
+    return [f"sim-{i + 1}" for i in range(spec.get("devices", 1))]
+
+
+def sim_bus_number(spec: dict, path: str) -> int:
+    """USB bus of the simulated board named path (see sim_device_paths)."""
+    index = int(path.rpartition("-")[2]) if path.startswith("sim-") else 1
+    return (index - 1) % spec.get("buses", 1) + 1
+
+
+def sim_device_topologies(spec: dict) -> list:
+    """SimulatedDevice.topology of every board described by spec."""
+    return [make_sim_device(spec, path).topology for path in sim_device_paths(spec)]
+
+
+def make_sim_device(spec: dict, path=None, logger=None):
+    """Create one SimulatedDevice from a parsed spec (see parse_sim_spec)."""
+    kwargs = {
+        k: v
+        for k, v in spec.items()
+        if k not in ("devices", "buses", "bus_bandwidth", "bus_switch")
+    }
+    path = path or "sim-1"
+    kwargs["bus"] = sim_bus_number(spec, path)
+    rate = spec.get("bus_bandwidth")
+    if rate:
+        key = (kwargs["bus"], rate, spec.get("bus_switch", 0.0))
+        link = _sim_buses.get(key)
+        if link is None:
+            link = _sim_buses[key] = SimBus(rate, key[2])
+        kwargs["bus_link"] = link
+    if kwargs.get("backing_path") and spec.get("devices", 1) > 1:
+        kwargs["backing_path"] = f"{kwargs['backing_path']}.{path}"
+    if kwargs.get("serial_number") and spec.get("devices", 1) > 1:
+        kwargs["serial_number"] = f"{kwargs['serial_number']}-{path}"
+    return SimulatedDevice(path=path, logger=logger, **kwargs)
+
+
+def verify_flash(device: SimulatedDevice, images: list, image_sources: dict, logger):
+    """
+    Compare each selected image of the <ImgList> with what the device holds.
+    Returns the list of image ids that do not match.
+    """
+    mismatched = []
+    for img in images:
+        if not img["select"] or img["type"].upper() == "ERASEFLASH":
+            continue
+        src = image_sources.get(img["file"]) if img["file"] else None
+        if src is None:
+            continue
+        part_id = img["block_id"] if img["block_id"] else img["id"]
+        if part_id not in device.partitions:
+            mismatched.append(img["id"])
+            continue
+        pos = 0
+        ok = True
+        with src.open() as f:
+            if device.unsparse and src.sparse:
+                ok, pos = _verify_sparse(device, part_id, f)
+            else:
+                while True:
+                    expected = f.read(1 << 20)
+                    if not expected:
+                        break
+                    if device.read_partition(part_id, pos, len(expected)) != expected:
+                        ok = False
+                        break
+                    pos += len(expected)
+        if ok:
+            logger.info(f"Verified '{img['id']}' ({src.size} bytes).")
+        else:
+            logger.error(f"'{img['id']}' differs from the image at offset {pos}.")
+            mismatched.append(img["id"])
+    return mismatched
+
+
+def _verify_sparse(device: SimulatedDevice, part_id: str, fileobj):
+    """Compare the RAW and FILL extents of a sparse image; (ok, offset)."""
+    mismatch = []
+
+    def compare(offset, data):
+        if not mismatch and device.read_partition(part_id, offset, len(data)) != data:
+            mismatch.append(offset)
+
+    expand(SparseReader(fileobj), compare)
+    if mismatch:
+        return False, mismatch[0]
+    return True, 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Flash an AXP into the simulated device and verify it.",
+    )
+    parser.add_argument("--axp", required=True, help="Path to the AXP package (.axp).")
+    parser.add_argument(
+        "--sim",
+        default="",
+        help="Simulator options, e.g. latency_ms=0.5,bandwidth_mbps=40,flash_mbps=20",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_DATA_WINDOW,
+        help="MIDST_DATA chunks kept in flight while burning images.",
+    )
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(
+        level=log_level, format="%(asctime)s [%(levelname)s] %(message)s"
+    )
+    logger = logging.getLogger("axdl_sim")
+
+    try:
+        plan = FlashPlan.load(args.axp, logger)
+    except AXPError as e:
+        parser.error(str(e))
+
+    device = make_sim_device(parse_sim_spec(args.sim), logger=logger)
+    session = FlashSession(
+        plan, device, AXDLTool(data_window=args.window), logger=logger
+    )
+    with session:
+        start = time.monotonic()
+        try:
+            session.run()
+        except FlashError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        elapsed = time.monotonic() - start
+        logger.info(f"Flash finished in {elapsed:.2f}s, verifying...")
+        ok = not verify_flash(device, plan.cfg["imglist"], plan.image_sources, logger)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
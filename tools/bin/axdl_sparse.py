@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: axdl_sparse.py
+Description: Android sparse image reader and transfer planner for axdl_tool.py.
+
+rootfs_sparse.ext4 is written by make_ext4fs in the Android sparse format: a
+file header followed by RAW, FILL, DONT_CARE and CRC32 chunks.  SparseReader
+walks such an image front to back (it never needs to seek, so compressed AXP
+members work too), iter_transfers() cuts it into MIDST_DATA transfers that
+only split at chunk boundaries or block-aligned offsets inside RAW data, and
+scan_sparse() validates an image and reports its real and expanded size.
+expand() writes out the blocks an image describes; the device simulator
+uses it to model an FDL that unpacks sparse images, and the read-back
+verification of axdl_tool.py to know what a partition should contain.
+
+# SPDX-FileCopyrightText: 2024 M5Stack Technology CO LTD
+#
+# SPDX-License-Identifier: MIT
+
+use: python3 axdl_sparse.py rootfs_sparse.ext4
+     python3 axdl_sparse.py --axp ./M5_LLM_ubuntu22.04_20250210.axp
+
+"""
+import argparse
+import collections
+import io
+import json
+import struct
+import sys
+import zlib
+
+SPARSE_MAGIC = 0xED26FF3A
+# magic, major, minor, file_hdr_sz, chunk_hdr_sz, blk_sz, total_blks,
+# total_chunks, image_checksum
+SPARSE_HEADER = struct.Struct("<IHHHHIIII")
+# chunk_type, reserved, chunk_sz (blocks), total_sz (bytes, header included)
+CHUNK_HEADER = struct.Struct("<HHII")
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+CHUNK_TYPE_NAMES = {
+    CHUNK_TYPE_RAW: "raw",
+    CHUNK_TYPE_FILL: "fill",
+    CHUNK_TYPE_DONT_CARE: "dont_care",
+    CHUNK_TYPE_CRC32: "crc32",
+}
+
+# Rough transfer model used when no measured figures are given: USB 2.0 bulk
+# throughput, round-trip time of one packet exchange, eMMC write speed.
+DEFAULT_LINK_RATE = 35e6
+DEFAULT_LATENCY = 0.0005
+DEFAULT_FLASH_RATE = 20e6
+
+# Largest piece read or expanded at a time
+IO_PIECE = 1 << 20
+
+SparseHeader = collections.namedtuple(
+    "SparseHeader",
+    "major minor file_header_size chunk_header_size block_size total_blocks "
+    "total_chunks image_checksum",
+)
+# offset: file offset of the chunk header; out_offset: byte offset in the
+# expanded image
+SparseChunk = collections.namedtuple(
+    "SparseChunk", "type blocks data_size offset out_offset"
+)
+
+
+class SparseFormatError(ValueError):
+    """The data is not a well-formed Android sparse image."""
+
+
+def is_sparse(head: bytes) -> bool:
+    """True when head (the first bytes of an image) starts a sparse image."""
+    return len(head) >= 4 and struct.unpack_from("<I", head)[0] == SPARSE_MAGIC
+
+
+class SparseReader:
+    """
+    Sequential reader of a sparse image.
+
+    chunks() yields one SparseChunk per chunk; its data can then be read with
+    read_data().  Whatever is left unread is skipped when the next chunk is
+    requested, by seeking when the file allows it.  stats counts the chunks
+    of each type and the expanded bytes they describe, e.g. stats["raw"] and
+    stats["raw_bytes"].
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pos = 0  # offset in the sparse file
+        raw = self._read_exact(SPARSE_HEADER.size, "file header")
+        fields = SPARSE_HEADER.unpack(raw)
+        if fields[0] != SPARSE_MAGIC:
+            raise SparseFormatError("Not an Android sparse image (bad magic).")
+        self.header = SparseHeader(*fields[1:])
+        h = self.header
+        if h.major != 1:
+            raise SparseFormatError(f"Unsupported sparse format version {h.major}.")
+        if h.file_header_size < SPARSE_HEADER.size:
+            raise SparseFormatError(f"File header size {h.file_header_size} too small.")
+        if h.chunk_header_size < CHUNK_HEADER.size:
+            raise SparseFormatError(
+                f"Chunk header size {h.chunk_header_size} too small."
+            )
+        if h.block_size == 0 or h.block_size % 4:
+            raise SparseFormatError(f"Bad block size {h.block_size}.")
+        extra = h.file_header_size - SPARSE_HEADER.size
+        self.header_bytes = raw + self._read_exact(extra, "file header")
+        # Raw header of the current chunk and its data still unread
+        self.chunk_header = b""
+        self._remaining = 0
+        # End of a seekable file, so skipped data can be checked to be there
+        self._end = None
+        if getattr(fileobj, "seekable", lambda: False)():
+            here = fileobj.tell()
+            self._end = fileobj.seek(0, io.SEEK_END)
+            fileobj.seek(here)
+        self.stats = collections.Counter()
+
+    @property
+    def expanded_size(self) -> int:
+        return self.header.total_blocks * self.header.block_size
+
+    def chunks(self):
+        """Yield the chunks in file order, validating each chunk header."""
+        h = self.header
+        out_offset = 0
+        for index in range(h.total_chunks):
+            self.skip_data()
+            offset = self.pos
+            raw = self._read_exact(h.chunk_header_size, f"chunk {index} header")
+            ctype, _, blocks, total = CHUNK_HEADER.unpack_from(raw)
+            data_size = total - h.chunk_header_size
+            expected = {
+                CHUNK_TYPE_RAW: blocks * h.block_size,
+                CHUNK_TYPE_FILL: 4,
+                CHUNK_TYPE_DONT_CARE: 0,
+                CHUNK_TYPE_CRC32: 4,
+            }.get(ctype)
+            if expected is None:
+                raise SparseFormatError(
+                    f"Chunk {index} at offset {offset}: unknown type 0x{ctype:04X}."
+                )
+            if data_size != expected:
+                raise SparseFormatError(
+                    f"Chunk {index} at offset {offset}: {CHUNK_TYPE_NAMES[ctype]} "
+                    f"chunk of {blocks} blocks has {data_size} data bytes, "
+                    f"expected {expected}."
+                )
+            chunk = SparseChunk(ctype, blocks, data_size, offset, out_offset)
+            name = CHUNK_TYPE_NAMES[ctype]
+            self.stats[name] += 1
+            self.stats[f"{name}_bytes"] += blocks * h.block_size
+            self.chunk_header = raw
+            self._remaining = data_size
+            yield chunk
+            out_offset += blocks * h.block_size
+            if out_offset > self.expanded_size:
+                raise SparseFormatError(
+                    f"Chunks describe more than the {h.total_blocks} blocks "
+                    "of the header."
+                )
+        self.skip_data()
+        if out_offset != self.expanded_size:
+            raise SparseFormatError(
+                f"Chunks describe {out_offset // h.block_size} blocks, "
+                f"the header {h.total_blocks}."
+            )
+
+    def read_data(self, size=-1) -> bytes:
+        """Read up to size bytes (default: all) of the current chunk's data."""
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._read_exact(size, "chunk data")
+        self._remaining -= size
+        return data
+
+    def skip_data(self):
+        """Skip the rest of the current chunk's data."""
+        remaining, self._remaining = self._remaining, 0
+        if not remaining:
+            return
+        if self._end is None:
+            while remaining:
+                size = min(remaining, IO_PIECE)
+                self._read_exact(size, "chunk data")
+                remaining -= size
+            return
+        here = self.fileobj.tell()
+        if here + remaining > self._end:
+            raise SparseFormatError(
+                f"Image truncated in chunk data at offset {self.pos + self._end - here}."
+            )
+        self.fileobj.seek(here + remaining)
+        self.pos += remaining
+
+    def _read_exact(self, size: int, what: str) -> bytes:
+        data = self.fileobj.read(size) if size else b""
+        while len(data) < size:
+            more = self.fileobj.read(size - len(data))
+            if not more:
+                raise SparseFormatError(
+                    f"Image truncated in {what} at offset {self.pos + len(data)}."
+                )
+            data += more
+        self.pos += size
+        return data
+
+
+def iter_transfers(reader: SparseReader, max_size: int, data=True):
+    """
+    Cut a sparse image into transfers of at most max_size bytes, in order.
+
+    A transfer starts at a chunk header, except the continuation pieces of a
+    RAW chunk too large for one transfer, which start at a block boundary of
+    its data.  Small chunks (FILL, DONT_CARE, CRC32 and RAW chunks that fit)
+    are packed together; the file header travels with the first chunk.
+    Bytes after the last chunk are passed through unchanged.
+
+    Yields the transfers as bytes, or only their lengths with data=False.
+    """
+    block_size = reader.header.block_size
+    parts = [reader.header_bytes]
+    length = len(reader.header_bytes)
+    holds_chunk = False
+
+    def take():
+        nonlocal parts, length, holds_chunk
+        out = b"".join(parts) if data else length
+        parts, length, holds_chunk = [], 0, False
+        return out
+
+    for chunk in reader.chunks():
+        header = reader.chunk_header
+        need = len(header) + chunk.data_size
+        if holds_chunk and length + need > max_size:
+            yield take()
+        if length + need <= max_size or chunk.type != CHUNK_TYPE_RAW:
+            parts.append(header)
+            if data:
+                parts.append(reader.read_data())
+            length += need
+            holds_chunk = True
+            continue
+        # A RAW chunk spanning several transfers
+        parts.append(header)
+        length += len(header)
+        remaining = chunk.data_size
+        while remaining:
+            space = max_size - length
+            size = min(remaining, space - space % block_size)
+            if size <= 0:
+                yield take()
+                continue
+            if data:
+                parts.append(reader.read_data(size))
+            length += size
+            remaining -= size
+            holds_chunk = True
+            if remaining:
+                yield take()
+    if length:
+        yield take()
+    while True:
+        rest = reader.fileobj.read(max_size)
+        if not rest:
+            break
+        yield rest if data else len(rest)
+
+
+def expand(reader: SparseReader, write, verify_crc=True) -> int:
+    """
+    Call write(offset, data) for the RAW and FILL extents of the expanded
+    image, in order and in pieces of at most IO_PIECE bytes; DONT_CARE
+    extents are not written.  CRC32 chunks are checked against the CRC-32 of
+    the expanded image so far (DONT_CARE counting as zeros) unless
+    verify_crc is False.  Returns the expanded size.
+    """
+    for offset, piece in iter_expanded(reader, verify_crc):
+        write(offset, piece)
+    return reader.expanded_size
+
+
+def iter_expanded(reader: SparseReader, verify_crc=True):
+    """Generator form of expand(): yields the (offset, data) pieces."""
+    crc = 0
+    for chunk in reader.chunks():
+        out_size = chunk.blocks * reader.header.block_size
+        if chunk.type == CHUNK_TYPE_RAW:
+            done = 0
+            while done < out_size:
+                piece = reader.read_data(IO_PIECE)
+                yield chunk.out_offset + done, piece
+                if verify_crc:
+                    crc = zlib.crc32(piece, crc)
+                done += len(piece)
+        elif chunk.type == CHUNK_TYPE_FILL:
+            pattern = reader.read_data(4) * (IO_PIECE // 4)
+            for done in range(0, out_size, IO_PIECE):
+                piece = pattern[: min(IO_PIECE, out_size - done)]
+                yield chunk.out_offset + done, piece
+                if verify_crc:
+                    crc = zlib.crc32(piece, crc)
+        elif chunk.type == CHUNK_TYPE_DONT_CARE:
+            if verify_crc:
+                crc = _crc32_zeros(crc, out_size)
+        elif chunk.type == CHUNK_TYPE_CRC32:
+            (expected,) = struct.unpack("<I", reader.read_data(4))
+            if verify_crc and expected != crc:
+                raise SparseFormatError(
+                    f"CRC32 chunk at offset {chunk.offset}: 0x{expected:08X} "
+                    f"recorded, 0x{crc:08X} computed."
+                )
+
+
+def data_extents(reader: SparseReader) -> list:
+    """
+    Return the (offset, length) extents of the expanded image that RAW and
+    FILL chunks write, adjacent ones merged.  Only the chunk headers are
+    read when the file can seek.
+    """
+    extents = []
+    for chunk in reader.chunks():
+        if chunk.type not in (CHUNK_TYPE_RAW, CHUNK_TYPE_FILL):
+            continue
+        length = chunk.blocks * reader.header.block_size
+        if extents and sum(extents[-1]) == chunk.out_offset:
+            extents[-1] = (extents[-1][0], extents[-1][1] + length)
+        elif length:
+            extents.append((chunk.out_offset, length))
+    return extents
+
+
+def _crc32_zeros(crc: int, size: int) -> int:
+    zeros = bytes(min(size, IO_PIECE))
+    while size:
+        n = min(size, len(zeros))
+        crc = zlib.crc32(zeros[:n], crc)
+        size -= n
+    return crc
+
+
+def scan_sparse(fileobj, max_transfer: int) -> dict:
+    """
+    Validate the structure of a sparse image and describe it:
+    {"block_size", "total_blocks", "chunks": {type: count}, "file_size",
+    "expanded_size", "raw_bytes", "fill_bytes", "dont_care_bytes",
+    "transfers"}, where "transfers" is the number of MIDST_DATA chunks of at
+    most max_transfer bytes iter_transfers() sends it in.  Only the headers
+    are read when fileobj can seek.  Raises SparseFormatError.
+    """
+    reader = SparseReader(fileobj)
+    lengths = list(iter_transfers(reader, max_transfer, data=False))
+    file_size = reader.pos
+    if sum(lengths) != file_size:
+        raise SparseFormatError(f"Trailing data after the last chunk at {file_size}.")
+    return {
+        "block_size": reader.header.block_size,
+        "total_blocks": reader.header.total_blocks,
+        "chunks": {name: reader.stats[name] for name in CHUNK_TYPE_NAMES.values()},
+        "file_size": file_size,
+        "expanded_size": reader.expanded_size,
+        "raw_bytes": reader.stats["raw_bytes"],
+        "fill_bytes": reader.stats["fill_bytes"],
+        "dont_care_bytes": reader.stats["dont_care_bytes"],
+        "transfers": len(lengths),
+    }
+
+
+def verify_sparse_crc(fileobj) -> int:
+    """
+    Check the CRC32 chunks of a sparse image against its expanded content;
+    returns how many were checked.  Raises SparseFormatError.
+    """
+    reader = SparseReader(fileobj)
+    expand(reader, lambda offset, data: None)
+    return reader.stats["crc32"]
+
+
+def estimate_transfer_time(
+    info: dict,
+    link_rate=DEFAULT_LINK_RATE,
+    latency=DEFAULT_LATENCY,
+    flash_rate=DEFAULT_FLASH_RATE,
+) -> float:
+    """
+    Seconds to send a scanned image: the larger of the link time (bytes on the
+    wire plus two round-trips per transfer) and the flash time (RAW and FILL
+    bytes; DONT_CARE blocks are never written).
+    """
+    link = info["file_size"] / link_rate + 2 * info["transfers"] * latency
+    flash = (info["raw_bytes"] + info["fill_bytes"]) / flash_rate
+    return max(link, flash)
+
+
+def make_sparse(data: bytes, block_size=4096, crc=False) -> bytes:
+    """
+    Convert a raw image (a multiple of block_size long) to the sparse format
+    as img2simg does: all-zero blocks become DONT_CARE, blocks repeating one
+    32-bit word FILL and the rest RAW; with crc a CRC32 chunk ends the image.
+    """
+    if len(data) % block_size:
+        raise ValueError(f"Image size is not a multiple of {block_size}.")
+    runs = []  # [type, first block, blocks, fill pattern]
+    view = memoryview(data)
+    zero = bytes(block_size)
+    for index in range(len(data) // block_size):
+        block = view[index * block_size : (index + 1) * block_size]
+        if block == zero:
+            kind, pattern = CHUNK_TYPE_DONT_CARE, None
+        elif block == bytes(block[:4]) * (block_size // 4):
+            kind, pattern = CHUNK_TYPE_FILL, bytes(block[:4])
+        else:
+            kind, pattern = CHUNK_TYPE_RAW, None
+        if runs and runs[-1][0] == kind and runs[-1][3] == pattern:
+            runs[-1][2] += 1
+        else:
+            runs.append([kind, index, 1, pattern])
+
+    body = []
+    for kind, first, blocks, pattern in runs:
+        if kind == CHUNK_TYPE_RAW:
+            payload = bytes(view[first * block_size : (first + blocks) * block_size])
+        elif kind == CHUNK_TYPE_FILL:
+            payload = pattern
+        else:
+            payload = b""
+        body.append(
+            CHUNK_HEADER.pack(kind, 0, blocks, CHUNK_HEADER.size + len(payload))
+        )
+        body.append(payload)
+    if crc:
+        checksum = struct.pack("<I", zlib.crc32(data))
+        body.append(CHUNK_HEADER.pack(CHUNK_TYPE_CRC32, 0, 0, CHUNK_HEADER.size + 4))
+        body.append(checksum)
+    header = SPARSE_HEADER.pack(
+        SPARSE_MAGIC,
+        1,
+        0,
+        SPARSE_HEADER.size,
+        CHUNK_HEADER.size,
+        block_size,
+        len(data) // block_size,
+        len(runs) + (1 if crc else 0),
+        0,
+    )
+    return header + b"".join(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check Android sparse images and estimate their transfer time."
+    )
+    parser.add_argument("images", nargs="*", help="Sparse image files.")
+    parser.add_argument("--axp", help="Check the sparse images inside an AXP package.")
+    parser.add_argument(
+        "--chunk-size",
+        type=lambda x: int(x, 0),
+        default=0xB000,
+        help="Largest MIDST_DATA transfer (default 0xB000, as axdl_tool.py).",
+    )
+    parser.add_argument(
+        "--link-mbps",
+        type=float,
+        default=DEFAULT_LINK_RATE / 1e6,
+        help=f"USB throughput in MB/s (default {DEFAULT_LINK_RATE / 1e6:g}).",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=DEFAULT_LATENCY * 1000,
+        help=f"Round-trip time in ms (default {DEFAULT_LATENCY * 1000:g}).",
+    )
+    parser.add_argument(
+        "--flash-mbps",
+        type=float,
+        default=DEFAULT_FLASH_RATE / 1e6,
+        help=f"Flash write speed in MB/s (default {DEFAULT_FLASH_RATE / 1e6:g}).",
+    )
+    parser.add_argument(
+        "--crc",
+        action="store_true",
+        help="Also read all data to check the CRC32 chunks.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print JSON.")
+    args = parser.parse_args()
+    if not args.images and not args.axp:
+        parser.error("give sparse image files or --axp")
+
+    sources = [(path, lambda path=path: open(path, "rb")) for path in args.images]
+    if args.axp:
+        import logging
+        from axdl_tool import AXDLTool
+
+        logger = logging.getLogger("axdl_sparse")
+        _, image_sources = AXDLTool().open_axp(args.axp, logger)
+        for name, src in sorted(image_sources.items()):
+            with src.open() as f:
+                if is_sparse(f.read(4)):
+                    sources.append((name, src.open))
+
+    failed = False
+    results = {}
+    for name, open_image in sources:
+        try:
+            with open_image() as f:
+                info = scan_sparse(f, args.chunk_size)
+            if args.crc:
+                with open_image() as f:
+                    info["crc_checked"] = verify_sparse_crc(f)
+        except (OSError, SparseFormatError) as e:
+            print(f"{name}: {e}", file=sys.stderr)
+            failed = True
+            continue
+        info["estimate_s"] = estimate_transfer_time(
+            info, args.link_mbps * 1e6, args.latency_ms / 1000.0, args.flash_mbps * 1e6
+        )
+        results[name] = info
+        if args.json:
+            continue
+        chunks = ", ".join(f"{n} {t}" for t, n in info["chunks"].items() if n)
+        print(f"{name}:")
+        print(
+            f"  {info['file_size']} bytes sparse, {info['expanded_size']} bytes "
+            f"expanded ({info['file_size'] / max(1, info['expanded_size']):.1%}), "
+            f"{info['block_size']}-byte blocks"
+        )
+        print(
+            f"  chunks: {chunks}; {info['raw_bytes']} raw, {info['fill_bytes']} fill, "
+            f"{info['dont_care_bytes']} don't care bytes"
+        )
+        print(
+            f"  {info['transfers']} transfers of <= {args.chunk_size} bytes, "
+            f"estimated {info['estimate_s']:.1f}s"
+        )
+        if args.crc:
+            print(f"  {info['crc_checked']} CRC32 chunk(s) verified")
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if not sources:
+        print("No sparse image found.", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: axdl_station.py
+Description: long-running flashing station built on axdl_tool.py.
+
+The AXPs are opened, parsed and their FDL blobs loaded once at start-up.  The
+station then watches for boards entering download mode (udev netlink events
+through pyudev when it is installed, polling of the USB bus otherwise) and
+flashes every new board in its own worker as soon as it shows up.  A board
+that is still being flashed, or that was flashed OK and never unplugged, is
+not flashed again when it re-enumerates on the same port; a board that failed
+is flashed again as soon as it shows up again.
+
+# SPDX-FileCopyrightText: 2024 M5Stack Technology CO LTD
+#
+# SPDX-License-Identifier: MIT
+
+use: sudo python3 axdl_station.py --axp ./M5_LLM_ubuntu22.04_20250210.axp
+
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+
+from axdl_tool import (
+    AXDLTool,
+    AXPError,
+    BACKOFF_FIRST,
+    BACKOFF_LONGEST,
+    Backoff,
+    BusScheduler,
+    CommandTimeouts,
+    DEFAULT_DATA_WINDOW,
+    FdlProfile,
+    FlashPlan,
+    FlashStatus,
+    PlanCache,
+    ThroughputProfile,
+    TracePort,
+    cache_dir,
+    check_image_sizes,
+    device_report,
+    find_devices,
+    flash_one_device,
+    record_throughput,
+    record_timeouts,
+    USBSerialPort,
+    write_prometheus,
+)
+
+try:
+    import pyudev
+except ImportError:  # optional, the bus is polled without it
+    pyudev = None
+
+DeviceEvent = collections.namedtuple("DeviceEvent", "action path")
+
+
+class PollingWatcher:
+    """
+    Report boards appearing in and disappearing from list_devices() as
+    DeviceEvents, by comparing the list every interval seconds.
+    """
+
+    def __init__(self, list_devices, interval=0.25):
+        self.list_devices = list_devices
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, events: queue.Queue):
+        self._thread = threading.Thread(
+            target=self._run, args=(events,), name="axdl-watch", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, events):
+        present = set()
+        while not self._stop.is_set():
+            current = set(self.list_devices())
+            for path in sorted(current - present):
+                events.put(DeviceEvent("add", path))
+            for path in sorted(present - current):
+                events.put(DeviceEvent("remove", path))
+            present = current
+            self._stop.wait(self.interval)
+
+
+class UdevWatcher:
+    """
+    Report add/remove uevents of USB devices with the given VID/PID as
+    DeviceEvents.  Boards already in download mode are reported first.
+
+    The uevent's sysfs name ("1-2.3") is the same bus-port path that
+    axdl_tool.usb_device_path() gives, so it can be passed to USBSerialPort.
+    """
+
+    def __init__(self, vid, pid, list_devices):
+        if pyudev is None:
+            raise RuntimeError("pyudev is not installed")
+        self.product = f"{vid:x}/{pid:x}/"
+        self.list_devices = list_devices
+        self.monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        self.monitor.filter_by(subsystem="usb", device_type="usb_device")
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, events: queue.Queue):
+        # Start listening before listing, so no arrival falls in between.
+        self.monitor.start()
+        for path in self.list_devices():
+            events.put(DeviceEvent("add", path))
+        self._thread = threading.Thread(
+            target=self._run, args=(events,), name="axdl-udev", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, events):
+        while not self._stop.is_set():
+            device = self.monitor.poll(timeout=0.5)
+            if device is None:
+                continue
+            # PRODUCT is "vid/pid/bcdDevice" in lower-case hex without zeros,
+            # and unlike the sysfs attributes it is still set on "remove".
+            if not device.get("PRODUCT", "").startswith(self.product):
+                continue
+            if device.action in ("add", "remove"):
+                events.put(DeviceEvent(device.action, device.sys_name))
+
+
+class FlashStation:
+    """
+    Start a flashing worker for every board that arrives, at most max_boards
+    at a time.  An arrival is acted on once the port has been present for
+    settle seconds, which absorbs a board bouncing on its connector.
+
+    A port with a worker running, or whose board was flashed OK and has not
+    been unplugged since, ignores further arrivals: a board re-enumerating on
+    the same port is flashed once.  A board that failed is retried on its
+    next arrival (reset back into download mode, or replugged).
+    """
+
+    def __init__(
+        self,
+        logger,
+        plans: list,
+        make_port,
+        make_tool,
+        routes=(),
+        reset=False,
+        max_boards=8,
+        settle=0.5,
+        on_finished=None,
+    ):
+        """
+        :param plans: FlashPlans; the first one is used for every port that
+            no route matches
+        :param make_port: make_port(path, logger) creates a board's transport
+        :param make_tool: make_tool(plan) creates a configured AXDLTool
+        :param routes: (bus-port prefix, FlashPlan) pairs; the longest
+            matching prefix picks the plan of a board
+        :param on_finished: Called as on_finished(status, plan) after a board
+        """
+        self.logger = logger
+        self.plans = plans
+        self.routes = sorted(routes, key=lambda r: len(r[0]), reverse=True)
+        self.make_port = make_port
+        self.make_tool = make_tool
+        self.reset = reset
+        self.settle = settle
+        self.on_finished = on_finished
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_boards)
+        self.pending = {}  # path -> time the board is considered settled
+        self.active = {}  # path -> (future, status, plan)
+        self.flashed = set()  # flashed OK and still plugged in
+        self.unplugged = set()  # removed while its worker runs
+        self.finished = 0
+        self.failed = 0
+
+    def plan_for(self, path: str):
+        for prefix, plan in self.routes:
+            if path.startswith(prefix):
+                return plan
+        return self.plans[0]
+
+    def handle(self, event: DeviceEvent):
+        path = event.path
+        if event.action == "remove":
+            if self.pending.pop(path, None) is not None:
+                self.logger.info(f"[{path}] unplugged before flashing started.")
+            elif path in self.flashed:
+                self.flashed.discard(path)
+                self.logger.info(f"[{path}] board removed; port is free.")
+            elif path in self.active:
+                self.unplugged.add(path)
+            return
+        if path in self.active:
+            self.unplugged.discard(path)
+        if path in self.active or path in self.flashed or path in self.pending:
+            self.logger.debug(f"[{path}] re-enumerated on the same port; ignored.")
+            return
+        self.logger.info(f"[{path}] board arrived.")
+        self.pending[path] = time.monotonic() + self.settle
+
+    def poll(self):
+        """Start settled boards and collect finished workers."""
+        now = time.monotonic()
+        for path, ready in list(self.pending.items()):
+            if ready <= now:
+                del self.pending[path]
+                self._start(path)
+        for path, (future, status, plan) in list(self.active.items()):
+            if not future.done():
+                continue
+            del self.active[path]
+            if path in self.unplugged:
+                self.unplugged.discard(path)
+            elif status.ok:
+                self.flashed.add(path)
+            self.finished += 1
+            if not status.ok:
+                self.failed += 1
+            result = "OK" if status.ok else f"FAILED during {status.phase}"
+            self.logger.info(
+                f"[{path}] {result} in {status.elapsed:.1f}s ({plan.name}); "
+                f"{self.finished - self.failed}/{self.finished} boards OK."
+            )
+            if not status.ok:
+                self.logger.info(
+                    f"[{path}] will be flashed again when it re-enters download mode."
+                )
+            if self.on_finished is not None:
+                self.on_finished(status, plan)
+
+    def _start(self, path: str):
+        plan = self.plan_for(path)
+        status = FlashStatus(path)
+        status.axp = plan.axp_path
+        self.logger.info(f"[{path}] flashing {plan.name}.")
+        future = self.pool.submit(
+            flash_one_device,
+            self.logger,
+            status,
+            plan.flash_args,
+            self.make_port,
+            lambda: self.make_tool(plan),
+            reset=self.reset,
+        )
+        self.active[path] = (future, status, plan)
+
+    def run(self, watcher, stop: threading.Event, count=None):
+        """
+        Flash boards reported by watcher until stop is set or count boards
+        have finished; then wait for the running workers.
+        """
+        events = queue.Queue()
+        watcher.start(events)
+        try:
+            while not stop.is_set() and (count is None or self.finished < count):
+                try:
+                    self.handle(events.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+                self.poll()
+        finally:
+            watcher.stop()
+            self.pending.clear()
+            self.pool.shutdown(wait=True)
+            self.poll()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Flash every Axera board plugged into this station."
+    )
+    parser.add_argument(
+        "--axp",
+        action="append",
+        required=True,
+        help="AXP package to flash; repeat to load several (the first is the "
+        "default, see --route).",
+    )
+    parser.add_argument(
+        "--route",
+        action="append",
+        default=[],
+        metavar="PORT=AXP",
+        help="Flash boards whose bus-port path starts with PORT with the AXP "
+        "named AXP (file name without .axp), e.g. --route 1-2=M5_LLM_ubuntu.",
+    )
+    parser.add_argument("--reset", action="store_true", help="Reset after finish.")
+    parser.add_argument(
+        "--vid",
+        type=lambda x: int(x, 16),
+        default=0x32C9,
+        help="USB Vendor ID in hex (e.g. 0x32c9).",
+    )
+    parser.add_argument(
+        "--pid",
+        type=lambda x: int(x, 16),
+        default=0x1000,
+        help="USB Product ID in hex (e.g. 0x1000).",
+    )
+    parser.add_argument(
+        "--poll-backoff",
+        type=Backoff.parse,
+        default=Backoff(),
+        metavar="FIRST_MS[,MAX_MS]",
+        help="Delays between looks for a board that is not there yet and "
+        "between handshake resends, doubling from FIRST_MS up to MAX_MS "
+        f"(default {BACKOFF_FIRST * 1000:g},{BACKOFF_LONGEST * 1000:g}).",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_DATA_WINDOW,
+        help=f"MIDST_DATA chunks kept in flight (default {DEFAULT_DATA_WINDOW}).",
+    )
+    parser.add_argument(
+        "--chunk-checksum",
+        action="store_true",
+        help="Send every MIDST_DATA chunk with its checksum for the FDL to verify.",
+    )
+    parser.add_argument(
+        "--chunk-retries",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Re-send a failed chunk up to N times (default 0).",
+    )
+    parser.add_argument(
+        "--on-stall",
+        choices=("fail", "wait"),
+        default="wait",
+        help="What a reply missing the timeout learnt for its command does: "
+        "'wait' waits for the fixed timeout (default), 'fail' fails the board "
+        "at once.",
+    )
+    parser.add_argument(
+        "--fixed-timeouts",
+        action="store_true",
+        help="Do not use the reply timeouts learnt from earlier sessions.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Read every written partition back and compare it with its image.",
+    )
+    parser.add_argument(
+        "--verify-sample",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Spot-check N random blocks of each image instead; implies --verify.",
+    )
+    parser.add_argument(
+        "--fdl-probe",
+        action="store_true",
+        help="Upload the FDLs in the largest chunks each board model takes "
+        "instead of 1000-byte lock-step chunks.",
+    )
+    parser.add_argument(
+        "--max-boards",
+        type=int,
+        default=8,
+        help="Boards flashed at the same time (default 8).",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=0.5,
+        metavar="SEC",
+        help="Wait until a board has been present for SEC seconds (default 0.5).",
+    )
+    parser.add_argument(
+        "--watch",
+        choices=("auto", "udev", "poll"),
+        default="auto",
+        help="How arrivals are detected: udev netlink events (needs pyudev), "
+        "polling the bus, or udev when available (default).",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=0.25,
+        metavar="SEC",
+        help="Bus polling interval of --watch poll (default 0.25).",
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        metavar="N",
+        help="Exit after N boards have been flashed.",
+    )
+    parser.add_argument(
+        "--sim",
+        nargs="?",
+        const="",
+        metavar="OPTIONS",
+        help="Serve the simulated boards of axdl_sim.py instead of USB.",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="JSONL",
+        help="Append the session report of every board to JSONL.",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="Keep the metrics of the last flash of every port in FILE "
+        "(Prometheus text format, for node_exporter's textfile collector).",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        metavar="DIR",
+        help="Record a session trace of every flash in DIR, as "
+        "<bus-port>-<time>.axtrace (see axdl_trace.py).",
+    )
+    parser.add_argument(
+        "--max-per-bus",
+        type=int,
+        metavar="N",
+        help="Let at most N boards behind one host controller transfer image "
+        "data at a time (implies --bus-schedule).",
+    )
+    parser.add_argument(
+        "--bus-schedule",
+        action="store_true",
+        help="Let boards behind one host controller transfer image data only "
+        "as many at a time as raise its measured throughput (default: every "
+        "board right away).",
+    )
+    parser.add_argument(
+        "--keep-erases",
+        action="store_true",
+        help="Send every ERASEFLASH entry, even for a partition the next image "
+        "rewrites in full.",
+    )
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+    logger = logging.getLogger("axdl_station")
+
+    plan_cache = PlanCache(os.path.join(cache_dir(), "plans.json"))
+    plans = []
+    for axp_path in args.axp:
+        try:
+            plan = FlashPlan.load(axp_path, logger, cache=plan_cache)
+            if not args.keep_erases:
+                plan, _ = plan.elide_erases()
+            ops = plan.operations()
+        except AXPError as e:
+            parser.error(str(e))
+        if not check_image_sizes(ops, logger):
+            parser.error(f"{axp_path}: an image does not fit its partition")
+        setup_time = sum(p["wall"] for p in plan.setup_phases)
+        logger.info(f"Loaded {plan.name} in {setup_time:.2f}s.")
+        plans.append(plan)
+    by_name = {plan.name: plan for plan in plans}
+    routes = []
+    for route in args.route:
+        prefix, _, name = route.partition("=")
+        if name not in by_name:
+            parser.error(f"--route {route}: no AXP named '{name}'")
+        routes.append((prefix, by_name[name]))
+
+    if args.sim is not None:
+        import axdl_sim
+
+        try:
+            sim_spec = axdl_sim.parse_sim_spec(args.sim)
+        except ValueError as e:
+            parser.error(f"--sim {args.sim}: {e}")
+
+        def make_port(path, port_logger):
+            return axdl_sim.make_sim_device(sim_spec, path, port_logger)
+
+        def list_devices():
+            return axdl_sim.sim_device_paths(sim_spec)
+
+    else:
+
+        def make_port(path, port_logger):
+            return USBSerialPort(
+                args.vid,
+                args.pid,
+                logger=port_logger,
+                path=path,
+                backoff=args.poll_backoff,
+            )
+
+        def list_devices():
+            return find_devices(args.vid, args.pid)
+
+    if args.trace_dir:
+        os.makedirs(args.trace_dir, exist_ok=True)
+        make_board_port = make_port
+
+        def make_port(path, port_logger):
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            trace_path = os.path.join(args.trace_dir, f"{path}-{stamp}.axtrace")
+            return TracePort(make_board_port(path, port_logger), trace_path)
+
+    checkpoint_dir = os.path.join(cache_dir(), "sessions")
+    fdl_profile = FdlProfile(os.path.join(cache_dir(), "fdl_profile.json"))
+    timeouts = CommandTimeouts(
+        os.path.join(cache_dir(), "timeouts.json"),
+        prefix="sim:" if args.sim is not None else "",
+    )
+    scheduler = None
+    if args.bus_schedule or args.max_per_bus:
+        scheduler = BusScheduler(args.max_per_bus, logger)
+
+    def make_tool(plan):
+        tool = AXDLTool(
+            data_window=args.window,
+            chunk_checksum=args.chunk_checksum,
+            chunk_retries=args.chunk_retries,
+        )
+        tool.progress_enabled = False
+        tool.checkpoint_dir = checkpoint_dir
+        tool.axp_id = plan.axp_id
+        tool.verify = args.verify or args.verify_sample > 0
+        tool.verify_samples = max(0, args.verify_sample)
+        tool.fdl_profile = fdl_profile
+        tool.fdl_probe = args.fdl_probe
+        tool.scheduler = scheduler
+        tool.command_timeouts = None if args.fixed_timeouts else timeouts
+        tool.on_stall = args.on_stall
+        tool.backoff = args.poll_backoff
+        return tool
+
+    last_status = {}
+    throughput = ThroughputProfile(os.path.join(cache_dir(), "throughput.json"))
+
+    def on_finished(status, plan):
+        record_throughput(throughput, [status], plan.cfg, sim=args.sim is not None)
+        record_timeouts(timeouts, [status])
+        if args.report:
+            entry = dict(device_report(status), axp=os.path.abspath(plan.axp_path))
+            entry["created"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            with open(args.report, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        if args.prometheus:
+            last_status[status.device] = status
+            # Every status carries the AXP its board was flashed with
+            write_prometheus(args.prometheus, plan.axp_path, list(last_status.values()))
+
+    use_udev = args.watch == "udev" or (
+        args.watch == "auto" and pyudev is not None and args.sim is None
+    )
+    if use_udev:
+        watcher = UdevWatcher(args.vid, args.pid, list_devices)
+    else:
+        watcher = PollingWatcher(list_devices, args.poll_interval)
+    logger.info(
+        f"Waiting for boards ({'udev' if use_udev else 'polling'}); "
+        "press Ctrl-C to stop."
+    )
+
+    stop = threading.Event()
+
+    def request_stop(*_):
+        logger.info("Stopping; waiting for the boards being flashed...")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    station = FlashStation(
+        logger,
+        plans,
+        make_port,
+        make_tool,
+        routes=routes,
+        reset=args.reset,
+        max_boards=args.max_boards,
+        settle=args.settle,
+        on_finished=on_finished,
+    )
+    station.run(watcher, stop, count=args.count)
+    logger.info(
+        f"{station.finished - station.failed}/{station.finished} boards flashed OK."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -16,22 +16,61 @@ Version: 1.0.1
 use: sudo python3 axdl_tool.py --axp ./M5_LLM_ubuntu22.04_20250210.axp
 
 """
+import abc
 import argparse
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
 import logging
+import math
+import mmap
 import os
 from pathlib import Path
+import queue
+import random
+import socket
 import struct
 import sys
+import threading
 import time
-from tqdm import tqdm
 import xml.etree.ElementTree as ET
 import zipfile
-import tempfile
+import zlib
+import io
 import usb.core
 import usb.util
-import glob
 
-tempfile.tempdir = "/var/tmp"
+from axdl_sparse import (
+    SparseFormatError,
+    SparseReader,
+    data_extents,
+    estimate_transfer_time,
+    is_sparse,
+    iter_expanded,
+    iter_transfers,
+    scan_sparse,
+)
+
+try:
+    import numpy
+except ImportError:  # optional, only speeds up checksums of large chunks
+    numpy = None
+
+try:
+    from tqdm import tqdm
+except ImportError:  # optional, progress is then only reported to callbacks
+    tqdm = None
+
+try:
+    import pyudev
+except ImportError:  # optional, waiting for a board then only polls
+    pyudev = None
 
 # ======= Global Definitions =======
 CMD_HANDSHAKE_BYTE = 0x3C
@@ -44,18 +83,235 @@ BSL_CMD_EXEC_DATA = 0x04
 BSL_CMD_RESET = 0x05
 BSL_CMD_ERASE_FLASH = 0x0A
 BSL_CMD_REPARTITION = 0x0B
+BSL_CMD_READ_FLASH_START = 0x10
+BSL_CMD_READ_FLASH_MIDST = 0x11
+BSL_CMD_READ_FLASH_END = 0x12
 
 BSL_REP_ACK = 0x80
 BSL_REP_FLASH_DATA = 0x93
 BSL_REP_VER = 0x81
+BSL_REP_INVALID_CMD = 0x82
+BSL_REP_UNKNOW_CMD = 0x83
+BSL_REP_OPERATION_FAILED = 0x84
+BSL_REP_DOWN_SIZE_ERROR = 0x8A
+BSL_REP_VERIFY_ERROR = 0x8B
+
+# Names used for the per-command latency statistics (see PhaseTimer)
+BSL_COMMAND_NAMES = {
+    BSL_CMD_CONNECT: "CONNECT",
+    BSL_CMD_START_DATA: "START_DATA",
+    BSL_CMD_MIDST_DATA: "MIDST_DATA",
+    BSL_CMD_ENDED_DATA: "ENDED_DATA",
+    BSL_CMD_EXEC_DATA: "EXEC_DATA",
+    BSL_CMD_RESET: "RESET",
+    BSL_CMD_ERASE_FLASH: "ERASE_FLASH",
+    BSL_CMD_REPARTITION: "REPARTITION",
+    BSL_CMD_READ_FLASH_START: "READ_FLASH_START",
+    BSL_CMD_READ_FLASH_MIDST: "READ_FLASH_MIDST",
+    BSL_CMD_READ_FLASH_END: "READ_FLASH_END",
+}
+
+# PARTITION_HEAD magic ("par:") and <Partitions unit="..."> -> bytes per unit
+PARTITION_MAGIC = 0x3A726170
+UNIT_SIZE_TABLE = {0: 1048576, 1: 524288, 2: 1024, 3: 1}
+
+DATA_CHUNK_SIZE = 0xB000
+# Number of MIDST_DATA chunks kept in flight; 1 is the original lock-step mode.
+# Larger windows have only been exercised against axdl_sim.py so far, so the
+# lock-step mode stays the default until the FDL is known to queue chunks.
+DEFAULT_DATA_WINDOW = 1
+# FDL uploads (see AXDLTool.fdl_steps): every stage takes FDL_LEGACY_CHUNK
+# lock-step; with fdl_probe, chunk sizes are probed from the largest down.
+FDL_CHUNK_SIZES = (0x10000, 0x8000, 0x4000, 0x2000, 0x1000, 1000)
+FDL_LEGACY_CHUNK = 1000
+# Stage that runs while each FDL is uploaded
+FDL_UPLOADER = {"EIP": "ROM CODE", "FDL1": "ROM CODE", "FDL2": "FDL1"}
+# Time (ms) a stage gets to ACK a MIDST_DATA header, and the data of a chunk
+FDL_HEADER_TIMEOUT = 2000
+FDL_DATA_TIMEOUT = 30000
+# Bytes asked for by one READ_FLASH_MIDST; the reply must fit the 16-bit
+# packet length.  Also the block size of the sampling read-back check.
+READ_CHUNK_SIZE = 0xB000
+
+
+# ======= Errors =======
+
+
+class AXDLError(Exception):
+    """Base class of the errors raised by the flashing API."""
+
+
+class AXPError(AXDLError):
+    """The AXP package is missing, unreadable or incomplete."""
+
+
+class SelectionError(AXDLError, ValueError):
+    """--only/--skip name images the AXP does not have, or leave none."""
+
+
+class FlashError(AXDLError):
+    """A phase of flashing a board failed (see FlashSession)."""
+
+    def __init__(self, message: str, phase=None, device=None):
+        super().__init__(message)
+        self.phase = phase
+        self.device = device
+
+
+class HandshakeError(FlashError):
+    """The ROM CODE or FDL1 handshake or CONNECT got no answer."""
+
+
+class FdlError(FlashError):
+    """Uploading or starting an FDL failed."""
+
+
+class PartitionError(FlashError):
+    """The partition table could not be written."""
+
+
+class ImageError(FlashError):
+    """Writing, erasing or verifying a partition failed."""
 
 
 # ======= USBSerialPort Class =======
 
 
+def usb_device_path(dev) -> str:
+    """Return the bus-port path of a device, e.g. '1-2.3' (as in sysfs)."""
+    ports = getattr(dev, "port_numbers", None)
+    if ports:
+        return f"{dev.bus}-{'.'.join(str(p) for p in ports)}"
+    return f"{dev.bus}-@{dev.address}"
+
+
+# pyusb speed codes (usb.util.SPEED_*) -> names
+USB_SPEEDS = {1: "low", 2: "full", 3: "high", 4: "super", 5: "super+"}
+
+
+def usb_controller(bus: int) -> str:
+    """
+    Host controller of a USB bus: the sysfs device its root hub hangs off
+    (e.g. the PCI address 0000:00:14.0), so the USB 2 and USB 3 buses of one
+    xHCI controller share a name.  "usb<bus>" when sysfs does not say.
+    """
+    root = f"/sys/bus/usb/devices/usb{bus}"
+    if not os.path.exists(root):
+        return f"usb{bus}"
+    return os.path.basename(os.path.dirname(os.path.realpath(root)))
+
+
+def usb_topology(dev) -> dict:
+    """Bus, port chain, parent hub, host controller and speed of a device."""
+    ports = list(getattr(dev, "port_numbers", None) or ())
+    if len(ports) > 1:
+        hub = f"{dev.bus}-{'.'.join(str(p) for p in ports[:-1])}"
+    else:
+        hub = f"usb{dev.bus}"
+    return {
+        "path": usb_device_path(dev),
+        "bus": dev.bus,
+        "ports": ports,
+        "hub": hub,
+        "controller": usb_controller(dev.bus),
+        "speed": USB_SPEEDS.get(getattr(dev, "speed", None), "unknown"),
+    }
+
+
+# Polling delays while waiting for a board to appear or for a stage to answer
+# its handshake (see Backoff), in seconds
+BACKOFF_FIRST = 0.05
+BACKOFF_LONGEST = 1.0
+# Seconds to wait for a board to appear, and for a stage to answer
+DEVICE_WAIT_TIMEOUT = 15.0
+HANDSHAKE_TIMEOUT = 20.0
+# Least milliseconds to wait for BSL_REP_VER before sending 0x3C again: a
+# stage answers every 0x3C run it gets, so resends only add stale replies
+HANDSHAKE_MIN_WAIT = 100
+
+
+class Backoff:
+    """Polling delays growing from first by factor up to longest seconds."""
+
+    def __init__(self, first=BACKOFF_FIRST, longest=BACKOFF_LONGEST, factor=2.0):
+        self.first = first
+        self.longest = max(first, longest)
+        self.factor = factor
+
+    @classmethod
+    def parse(cls, spec: str):
+        """Backoff from "FIRST_MS[,LONGEST_MS]", e.g. "50,1000"."""
+        first, _, longest = spec.partition(",")
+        first = float(first) / 1000
+        return cls(first, float(longest) / 1000 if longest else BACKOFF_LONGEST)
+
+    def delays(self):
+        delay = self.first
+        while True:
+            yield delay
+            delay = min(self.longest, delay * self.factor)
+
+
+@contextlib.contextmanager
+def usb_monitor():
+    """
+    Context manager yielding a started pyudev Monitor of USB device uevents,
+    or None without pyudev or netlink access (see wait_usb_event).
+    pyudev has no close(): its netlink socket goes with the last reference
+    to the monitor, which is dropped on leaving the with block.
+    """
+    monitor = None
+    if pyudev is not None:
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by(subsystem="usb", device_type="usb_device")
+            monitor.start()
+        except (OSError, ValueError):
+            monitor = None
+    try:
+        yield monitor
+    finally:
+        del monitor
+
+
+def wait_usb_event(monitor, timeout: float):
+    """Sleep up to timeout seconds; a uevent on monitor (if any) ends it early."""
+    if monitor is None:
+        time.sleep(timeout)
+    else:
+        monitor.poll(timeout=timeout)
+
+
+def find_devices(vid, pid) -> list:
+    """Return the sorted bus-port paths of all devices matching vid/pid."""
+    try:
+        devices = usb.core.find(find_all=True, idVendor=vid, idProduct=pid)
+        return sorted(usb_device_path(dev) for dev in devices)
+    except usb.core.USBError:
+        return []
+
+
+def find_device_topologies(vid, pid) -> list:
+    """Return the usb_topology() of all devices matching vid/pid, by path."""
+    try:
+        devices = usb.core.find(find_all=True, idVendor=vid, idProduct=pid)
+        return sorted((usb_topology(dev) for dev in devices), key=lambda t: t["path"])
+    except usb.core.USBError:
+        return []
+
+
 class USBSerialPort:
 
-    def __init__(self, vid, pid, logger=None, interface_number=0, alt_setting=0):
+    def __init__(
+        self,
+        vid,
+        pid,
+        logger=None,
+        interface_number=0,
+        alt_setting=0,
+        path=None,
+        backoff=None,
+    ):
         """
         Constructor to store vid/pid and optional logger.
 
@@ -64,9 +320,14 @@ class USBSerialPort:
         :param logger: A logging.Logger instance or None
         :param interface_number: Which interface to claim (defaults to 0)
         :param alt_setting: Which alternate setting to select (defaults to 0)
+        :param path: Bus-port path (see usb_device_path) of the board to open;
+            None opens the first matching board
+        :param backoff: Backoff of the look-ups while waiting for the board
         """
         self.vid = vid
         self.pid = pid
+        self.path = path
+        self.backoff = backoff if backoff else Backoff()
         self.logger = logger if logger else logging.getLogger("USBSerialPort")
         self.dev = None
         self.ep_out = None
@@ -77,36 +338,37 @@ class USBSerialPort:
 
         self.is_open = False
         self._kernel_driver_detached = False
+        # Reused OUT buffer of each writing thread (see _out_buffer)
+        self._out_local = threading.local()
 
-    def open(self, retry_count=15):
+    def open(self, timeout=DEVICE_WAIT_TIMEOUT):
         """
         Find the device, set configuration, claim the interface,
         and locate the Bulk endpoints (0x01 for OUT, 0x81 for IN).
 
-        :param retry_count: Number of times to retry finding the device
+        :param timeout: Seconds to wait for the device to appear
 
         :raises usb.core.USBError: If there is a failure in USB communication
         :raises ValueError: If device or endpoints can't be found
         """
+        where = f" at {self.path}" if self.path else ""
         self.logger.info(
-            f"Attempting to open USB device (VID=0x{self.vid:04X}, PID=0x{self.pid:04X})"
+            f"Attempting to open USB device (VID=0x{self.vid:04X}, PID=0x{self.pid:04X}){where}"
         )
+        match = None
+        if self.path:
+            match = lambda dev: usb_device_path(dev) == self.path
 
         # Find the USB device
-        retry = 0
-        while retry < retry_count:
-            try:
-                self.dev = usb.core.find(idVendor=self.vid, idProduct=self.pid)
-                if self.dev is not None:
-                    break
-            except usb.core.USBError as e:
-                self.logger.warning(f"USB find error: {e}")
-            retry += 1
-            self.logger.info("Retrying...")
-            time.sleep(1)
+        deadline = time.monotonic() + timeout
+        self.dev = self._find(match)
+        if self.dev is None:
+            self.dev = self._wait_for_device(match, deadline)
 
         if self.dev is None:
-            msg = f"Device not found (VID=0x{self.vid:04X}, PID=0x{self.pid:04X})."
+            msg = (
+                f"Device not found (VID=0x{self.vid:04X}, PID=0x{self.pid:04X}){where}."
+            )
             self.logger.error(msg)
             raise ValueError(msg)
 
@@ -163,6 +425,51 @@ class USBSerialPort:
             "USBSerialPort open: Bulk OUT=0x01, IN=0x81 claimed successfully."
         )
 
+    @property
+    def topology(self):
+        """usb_topology() of the opened device, or None."""
+        return usb_topology(self.dev) if self.dev else None
+
+    @property
+    def serial_number(self):
+        """USB iSerialNumber string of the opened device, or None."""
+        if not self.dev or not self.dev.iSerialNumber:
+            return None
+        try:
+            return usb.util.get_string(self.dev, self.dev.iSerialNumber)
+        except (usb.core.USBError, ValueError):
+            return None
+
+    def _find(self, match):
+        try:
+            return usb.core.find(
+                idVendor=self.vid, idProduct=self.pid, custom_match=match
+            )
+        except usb.core.USBError as e:
+            self.logger.warning(f"USB find error: {e}")
+            return None
+
+    def _wait_for_device(self, match, deadline: float):
+        """
+        Look the device up again on every USB uevent (with pyudev) and
+        otherwise after each delay of self.backoff, until deadline.
+        """
+        self.logger.info("Waiting for the device...")
+        started = time.monotonic()
+        delays = self.backoff.delays()
+        with usb_monitor() as monitor:
+            while True:
+                # Listening already, so an arrival from now on is not missed
+                dev = self._find(match)
+                if dev is not None:
+                    elapsed = time.monotonic() - started
+                    self.logger.info(f"Device found after {elapsed:.2f}s.")
+                    return dev
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                wait_usb_event(monitor, min(left, next(delays)))
+
     def close(self):
         """
         Release the interface and dispose resources.
@@ -202,8 +509,12 @@ class USBSerialPort:
         """
         if not self.is_open:
             raise IOError("Cannot write: USBSerialPort is not open.")
+        if isinstance(data, memoryview):
+            data = self._out_buffer(data)
         try:
             self.ep_out.write(data, timeout=timeout)
+            if not self.logger.isEnabledFor(logging.DEBUG):
+                return
             self.logger.debug(f"Wrote {len(data)} bytes to endpoint 0x01")
             # Print hex format for debugging
             if len(data) < 128:
@@ -216,6 +527,18 @@ class USBSerialPort:
             self.logger.error(f"Write failed: {e}")
             raise
 
+    def _out_buffer(self, view: memoryview) -> array.array:
+        """
+        Copy view (e.g. a MappedImage chunk) into this thread's reused
+        array: pyusb passes an array('B') to libusb as is but builds one from
+        anything else, a memoryview element by element.
+        """
+        buf = getattr(self._out_local, "buf", None)
+        if buf is None or len(buf) != view.nbytes:
+            buf = self._out_local.buf = array.array("B", bytes(view.nbytes))
+        memoryview(buf)[:] = view
+        return buf
+
     def read(self, size=512, timeout=120000) -> bytes:
         """
         Read raw bytes from the Bulk IN endpoint.
@@ -242,575 +565,4321 @@ class USBSerialPort:
             raise
 
 
-# ======= ax630tool =======
+# ======= Timing =======
 
 
-class AXDLGlobData:
-    MAGIC_NUMBER = 0x5C6D8E9F
+# Upper bounds (seconds) of the command latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    120.0,
+)
 
 
-class AXDLTool:
+def command_name(data) -> str:
+    """Name of the request in an OUT transfer: a BSL command, HANDSHAKE or DATA."""
+    if len(data) >= PACKET_HEAD.size:
+        magic, _, cmd = PACKET_HEAD.unpack_from(data)
+        if magic == AXDLGlobData.MAGIC_NUMBER:
+            return BSL_COMMAND_NAMES.get(cmd, f"0x{cmd:02X}")
+    if (
+        data
+        and data[0] == CMD_HANDSHAKE_BYTE
+        and bytes(data).count(CMD_HANDSHAKE_BYTE) == len(data)
+    ):
+        return "HANDSHAKE"
+    return "DATA"
 
-    def checksum16(self, data: bytes) -> int:
-        """Compute 16-bit checksum over the given data bytes."""
-        total = 0
-        idx = 0
-        length = len(data)
-        while idx < length - 1:
-            val = data[idx] | (data[idx + 1] << 8)
-            total += val
-            total &= 0xFFFFFFFF
-            idx += 2
-        if length % 2 == 1:
-            total += data[-1]
-            total &= 0xFFFFFFFF
-        while (total >> 16) != 0:
-            total = (total & 0xFFFF) + (total >> 16)
-        return (~total) & 0xFFFF
 
-    def build_packet(self, cmd: int, payload: bytes = b"") -> bytes:
-        """Build a packet: MAGIC(4) + LENGTH(2) + CMD(2) + PAYLOAD + CRC(2)."""
-        length_bytes = struct.pack("<H", len(payload))
-        cmd_bytes = struct.pack("<H", cmd)
-        to_cksum = length_bytes + cmd_bytes + payload
-        csum = self.checksum16(to_cksum)
-        csum_bytes = struct.pack("<H", csum)
-        return struct.pack("<I", AXDLGlobData.MAGIC_NUMBER) + to_cksum + csum_bytes
+class PhaseTimer:
+    """
+    Wall time, process CPU time, bytes and bulk transfers per flashing phase,
+    plus a latency histogram per protocol command.
 
-    def parse_packet(self, resp: bytes):
-        """Parse the packet from raw bytes -> (cmd, payload) or None if invalid."""
-        if len(resp) < 8:
-            return None
-        magic = struct.unpack_from("<I", resp, 0)[0]
-        if magic != AXDLGlobData.MAGIC_NUMBER:
-            return None
-        length_val = struct.unpack_from("<H", resp, 4)[0]
-        cmd_val = struct.unpack_from("<H", resp, 6)[0]
-        total_len = 4 + 2 + 2 + length_val + 2
-        if len(resp) < total_len:
-            return None
-        payload = resp[8 : 8 + length_val]
-        csum_pkt = struct.unpack_from("<H", resp, 8 + length_val)[0]
-        to_cksum = resp[4 : 4 + 2 + 2 + length_val]
-        if self.checksum16(to_cksum) != csum_pkt:
-            return None
-        return (cmd_val, payload)
+    Phases are recorded in the order they run; a phase started while another
+    one is running (e.g. an image inside "images") is recorded separately and
+    its transfers are attributed to the innermost phase only.
+
+    Command latencies are matched from the transfers themselves: every OUT
+    transfer given with its data queues a request, and every reply packet
+    read back completes the oldest one (an empty read counts it as a
+    timeout).  The FDL answers strictly in order, so this also holds with
+    several MIDST_DATA chunks in flight.
+    """
 
-    tmp_axp_path = None
+    def __init__(self):
+        self.phases = []
+        self._stack = []
+        self.commands = {}
+        self._pending = collections.deque(maxlen=64)
 
-    def __del__(self):
-        if self.tmp_axp_path != None:
-            self.tmp_axp_path.cleanup()
-            self.tmp_axp_path = None
+    @contextlib.contextmanager
+    def phase(self, name: str, nbytes: int = 0):
+        entry = {
+            "name": name,
+            "bytes": nbytes,
+            "wall": 0.0,
+            "cpu": 0.0,
+            "reads": 0,
+            "writes": 0,
+            "bytes_out": 0,
+            "bytes_in": 0,
+            "retries": 0,
+        }
+        self.phases.append(entry)
+        self._stack.append(entry)
+        wall0 = time.monotonic()
+        cpu0 = time.process_time()
+        try:
+            yield entry
+        finally:
+            entry["wall"] = time.monotonic() - wall0
+            entry["cpu"] = time.process_time() - cpu0
+            self._stack.pop()
 
-    def extract_axp(self, axp_path: str, logger: logging.Logger):
+    def count_transfer(self, direction: str, nbytes: int, data=None):
         """
-        Extract all files from an AXP (zip) to temp, returning (xml_content, extracted_files).
+        Count one bulk transfer into the innermost phase.  With data, also
+        track the command latency (data written / data read back).
         """
-        if self.tmp_axp_path == None:
-            self.tmp_axp_path = tempfile.TemporaryDirectory()
-        if not os.path.isfile(axp_path):
-            logger.error(f"AXP file not found: {axp_path}")
-            sys.exit(1)
-        with zipfile.ZipFile(axp_path, "r") as zip_ref:
-            for file_info in zip_ref.infolist():
-                try:
-                    zip_ref.extract(file_info, self.tmp_axp_path.name)
-                except Exception as e:
-                    pass
-        xml_content = None
-        extracted_file_list = glob.glob(os.path.join(self.tmp_axp_path.name, "*"))
-        extracted_files = {}
-        if len(extracted_file_list) != 0:
-            for file_path in extracted_file_list:
-                file_name = os.path.basename(file_path)
-                extracted_files[file_name] = file_path
-                if file_name.lower().endswith(".xml"):
-                    with open(file_path, "r", encoding="utf-8") as xml_file:
-                        xml_content = xml_file.read()
+        if data is not None:
+            self._track_command(direction, data)
+        if not self._stack:
+            return
+        entry = self._stack[-1]
+        if direction == "out":
+            entry["writes"] += 1
+            entry["bytes_out"] += nbytes
+        else:
+            entry["reads"] += 1
+            entry["bytes_in"] += nbytes
 
-        if not xml_content:
-            logger.error("No XML found in AXP.")
-            sys.exit(1)
+    def count_retry(self):
+        if self._stack:
+            self._stack[-1]["retries"] += 1
 
-        return xml_content, extracted_files
+    def _track_command(self, direction: str, data):
+        now = time.monotonic()
+        if direction == "out":
+            self._pending.append((command_name(data), now))
+            return
+        if not data:
+            if self._pending:
+                self._record_command(self._pending.popleft()[0], None)
+            return
+        # A read may carry several replies; one that carries none is the
+        # rest of a packet started in an earlier read.
+        for _ in range(bytes(data).count(PACKET_MAGIC)):
+            if not self._pending:
+                break
+            name, sent = self._pending.popleft()
+            self._record_command(name, now - sent)
 
-    def parse_config_xml(self, xml_str: str, logger: logging.Logger):
+    def _record_command(self, name: str, latency):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = {
+                "count": 0,
+                "timeouts": 0,
+                "sum": 0.0,
+                "max": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        if latency is None:
+            stats["timeouts"] += 1
+            return
+        stats["count"] += 1
+        stats["sum"] += latency
+        stats["max"] = max(stats["max"], latency)
+        stats["buckets"][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def report(self) -> list:
         """
-        Parse the XML to extract:
-        - FDL1 file name & base
-        - FDL2 file name & base
-        - The 'unit' from <Partitions unit="...">
-        - The list of partitions: (id, size, gap)
-        - The full <ImgList> in order (for subsequent downloading)
-        Returns a dict with e.g.:
-        {
-            'fdl1': {'file': 'fdl1.bin', 'base': 0x03000000},
-            'fdl2': {'file': 'fdl2.bin', 'base': 0x5C000000},
-            'unit': 2,
-            'partitions': [
-                {'id': 'spl', 'size': 768, 'gap': 0},
-                ...
-            ],
-            'imglist': [
-                {
-                    'id': 'FDL1',
-                    'file': 'fdl1.bin',
-                    'base': 0x3000000,
-                    'block_id': None or 'somepart',
-                    'select': True/False,
-                    'flag': 3,
-                    'type': 'FDL1'
-                },
-                ...
-            ]
-        }
+        Return the phases as a list of dicts (JSON serialisable); phases that
+        carry image data also get their throughput as "mb_per_s".
         """
-        root = ET.fromstring(xml_str)  # <Config>
-        project = root.find("Project")
-        if project is None:
-            logger.error("No <Project> in XML.")
-            sys.exit(1)
+        phases = []
+        for entry in self.phases:
+            entry = dict(entry)
+            if entry["bytes"] and entry["wall"] > 0:
+                entry["mb_per_s"] = entry["bytes"] / entry["wall"] / 1e6
+            phases.append(entry)
+        return phases
 
-        # Partitions
-        partitions_elem = project.find("Partitions")
-        if partitions_elem is None:
-            logger.error("No <Partitions> in XML.")
-            sys.exit(1)
-        # read 'unit' from <Partitions unit="...">
-        str_unit = partitions_elem.get("unit", "2")
-        unit = int(str_unit, 0)  # parse as decimal or hex
+    def command_report(self) -> dict:
+        """
+        Return the command latencies as {command: {"count", "timeouts", "sum",
+        "max", "mean", "buckets": {upper bound: cumulative count}}}, the
+        buckets ending with "+Inf" as in a Prometheus histogram.
+        """
+        report = {}
+        for name, stats in sorted(self.commands.items()):
+            bounds = [f"{b:g}" for b in LATENCY_BUCKETS] + ["+Inf"]
+            cumulative = 0
+            buckets = {}
+            for bound, n in zip(bounds, stats["buckets"]):
+                cumulative += n
+                buckets[bound] = cumulative
+            report[name] = {
+                "count": stats["count"],
+                "timeouts": stats["timeouts"],
+                "sum": stats["sum"],
+                "max": stats["max"],
+                "mean": stats["sum"] / stats["count"] if stats["count"] else 0.0,
+                "buckets": buckets,
+            }
+        return report
 
-        # gather partition info
-        partition_list = []
-        for pe in partitions_elem.findall("Partition"):
-            pid = pe.get("id", "")
-            psize = int(pe.get("size", "0"), 0)
-            pgap = int(pe.get("gap", "0"), 0)
-            partition_list.append({"id": pid, "size": psize, "gap": pgap})
 
-        # parse <ImgList>
-        img_list_elem = project.find("ImgList")
-        if img_list_elem is None:
-            logger.error("No <ImgList> in XML.")
-            sys.exit(1)
+class TimedPort:
+    """Port wrapper that counts every bulk transfer into a PhaseTimer."""
 
-        # placeholders
-        fdl1_info = {"file": None, "base": None}
-        fdl2_info = {"file": None, "base": None}
-        eip_info = {"file": None, "base": None}
-        full_img_list = []
+    def __init__(self, port, timer: PhaseTimer):
+        self.port = port
+        self.timer = timer
 
-        for img_elem in img_list_elem.findall("Img"):
-            id_node = img_elem.find("ID")
-            file_node = img_elem.find("File")
-            block_elem = img_elem.find("Block")
+    def __getattr__(self, name):
+        return getattr(self.port, name)
 
-            if id_node is None:
-                continue
-            img_id = id_node.text.strip() if id_node.text else ""
-            fname = (
-                file_node.text.strip()
-                if (file_node is not None and file_node.text)
-                else ""
-            )
-            flag_str = img_elem.get("flag", "0")
-            select_str = img_elem.get("select", "0")
-            # parse base from <Block><Base>0x3000000</Base></Block> if present
-            base_addr = 0
-            block_id = None
-            if block_elem is not None:
-                base_text = block_elem.findtext("Base", "0")
-                block_id = block_elem.get("id", None)
-                if base_text.startswith("0x") or base_text.startswith("0X"):
-                    base_addr = int(base_text, 16)
-                else:
-                    base_addr = int(base_text)
+    def write(self, data, timeout=2000):
+        written = self.port.write(data, timeout=timeout)
+        self.timer.count_transfer("out", len(data), data)
+        return written
 
-            # catch EIP / FDL1 / FDL2 specifically
-            if img_id == "FDL1":
-                fdl1_info["file"] = fname
-                fdl1_info["base"] = base_addr
-            elif img_id == "FDL2":
-                fdl2_info["file"] = fname
-                fdl2_info["base"] = base_addr
-            elif img_id == "EIP":
-                eip_info["file"] = fname
-                eip_info["base"] = base_addr
-            else:
-                # store
-                one_img = {
-                    "id": img_id,
-                    "file": fname,
-                    "base": base_addr,
-                    "block_id": block_id,
-                    "flag": int(flag_str),
-                    "select": (select_str == "1"),
-                    "type": img_elem.findtext("Type", "").strip(),
-                }
-                full_img_list.append(one_img)
+    def read(self, size=512, timeout=120000) -> bytes:
+        data = self.port.read(size, timeout=timeout)
+        self.timer.count_transfer("in", len(data), data)
+        return data
 
-        if not fdl1_info["file"] or fdl1_info["base"] is None:
-            logger.error("FDL1 (file/base) not properly found in XML.")
-            sys.exit(1)
-        if not fdl2_info["file"] or fdl2_info["base"] is None:
-            logger.error("FDL2 (file/base) not properly found in XML.")
-            sys.exit(1)
 
-        return {
-            "fdl1": fdl1_info,
-            "fdl2": fdl2_info,
-            "eip": eip_info,
-            "unit": unit,
-            "partitions": partition_list,
-            "imglist": full_img_list,
-        }
+# ======= Session traces =======
 
-    def handshake(self, port, logger, stage_name="ROM CODE") -> bool:
-        """Repeatedly send 0x3C until receiving BSL_REP_VER."""
-        max_tries = 10
-        for attempt in range(max_tries):
-            port.write(bytes([CMD_HANDSHAKE_BYTE] * 3))
-            time.sleep(0.1)
-            resp = port.read(512, timeout=2000)
-            if not resp:
-                logger.debug(f"{stage_name} handshake attempt {attempt+1}: no data.")
-                continue
-            parsed = self.parse_packet(resp)
-            if parsed:
-                cmd, payload = parsed
-                if cmd == BSL_REP_VER:
-                    logger.info(
-                        f'{stage_name} handshake success. ({payload.decode("utf-8", errors="ignore")})'
-                    )
-                    return resp.decode("utf-8", errors="ignore")
-        return ""
+# A trace (see TracePort, read back by axdl_trace.py) is a header followed by
+# one record per bulk transfer, in the order the transfers completed:
+#   header: TRACE_MAGIC, version (u16), length (u32) of the JSON metadata
+#           that follows it
+#   record: kind, flags (u8), reply packets (u16), stored bytes (u16), start
+#           (u64, us since the trace was opened), duration (u32, us), length
+#           (u32), then the stored bytes and with TRACE_DIGEST the digest
+TRACE_MAGIC = b"AXDLTRC\0"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<8sHI")
+TRACE_RECORD = struct.Struct("<BBHHQII")
+TRACE_OUT = 0
+TRACE_IN = 1
+# Record flags
+TRACE_FAILED = 0x01  # the transfer raised; length is the size asked for
+TRACE_WHOLE = 0x02  # the stored bytes are the whole transfer, not its head
+TRACE_DIGEST = 0x04  # a BLAKE2b digest of the transfer follows
+TRACE_DIGEST_SIZE = 8
+# Transfers up to TRACE_CAPTURE bytes (commands, replies, handshakes) are
+# stored whole; of longer ones only the first TRACE_HEAD bytes, which hold a
+# MIDST_DATA header sent with its data, are kept.
+TRACE_CAPTURE = 512
+TRACE_HEAD = 32
 
-    def cmd_connect(self, port, logger):
-        """Send BSL_CMD_CONNECT -> expect ACK."""
-        pkt = self.build_packet(BSL_CMD_CONNECT)
-        port.write(pkt)
-        resp = port.read(512)
-        parsed = self.parse_packet(resp)
-        if parsed and parsed[0] == BSL_REP_ACK:
-            logger.info("BSL_CMD_CONNECT -> ACK")
-            return True
-        logger.error("BSL_CMD_CONNECT -> no ACK")
-        return False
 
-    def download_fdl(
-        self, port, logger, fdl_path: str, base_addr: int, stage_name="FDL?"
-    ) -> bool:
-        """
-        Download an FDL via (START_DATA -> chunked -> ENDED_DATA -> EXEC_DATA).
-        Uses the older code example.
-        """
-        if not os.path.isfile(fdl_path):
-            logger.error(f"File not found: {fdl_path}")
-            return False
-        size = os.path.getsize(fdl_path)
-        logger.info(
-            f"Downloading {stage_name} from {Path(fdl_path).name}, size={size} bytes, base=0x{base_addr:X}"
+class TracePort:
+    """
+    Port wrapper that records every bulk transfer into a session trace file:
+    direction, start time, duration, length, the reply packets read and the
+    transfer itself (or its head, see TRACE_CAPTURE).  With digest, the data
+    of every transfer that is not stored whole is also digested, so traces of
+    two runs can be compared.  Transfers may come from several threads (see
+    axdl_async.AsyncPort).  The trace is closed with the port.
+    """
+
+    def __init__(self, port, trace_path: str, digest=False, meta=None):
+        self.port = port
+        self.trace_path = trace_path
+        self.digest = digest
+        self._lock = threading.Lock()
+        self._file = open(trace_path, "wb")
+        self._t0 = time.monotonic()
+        header = dict(meta or {})
+        header.update(
+            device=getattr(port, "path", None),
+            started=time.time(),
+            capture=TRACE_CAPTURE,
+            head=TRACE_HEAD,
+            digest=digest,
         )
+        blob = json.dumps(header).encode("utf-8")
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, len(blob)))
+        self._file.write(blob)
 
-        # Send BSL_CMD_START_DATA
-        if stage_name == "FDL1":
-            start_payload = struct.pack("<II", base_addr, size)
-        elif stage_name == "FDL2":
-            start_payload = struct.pack("<QQ", base_addr, size)
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def close(self):
+        try:
+            self.port.close()
+        finally:
+            with self._lock:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+
+    def write(self, data, timeout=2000):
+        start = time.monotonic()
+        try:
+            written = self.port.write(data, timeout=timeout)
+        except Exception:
+            self._record(TRACE_OUT, start, data, TRACE_FAILED)
+            raise
+        self._record(TRACE_OUT, start, data)
+        return written
+
+    def read(self, size=512, timeout=120000) -> bytes:
+        start = time.monotonic()
+        try:
+            data = self.port.read(size, timeout=timeout)
+        except Exception:
+            self._record(TRACE_IN, start, b"", TRACE_FAILED, size)
+            raise
+        self._record(TRACE_IN, start, data)
+        return data
+
+    def _record(self, kind: int, start: float, data, flags=0, length=None):
+        end = time.monotonic()
+        packets = 0
+        if kind == TRACE_IN:
+            packets = min(0xFFFF, bytes(data).count(PACKET_MAGIC))
+        data = memoryview(data).cast("B")
+        if len(data) <= TRACE_CAPTURE:
+            stored = data
+            flags |= TRACE_WHOLE
         else:
-            logger.error(f"Unknown stage name for FDL download: {stage_name}")
-        pkt_start = self.build_packet(BSL_CMD_START_DATA, start_payload)
-        port.write(pkt_start)
-        resp = port.read(512)
-        parsed = self.parse_packet(resp)
-        if not (parsed and parsed[0] == BSL_REP_ACK):
-            logger.error(f"No ACK after START_DATA for {stage_name}.")
-            return False
+            stored = data[:TRACE_HEAD]
+        extra = b""
+        if self.digest and not flags & TRACE_WHOLE:
+            extra = hashlib.blake2b(data, digest_size=TRACE_DIGEST_SIZE).digest()
+            flags |= TRACE_DIGEST
+        record = TRACE_RECORD.pack(
+            kind,
+            flags,
+            packets,
+            len(stored),
+            int((start - self._t0) * 1e6),
+            min(0xFFFFFFFF, int((end - start) * 1e6)),
+            len(data) if length is None else length,
+        )
+        with self._lock:
+            if self._file is not None:
+                self._file.write(record + stored + extra)
 
-        chunk_size = 1000
-        pbar = tqdm(total=size, unit="B", unit_scale=True, desc=f"{stage_name}")
 
-        with open(fdl_path, "rb") as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                # BSL_CMD_MIDST_DATA
-                # We'll typically set Enable=0 => no partial-checksum, and CheckSum=0 => filler.
-                chunk_len = len(chunk)
-                mids_payload = struct.pack("<III", chunk_len, 0, 0)
-                pkt_midst = self.build_packet(BSL_CMD_MIDST_DATA, mids_payload)
-                port.write(pkt_midst)
-                resp = port.read(512, timeout=2000)
-                parsed = self.parse_packet(resp)
-                if not (parsed and parsed[0] == BSL_REP_ACK):
-                    logger.error(f"No ACK after MIDST_DATA header for {stage_name}.")
-                    return False
+# ======= Data streaming helpers =======
 
-                # send the chunk
-                port.write(chunk)
-                resp = port.read(512, timeout=30000)
-                parsed = self.parse_packet(resp)
-                if not (parsed and parsed[0] == BSL_REP_ACK):
-                    logger.error(f"No ACK after data chunk for {stage_name}.")
-                    return False
 
-                pbar.update(chunk_len)
+def image_transfers(fileobj, chunk_size: int, sparse=False):
+    """
+    Iterate the MIDST_DATA transfers of an image: chunk_size slices, or for a
+    sparse image pieces of at most chunk_size aligned to its chunks (see
+    axdl_sparse.iter_transfers).
+    """
+    if sparse:
+        return iter_transfers(SparseReader(fileobj), chunk_size)
+    return iter(functools.partial(fileobj.read, chunk_size), b"")
 
-        pbar.close()
+
+class CallbackProgress:
+    """
+    Stand-in for a tqdm bar that reports every update as
+    callback(desc, done, total) (nothing when callback is None).
+    """
+
+    def __init__(self, callback, desc: str, total: int):
+        self.callback = callback
+        self.desc = desc
+        self.total = total
+        self.done = 0
+
+    def update(self, n: int):
+        self.done += n
+        if self.callback is not None:
+            self.callback(self.desc, self.done, self.total)
+
+    def close(self):
+        pass
+
+
+class ChunkPrefetcher:
+    """
+    Read fixed-size chunks from a binary file in a background thread so the
+    next chunks are already in memory while the current one is on the wire.
+    Iterating yields the chunks in file order; read errors are re-raised in
+    the consuming thread.
+    """
+
+    _EOF = object()
+
+    def __init__(self, fileobj, chunk_size: int, depth: int = 2, chunks=None):
+        """
+        :param fileobj: Binary file-like object opened for reading
+        :param chunk_size: Size of each chunk in bytes
+        :param depth: Maximum number of chunks buffered ahead of the consumer
+        :param chunks: Iterator producing the chunks from fileobj instead of
+            chunk_size reads (e.g. image_transfers() of a sparse image)
+        """
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._chunks = chunks
+        if chunks is None:
+            self._chunks = image_transfers(fileobj, chunk_size)
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for chunk in self._chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._EOF)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._EOF:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Stop the reader thread (safe to call more than once)."""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class PacketReader:
+    """
+    Split the Bulk IN byte stream into BSL packets.
+
+    A single read may carry more than one response when several commands are
+    outstanding, so surplus bytes are kept for the next call.  Bytes before
+    a packet's magic (e.g. the rest of a garbled reply) are skipped.
+    """
+
+    def __init__(self, axdl, port, read_size=512):
+        """
+        :param read_size: Bytes asked for per read; larger than 512 for
+            replies carrying data (BSL_REP_FLASH_DATA)
+        """
+        self.axdl = axdl
+        self.port = port
+        self.read_size = read_size
+        self._buf = bytearray()
+
+    def split(self):
+        """Pop the raw bytes of the next complete packet, or None if there is none yet."""
+        start = self._buf.find(PACKET_MAGIC)
+        if start < 0:
+            del self._buf[: max(0, len(self._buf) - len(PACKET_MAGIC) + 1)]
+        elif start:
+            del self._buf[:start]
+        if len(self._buf) < 6:
+            return None
+        length_val = struct.unpack_from("<H", self._buf, 4)[0]
+        total_len = 4 + 2 + 2 + length_val + 2
+        if len(self._buf) < total_len:
+            return None
+        pkt = bytes(self._buf[:total_len])
+        del self._buf[:total_len]
+        return pkt
+
+    def next_packet(self, timeout: int):
+        """
+        Return the next (cmd, payload) tuple, or None on timeout/invalid data.
+
+        :param timeout: Timeout in milliseconds for each underlying read
+        """
+        while True:
+            pkt = self.split()
+            if pkt is not None:
+                return self.axdl.parse_packet(pkt)
+            data = self.port.read(self.read_size, timeout=timeout)
+            if not data:
+                return None
+            self._buf += data
+
+
+# ======= Transport-independent protocol flow =======
+
+# The BSL exchanges are written once, as generators ("steps") that yield the
+# port operations below and are sent back their results.  run_steps() carries
+# them out on a blocking port, axdl_async.run_steps_async() on an AsyncPort,
+# so both transports take the same decisions (timeouts, retries, probing).
+
+# Write data; returns None
+PortWrite = collections.namedtuple("PortWrite", "data timeout", defaults=(2000,))
+# Queue a write; returns a handle for PortSent (written at once when blocking)
+PortSend = collections.namedtuple("PortSend", "data timeout", defaults=(2000,))
+# Wait for the writes of the PortSend handles; raises if one failed
+PortSent = collections.namedtuple("PortSent", "handles")
+# Next reply packet, each read asking for read_size bytes; (cmd, payload) or None
+PortPacket = collections.namedtuple("PortPacket", "timeout read_size", defaults=(512,))
+# Discard all input until a read times out (late replies of a failed exchange)
+PortDrain = collections.namedtuple("PortDrain", "")
+# fn(*args), which may block (image reads, hash and verifier threads)
+BlockingCall = collections.namedtuple("BlockingCall", "fn args", defaults=((),))
+# A BusScheduler slot for a data phase behind controller; returns the slot
+DataSlot = collections.namedtuple("DataSlot", "controller on_wait")
+
+
+def run_steps(steps, port, tool):
+    """
+    Run protocol steps on a blocking port and return their result.  An
+    exception of a port operation is raised inside the steps, at the yield.
+
+    :param tool: AXDLTool of the steps (packet parsing, BusScheduler, timer)
+    """
+    reader = PacketReader(tool, port)
+    result, error = None, None
+    try:
+        while True:
+            try:
+                op = steps.throw(error) if error is not None else steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result, error = None, None
+            try:
+                if isinstance(op, PortPacket):
+                    reader.read_size = op.read_size
+                    result = reader.next_packet(op.timeout)
+                elif isinstance(op, (PortWrite, PortSend)):
+                    port.write(op.data, timeout=op.timeout)
+                elif isinstance(op, PortDrain):
+                    while port.read(512, timeout=100):
+                        pass
+                    reader = PacketReader(tool, port)
+                elif isinstance(op, BlockingCall):
+                    result = op.fn(*op.args)
+                elif isinstance(op, DataSlot):
+                    result = tool.scheduler.acquire(
+                        op.controller, tool.timer, op.on_wait
+                    )
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+
+# ======= Image sources =======
+
+
+class ImageSource(abc.ABC):
+    """
+    Read-only view of one image inside (or next to) an AXP package.
+
+    open() returns a fresh binary reader each time, so several readers (and
+    several threads) can use the same source independently.
+    """
+
+    # CRC-32 of the content when it is known without reading it (zip members)
+    crc32 = None
+    _sparse = None
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+    @abc.abstractmethod
+    def open(self):
+        """Return a new binary reader positioned at the start of the image."""
+
+    @property
+    def sparse(self) -> bool:
+        """True for an Android sparse image (checked once, from its magic)."""
+        if self._sparse is None:
+            with self.open() as f:
+                self._sparse = is_sparse(f.read(4))
+        return self._sparse
+
+    def materialize(self):
+        """Return an in-memory copy of this image as a BytesImageSource."""
+        with self.open() as f:
+            return BytesImageSource(self.name, f.read())
+
+    def map(self, advise=True, drop_cache=False):
+        """
+        MappedImage of this image if it is stored uncompressed in a file that
+        can be memory-mapped, else None (read it through open()).
+        """
+        return None
+
+    def _map_file(self, path: str, offset: int, advise: bool, drop_cache: bool):
+        if not self.size:
+            return None
+        try:
+            return MappedImage(path, offset, self.size, advise, drop_cache)
+        except (OSError, ValueError):
+            return None
+
+
+class FileImageSource(ImageSource):
+    """Image stored as a plain file on disk."""
+
+    def __init__(self, path: str):
+        self.path = path
+        super().__init__(os.path.basename(path), os.path.getsize(path))
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def map(self, advise=True, drop_cache=False):
+        return self._map_file(self.path, 0, advise, drop_cache)
+
+
+class BytesImageSource(ImageSource):
+    """Image held in memory (XML, FDL blobs and other small members)."""
+
+    def __init__(self, name: str, data: bytes):
+        self.data = data
+        super().__init__(name, len(data))
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+    def materialize(self):
+        return self
+
+
+# Bytes of a MappedImage the kernel is asked to read ahead of the transfers
+MMAP_READAHEAD = 8 << 20
+# Chunks AXDLTool.prepare_image() reads ahead of an image that is not mapped
+PREPARE_DEPTH = MMAP_READAHEAD // DATA_CHUNK_SIZE
+
+
+class MappedImage:
+    """
+    Read-only memory map of an image stored uncompressed in a file (a plain
+    file or a stored member of the AXP zip).  chunks() hands out memoryview
+    slices of the map, so the data goes to the bulk OUT transfers without
+    being read into a bytes object per chunk first.
+
+    With advise, the kernel is told that the map is read sequentially, is
+    asked to read MMAP_READAHEAD bytes ahead of the transfers and drops the
+    pages already sent from the map.  drop_cache also evicts them from the
+    page cache, which only pays off when no other board is sent the image.
+    """
+
+    def __init__(
+        self, path: str, offset: int, size: int, advise=True, drop_cache=False
+    ):
+        self.size = size
+        self.advise = advise and hasattr(mmap.mmap, "madvise")
+        self.drop_cache = drop_cache and hasattr(os, "posix_fadvise")
+        # The map has to start at a multiple of the allocation granularity
+        self._start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self._base = offset - self._start
+        self._fd = os.open(path, os.O_RDONLY)
+        try:
+            self._map = mmap.mmap(
+                self._fd,
+                self._base + size,
+                access=mmap.ACCESS_READ,
+                offset=self._start,
+            )
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self.view = memoryview(self._map)[self._base : self._base + size]
+        # Map offsets up to which pages were asked for and given up
+        self._ahead = self._base
+        self._dropped = self._base - self._base % mmap.PAGESIZE
+        if self.advise:
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+            self._read_ahead(self._base)
+
+    def chunks(self, chunk_size: int, keep: int = 0):
+        """
+        Iterate the image as chunk_size memoryview slices.  The pages more
+        than keep bytes before the current chunk are dropped, in steps of
+        MMAP_READAHEAD // 2 (keep covers chunks still queued for writing
+        when the next one is taken).
+        """
+        for pos in range(0, self.size, chunk_size):
+            if self.advise:
+                self._read_ahead(self._base + pos)
+                if self._base + pos - keep - self._dropped >= MMAP_READAHEAD // 2:
+                    self._drop(self._base + pos - keep)
+            yield self.view[pos : pos + chunk_size]
+
+    def _read_ahead(self, pos: int):
+        if self._ahead - pos >= MMAP_READAHEAD // 2:
+            return
+        end = min(self._base + self.size, pos + MMAP_READAHEAD)
+        start = self._ahead - self._ahead % mmap.PAGESIZE
+        if end > start:
+            self._map.madvise(mmap.MADV_WILLNEED, start, end - start)
+        self._ahead = end
+
+    def _drop(self, pos: int):
+        end = pos - pos % mmap.PAGESIZE
+        if end <= self._dropped:
+            return
+        self._map.madvise(mmap.MADV_DONTNEED, self._dropped, end - self._dropped)
+        if self.drop_cache:
+            os.posix_fadvise(
+                self._fd,
+                self._start + self._dropped,
+                end - self._dropped,
+                os.POSIX_FADV_DONTNEED,
+            )
+        self._dropped = end
+
+    def close(self):
+        """Unmap the image (safe to call more than once)."""
+        if self._map is None:
+            return
+        if self.advise:
+            self._drop(self._base + self.size)
+        self.view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Chunks are still referenced (e.g. by a write cancelled while
+            # queued); the map goes away with the last of them.
+            pass
+        os.close(self._fd)
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _SliceReader(io.RawIOBase):
+    """Reader over a [offset, offset + size) slice of a file, using pread."""
+
+    def __init__(self, path: str, offset: int, size: int):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        self._pos = min(max(0, pos), self._size)
+        return self._pos
+
+    def read(self, size=-1):
+        remain = self._size - self._pos
+        if size is None or size < 0 or size > remain:
+            size = remain
+        if size == 0:
+            return b""
+        data = os.pread(self._fd, size, self._offset + self._pos)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+
+class _InflateReader(io.RawIOBase):
+    """
+    Inflating reader over a deflated zip member, read with pread from its
+    data offset like _SliceReader, so the zip directory is not parsed again
+    for every open.  The CRC-32 is checked at the end, as zipfile does.
+    """
+
+    def __init__(self, path: str, info: zipfile.ZipInfo, data_offset: int):
+        self._raw = _SliceReader(path, data_offset, info.compress_size)
+        self._inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._info = info
+        self._crc = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(functools.partial(self.read, 1 << 20), b""))
+        pieces = []
+        while size > 0 and not self._inflate.eof:
+            data = self._inflate.unconsumed_tail
+            if not data:
+                data = self._raw.read(1 << 16)
+                if not data:
+                    raise zipfile.BadZipFile(
+                        f"Truncated member '{self._info.filename}'"
+                    )
+            piece = self._inflate.decompress(data, size)
+            pieces.append(piece)
+            size -= len(piece)
+            self._crc = zlib.crc32(piece, self._crc)
+        if self._inflate.eof and self._crc != self._info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for member '{self._info.filename}'")
+        return b"".join(pieces)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._raw.close()
+        super().close()
+
+
+class _ZipStreamReader(io.RawIOBase):
+    """Chunk-by-chunk decompressing reader over a compressed zip member."""
+
+    def __init__(self, archive_path: str, info: zipfile.ZipInfo):
+        self._zip = zipfile.ZipFile(archive_path, "r")
+        self._member = self._zip.open(info, "r")
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._member.read(size)
+
+    def readinto(self, b):
+        data = self._member.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._member.close()
+            self._zip.close()
+        super().close()
+
+
+class ZipMemberImageSource(ImageSource):
+    """
+    Image read straight out of the AXP zip.  Stored members are read as
+    slices at their data offset in the archive; deflated members are
+    inflated from there as a stream, other compressed ones through zipfile.
+    """
+
+    def __init__(self, archive_path: str, info: zipfile.ZipInfo, data_offset: int):
+        self.archive_path = archive_path
+        self.info = info
+        self.data_offset = data_offset
+        super().__init__(os.path.basename(info.filename), info.file_size)
+
+    @property
+    def is_stored(self):
+        return self.info.compress_type == zipfile.ZIP_STORED
+
+    @property
+    def crc32(self):
+        return self.info.CRC
+
+    def map(self, advise=True, drop_cache=False):
+        if not self.is_stored:
+            return None
+        return self._map_file(self.archive_path, self.data_offset, advise, drop_cache)
+
+    def open(self):
+        if self.is_stored:
+            return _SliceReader(self.archive_path, self.data_offset, self.size)
+        if self.info.compress_type == zipfile.ZIP_DEFLATED:
+            return _InflateReader(self.archive_path, self.info, self.data_offset)
+        return _ZipStreamReader(self.archive_path, self.info)
+
+
+def zip_member_data_offset(fileobj, info: zipfile.ZipInfo) -> int:
+    """Return the offset of a member's data, past its local file header."""
+    fileobj.seek(info.header_offset)
+    header = fileobj.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile(f"Bad local file header for '{info.filename}'")
+    name_len, extra_len = struct.unpack_from("<HH", header, 26)
+    return info.header_offset + 30 + name_len + extra_len
+
+
+def as_image_source(image):
+    """Accept an ImageSource or a file path; return an ImageSource or None."""
+    if image is None or isinstance(image, ImageSource):
+        return image
+    if not os.path.isfile(image):
+        return None
+    return FileImageSource(image)
+
+
+# ======= Flash history =======
+
+
+def cache_dir() -> str:
+    """Directory for axdl_tool's persistent state ($XDG_CACHE_HOME/axdl_tool)."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "axdl_tool")
+
+
+def device_identity(port, handshake_versions: dict) -> str:
+    """
+    Identify a board from its handshake replies plus its USB serial number.
+    Boards without a serial number fall back to their bus-port path, which
+    only tells boards apart while they stay on the same port (see
+    identity_is_unique).
+    """
+    serial = getattr(port, "serial_number", None)
+    where = f"sn:{serial}" if serial else f"path:{getattr(port, 'path', None)}"
+    versions = "|".join(f"{k}={v}" for k, v in sorted(handshake_versions.items()))
+    return f"{where}|{versions}"
+
+
+def identity_is_unique(device_id: str) -> bool:
+    """True for a device_identity() built on a USB serial number."""
+    return device_id.startswith("sn:")
+
+
+def partition_table_hash(unit: int, partitions: list) -> str:
+    """SHA-256 over the repartition table as it is sent to the device."""
+    table = [unit] + [[p["id"], p["size"], p["gap"]] for p in partitions]
+    return hashlib.sha256(json.dumps(table).encode("utf-8")).hexdigest()
+
+
+class ImageHasher:
+    """
+    SHA-256 of image sources, computed by one background thread in the
+    order they were submitted, so hashing overlaps the ROM/FDL stages.
+    One instance can be shared by every device flashed from the same AXP.
+
+    :param known: Digests already known (name -> hex digest), e.g. from the
+        PlanCache; those images are not read again
+    """
+
+    def __init__(self, known=None):
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._futures = {}
+        for name, digest in (known or {}).items():
+            self._futures[name] = concurrent.futures.Future()
+            self._futures[name].set_result(digest)
+
+    @staticmethod
+    def hash_source(src) -> str:
+        digest = hashlib.sha256()
+        with src.open() as f:
+            while True:
+                block = f.read(1 << 20)
+                if not block:
+                    break
+                digest.update(block)
+        return digest.hexdigest()
+
+    def submit(self, name: str, src):
+        if name not in self._futures:
+            self._futures[name] = self._pool.submit(self.hash_source, src)
+
+    def get(self, name: str):
+        """Wait for and return the hex digest of name, or None if not submitted."""
+        future = self._futures.get(name)
+        return future.result() if future else None
+
+    def digests(self) -> dict:
+        """The digests finished so far, as {name: hex digest}."""
+        return {
+            name: future.result()
+            for name, future in self._futures.items()
+            if future.done() and not future.cancelled() and not future.exception()
+        }
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class JsonStore:
+    """
+    Versioned JSON file in the cache.  Every update re-reads the file under
+    an flock, so several workers and several processes can share one store.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _empty(self) -> dict:
+        return {"version": self.VERSION}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, open(self.path + ".lock", "w") as lockf:
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockf, fcntl.LOCK_UN)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.VERSION:
+                return data
+        except (OSError, ValueError):
+            pass
+        return self._empty()
+
+    def _save(self, data: dict):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class FlashHistory(JsonStore):
+    """
+    Persistent record of what was last written to each device, stored as JSON:
+    {"version": 1, "devices": {identity: {"partition_table": sha256,
+    "partitions": {part_id: {"sha256", "size", "image", "time"}}}}}
+    """
+
+    def _empty(self) -> dict:
+        return {"version": self.VERSION, "devices": {}}
+
+    def device(self, identity: str) -> dict:
+        """Return the stored record of one device (empty if unknown)."""
+        with self._locked():
+            return self._load()["devices"].get(identity, {})
+
+    def _update(self, identity: str, fn):
+        with self._locked():
+            data = self._load()
+            entry = data["devices"].setdefault(
+                identity, {"partition_table": None, "partitions": {}}
+            )
+            fn(entry)
+            self._save(data)
+
+    def set_partition_table(self, identity: str, table_hash: str):
+        """Record the table just written; a different table drops all records."""
+
+        def update(entry):
+            if entry["partition_table"] != table_hash:
+                entry["partitions"] = {}
+            entry["partition_table"] = table_hash
+
+        self._update(identity, update)
+
+    def record(self, identity: str, part_id: str, sha256: str, size: int, image: str):
+        def update(entry):
+            entry["partitions"][part_id] = {
+                "sha256": sha256,
+                "size": size,
+                "image": image,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+
+        self._update(identity, update)
+
+    def forget(self, identity: str, part_id: str):
+        self._update(identity, lambda entry: entry["partitions"].pop(part_id, None))
+
+
+class FdlProfile(JsonStore):
+    """
+    FDL upload settings that worked (or failed) for each uploading stage of
+    a board model, stored as JSON: {"version": 1, "stages": {key:
+    {"chunk_size", "combine", "fallback", "time"}}}, where key is the stage and
+    its handshake version, e.g. "ROM CODE/AX620E ROM CODE", and combine is
+    null until an upload of more than one chunk has probed it.  See
+    AXDLTool.fdl_steps.
+    """
+
+    def _empty(self) -> dict:
+        return {"version": self.VERSION, "stages": {}}
+
+    def get(self, key: str) -> dict:
+        with self._locked():
+            return self._load()["stages"].get(key, {})
+
+    def record(self, key: str, chunk_size: int, combine, fallback=False):
+        """:param fallback: The settings replace ones an upload failed with"""
+        with self._locked():
+            data = self._load()
+            data["stages"][key] = {
+                "chunk_size": chunk_size,
+                "combine": combine,
+                "fallback": fallback,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            self._save(data)
+
+
+# Weight of the newest session in the averages of a ThroughputProfile
+PROFILE_WEIGHT = 0.3
+# Phases that take about as long whatever the AXP (see ThroughputProfile)
+FIXED_PHASES = (
+    "rom-handshake",
+    "eip",
+    "fdl1",
+    "fdl1-handshake",
+    "fdl2",
+    "repartition",
+    "reset",
+)
+
+
+class ThroughputProfile(JsonStore):
+    """
+    How fast each board model (its ROM CODE version) flashes, learnt from
+    the successful sessions of axdl_tool.py, axdl_station.py and
+    axdl_bench.py, stored as JSON: {"version": 1, "models": {model:
+    {"phases": {phase: seconds}, "write_rate", "verify_rate", "erase_rate",
+    "sessions", "time"}}}.  The FIXED_PHASES and "erase" (per ERASE_FLASH)
+    are in seconds, the rates in bytes/s; all are moving averages weighted
+    by PROFILE_WEIGHT.  Sessions on the simulator are kept as "sim:<model>".
+    Used by --plan (see estimate_operations).
+    """
+
+    def _empty(self) -> dict:
+        return {"version": self.VERSION, "models": {}}
+
+    def get(self, model=None) -> tuple:
+        """
+        Return (model, entry) of model, or of the model updated last when
+        None; (model, {}) when there is no such entry.
+        """
+        with self._locked():
+            models = self._load()["models"]
+        if model is None and models:
+            model = max(models, key=lambda m: models[m]["time"])
+        return model, models.get(model, {})
+
+    def record(self, model: str, phases: list, part_sizes: dict):
+        """
+        Fold the phases (PhaseTimer.report()) of one successful session into
+        the entry of model.  part_sizes maps partition ids to their size in
+        bytes (see partition_bytes), for the erase rate.
+        """
+        fixed = {p["name"]: p["wall"] for p in phases if p["name"] in FIXED_PHASES}
+        erases = [p for p in phases if p["name"].startswith("erase:")]
+        if erases:
+            fixed["erase"] = sum(p["wall"] for p in erases) / len(erases)
+        rates = {}
+        for prefix, key in (("image:", "write_rate"), ("verify:", "verify_rate")):
+            done = [p for p in phases if p["name"].startswith(prefix) and p["bytes"]]
+            wall = sum(p["wall"] for p in done)
+            if wall > 0:
+                rates[key] = sum(p["bytes"] for p in done) / wall
+        sized = [
+            (part_sizes.get(p["name"].partition(":")[2]), p["wall"]) for p in erases
+        ]
+        wall = sum(w for n, w in sized if n)
+        if wall > 0:
+            rates["erase_rate"] = sum(n for n, w in sized if n) / wall
+
+        def blend(old, new):
+            return new if old is None else old + (new - old) * PROFILE_WEIGHT
+
+        with self._locked():
+            data = self._load()
+            entry = data["models"].setdefault(model, {"phases": {}, "sessions": 0})
+            for name, wall in fixed.items():
+                entry["phases"][name] = blend(entry["phases"].get(name), wall)
+            for key, rate in rates.items():
+                entry[key] = blend(entry.get(key), rate)
+            entry["sessions"] += 1
+            entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self._save(data)
+
+
+# Reply timeouts learnt by CommandTimeouts: once a command has had
+# TIMEOUT_MIN_SAMPLES replies, its timeout is TIMEOUT_FACTOR times the upper
+# bound of the LATENCY_BUCKETS bucket holding the TIMEOUT_QUANTILE, and at
+# least TIMEOUT_FLOOR ms.
+TIMEOUT_MIN_SAMPLES = 20
+TIMEOUT_QUANTILE = 0.999
+TIMEOUT_FACTOR = 4
+TIMEOUT_FLOOR = 1000
+# Commands whose reply takes time in proportion to the bytes involved (the
+# whole partition, the whole image), which a per-command timeout cannot learn
+TIMEOUT_UNLEARNT = ("ERASE_FLASH", "ENDED_DATA")
+# Replies per command a CommandTimeouts entry stands for; older counts are
+# scaled down past it, so recent sessions weigh most
+TIMEOUT_HISTORY = 10000
+
+
+class CommandTimeouts(JsonStore):
+    """
+    Reply latencies of each command on each board model (its ROM CODE
+    version), learnt from the successful sessions of axdl_tool.py and
+    axdl_station.py, stored as JSON: {"version": 2, "models": {model:
+    {"commands": {"command/window": [count per LATENCY_BUCKETS bucket, then
+    +Inf]}, "sessions", "time"}}}.  Commands are named as by command_name();
+    the TIMEOUT_UNLEARNT ones are left out.  window is the number of such
+    requests the session kept in flight (see AXDLTool.command_windows): a
+    reply queued behind others takes longer.  prefix goes before every
+    model, "sim:" keeps simulator sessions apart.  See AXDLTool.reply_timeout.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path: str, prefix: str = ""):
+        super().__init__(path)
+        self.prefix = prefix
+
+    def _empty(self) -> dict:
+        return {"version": self.VERSION, "models": {}}
+
+    @staticmethod
+    def key(command: str, window: int) -> str:
+        return f"{command}/{window}"
+
+    def record(self, model: str, commands: dict, windows=None):
+        """
+        Fold the command_report() of one successful session into model.
+
+        :param windows: {command: requests in flight} of the session (1 if
+            not given)
+        """
+        windows = windows or {}
+        with self._locked():
+            data = self._load()
+            entry = data["models"].setdefault(
+                self.prefix + model, {"commands": {}, "sessions": 0}
+            )
+            for name, stats in commands.items():
+                if name in TIMEOUT_UNLEARNT:
+                    continue
+                cumulative = list(stats["buckets"].values())
+                counts = [b - a for a, b in zip([0] + cumulative, cumulative)]
+                key = self.key(name, windows.get(name, 1))
+                old = entry["commands"].get(key)
+                if old and len(old) == len(counts):
+                    counts = [a + b for a, b in zip(old, counts)]
+                total = sum(counts)
+                if total > TIMEOUT_HISTORY:
+                    counts = [round(n * TIMEOUT_HISTORY / total, 3) for n in counts]
+                entry["commands"][key] = counts
+            entry["sessions"] += 1
+            entry["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self._save(data)
+
+    def timeouts(self, model: str) -> dict:
+        """
+        Return {key(command, window): timeout in ms} of the commands learnt
+        for model.
+        """
+        with self._locked():
+            entry = self._load()["models"].get(self.prefix + model, {})
+        learnt = {}
+        for name, counts in entry.get("commands", {}).items():
+            total = sum(counts)
+            if total < TIMEOUT_MIN_SAMPLES or name.split("/")[0] in TIMEOUT_UNLEARNT:
+                continue
+            seen = 0
+            # A quantile in the +Inf bucket learns nothing
+            for bound, n in zip(LATENCY_BUCKETS, counts):
+                seen += n
+                if seen >= total * TIMEOUT_QUANTILE:
+                    timeout = round(bound * 1000 * TIMEOUT_FACTOR)
+                    learnt[name] = max(TIMEOUT_FLOOR, timeout)
+                    break
+        return learnt
+
+
+# AXPs whose parsed plan is kept by PlanCache, the least recently used go
+PLAN_CACHE_ENTRIES = 16
+
+
+class PlanCache(JsonStore):
+    """
+    Parsed AXPs, so a release flashed again starts without re-reading its
+    zip directory and XML, stored as JSON: {"version": 1, "plans":
+    {fingerprint: {"files": [{"path", "size", "mtime_ns"}], "cfg",
+    "members", "hashes", "used"}}}.  fingerprint is axp_fingerprint(); an
+    AXP whose path, size and mtime match one of the files of an entry is
+    taken as unchanged, any other one is fingerprinted and then found even
+    if it was copied or renamed.  members
+    holds what ZipMemberImageSource needs of each member and hashes the
+    SHA-256 of images, once a run has computed them.  As the hashes decide
+    what --delta skips, they are only handed out for an AXP whose
+    fingerprint (over the CRC-32 of every member) matches the entry.
+    Bump VERSION when parse_config_xml changes what it returns.
+    """
+
+    def _empty(self) -> dict:
+        return {"version": self.VERSION, "plans": {}}
+
+    @staticmethod
+    def _stat(axp_path: str) -> dict:
+        st = os.stat(axp_path)
+        return {
+            "path": os.path.abspath(axp_path),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+        }
+
+    def lookup(self, axp_path: str, hashes=False):
+        """
+        Return (fingerprint, cfg, image sources, image hashes) of a cached
+        AXP, or None.
+
+        :param hashes: The image hashes will be trusted (--delta): an AXP
+            matched by its path, size and mtime is fingerprinted too, so one
+            rewritten in place without either changing does not take them
+            over.  Otherwise they are {}.
+        """
+        try:
+            stat = self._stat(axp_path)
+        except OSError:
+            return None
+        with self._locked():
+            data = self._load()
+            plans = data["plans"]
+            fingerprint = next(
+                (fp for fp, entry in plans.items() if stat in entry["files"]), None
+            )
+            if fingerprint is not None and hashes:
+                try:
+                    actual = axp_fingerprint(axp_path)
+                except (OSError, zipfile.BadZipFile):
+                    return None
+                if actual != fingerprint:
+                    stale = plans[fingerprint]
+                    stale["files"] = [f for f in stale["files"] if f != stat]
+                    self._save(data)
+                    fingerprint = None
+            if fingerprint is None:
+                try:
+                    fingerprint = axp_fingerprint(axp_path)
+                except (OSError, zipfile.BadZipFile):
+                    return None
+                if fingerprint not in plans:
+                    return None
+            entry = plans[fingerprint]
+            entry["files"] = self._add_file(entry["files"], stat)
+            entry["used"] = time.time()
+            self._save(data)
+        image_sources = {}
+        for name, member in entry["members"].items():
+            filename, crc, size, csize, ctype, header_offset, flags, offset = member
+            info = zipfile.ZipInfo(filename)
+            info.CRC = crc
+            info.file_size = size
+            info.compress_size = csize
+            info.compress_type = ctype
+            info.header_offset = header_offset
+            info.flag_bits = flags
+            image_sources[name] = ZipMemberImageSource(axp_path, info, offset)
+        known = entry["hashes"] if hashes else {}
+        return fingerprint, entry["cfg"], image_sources, known
+
+    @staticmethod
+    def _add_file(files: list, stat: dict) -> list:
+        """files with stat first, replacing an older stat of its path."""
+        others = [f for f in files if f["path"] != stat["path"]]
+        return [stat] + others[: PLAN_CACHE_ENTRIES - 1]
+
+    def store(self, axp_path: str, cfg: dict, image_sources: dict) -> str:
+        """Cache a freshly parsed AXP; returns its fingerprint."""
+        stat = self._stat(axp_path)
+        fingerprint = axp_fingerprint(axp_path)
+        members = {}
+        for name, src in image_sources.items():
+            info = src.info
+            members[name] = [
+                info.filename,
+                info.CRC,
+                info.file_size,
+                info.compress_size,
+                info.compress_type,
+                info.header_offset,
+                info.flag_bits,
+                src.data_offset,
+            ]
+        with self._locked():
+            data = self._load()
+            plans = data["plans"]
+            old = plans.get(fingerprint, {})
+            plans[fingerprint] = {
+                "files": self._add_file(old.get("files", []), stat),
+                "cfg": cfg,
+                "members": members,
+                "hashes": old.get("hashes", {}),
+                "used": time.time(),
+            }
+            for stale in sorted(plans, key=lambda fp: plans[fp]["used"])[
+                : max(0, len(plans) - PLAN_CACHE_ENTRIES)
+            ]:
+                del plans[stale]
+            self._save(data)
+        return fingerprint
+
+    def record_hashes(self, fingerprint: str, hashes: dict):
+        """Add image SHA-256s (name -> hex digest) to a cached AXP."""
+        with self._locked():
+            data = self._load()
+            entry = data["plans"].get(fingerprint)
+            if entry is None or all(
+                entry["hashes"].get(k) == v for k, v in hashes.items()
+            ):
+                return
+            entry["hashes"].update(hashes)
+            self._save(data)
+
+
+# ======= Read-back verification =======
+
+
+def verify_blocks(src, block_size: int) -> list:
+    """
+    Return the (offset, length) blocks, at most block_size long, covering
+    what an image writes to its partition: all of it, or the RAW and FILL
+    extents of a sparse image (which the FDL expands).
+    """
+    if src.sparse:
+        with src.open() as f:
+            extents = data_extents(SparseReader(f))
+    else:
+        extents = [(0, src.size)] if src.size else []
+    return [
+        (pos, min(block_size, offset + length - pos))
+        for offset, length in extents
+        for pos in range(offset, offset + length, block_size)
+    ]
+
+
+def expected_blocks(src, blocks: list):
+    """
+    Yield what the partition should hold in each of blocks (sorted and
+    inside the extents of verify_blocks), streaming the image once.
+    """
+
+    def file_pieces(f):
+        pos = 0
+        for piece in iter(functools.partial(f.read, 1 << 20), b""):
+            yield pos, piece
+            pos += len(piece)
+
+    with src.open() as f:
+        if src.sparse:
+            pieces = iter_expanded(SparseReader(f), verify_crc=False)
+        else:
+            pieces = file_pieces(f)
+        base, buf = 0, b""
+        for offset, length in blocks:
+            parts = []
+            while length:
+                while base + len(buf) <= offset:
+                    piece = next(pieces, None)
+                    if piece is None:
+                        raise ValueError(f"Image ends before offset {offset}.")
+                    base, buf = piece
+                part = buf[offset - base : offset - base + length]
+                parts.append(part)
+                offset += len(part)
+                length -= len(part)
+            yield b"".join(parts)
+
+
+class ReadbackVerifier:
+    """
+    Check the data read back from a partition in a background thread, while
+    the next blocks are on the wire.  Each block is compared with the image
+    (see expected_blocks); when expected_sha256 is given, the SHA-256 of the
+    whole read-back is compared with it instead, so the image is not read a
+    second time.  At most depth blocks are queued.
+    """
+
+    def __init__(self, src, blocks: list, expected_sha256=None, depth=8):
+        self.src = src
+        self.blocks = blocks
+        self.expected_sha256 = expected_sha256
+        self.digest = hashlib.sha256()
+        self.error = None
+        self._queue = queue.Queue(maxsize=max(1, depth))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def feed(self, offset: int, data: bytes):
+        """Queue the read-back data of the next block."""
+        self._queue.put((offset, data))
+
+    def _run(self):
+        expected = None
+        if self.expected_sha256 is None:
+            expected = expected_blocks(self.src, self.blocks)
+        try:
+            for offset, data in iter(self._queue.get, None):
+                if self.error is None:
+                    self._check(expected, offset, data)
+        finally:
+            if expected is not None:
+                expected.close()
+
+    def _check(self, expected, offset: int, data: bytes):
+        self.digest.update(data)
+        if expected is None:
+            return
+        try:
+            want = next(expected)
+        except Exception as e:
+            self.error = f"cannot read the image: {e}"
+            return
+        if data != want:
+            pos = next(
+                (i for i, (a, b) in enumerate(zip(data, want)) if a != b),
+                min(len(data), len(want)),
+            )
+            self.error = f"data differs from the image at offset {offset + pos}"
+
+    def close(self):
+        """Wait for the queued blocks; return the first mismatch found or None."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is None and self.expected_sha256:
+            actual = self.digest.hexdigest()
+            if actual != self.expected_sha256:
+                self.error = (
+                    f"SHA-256 {actual[:16]}... of the read-back differs from "
+                    f"{self.expected_sha256[:16]}... of the image"
+                )
+        return self.error
+
+
+# ======= Session checkpoints =======
+
+
+def axp_fingerprint(axp_path: str) -> str:
+    """
+    SHA-256 over the AXP's central directory entries (name, sizes, CRC-32,
+    offset) and file size: identifies the content without reading it.
+    """
+    digest = hashlib.sha256(str(os.path.getsize(axp_path)).encode("ascii"))
+    with zipfile.ZipFile(axp_path, "r") as zf:
+        for info in zf.infolist():
+            entry = [
+                info.filename,
+                info.CRC,
+                info.file_size,
+                info.compress_size,
+                info.compress_type,
+                info.header_offset,
+            ]
+            digest.update(json.dumps(entry).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class SessionCheckpoint:
+    """
+    Progress of one flash session on one device, written after every
+    finished step so an interrupted flash can be resumed:
+    {"version": 1, "axp": fingerprint, "device": identity,
+    "partition_table": sha256, "repartitioned": bool,
+    "next": index of the first <ImgList> entry not done,
+    "completed": [{"index", "id", "partition", "size", "crc32"}, ...]}
+
+    There is one file per device identity.  It is removed once the whole
+    <ImgList> has been flashed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory: str, identity: str, axp_id: str, table_hash: str):
+        name = hashlib.sha256(identity.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory, f"{name}.json")
+        self.state = {
+            "version": self.VERSION,
+            "axp": axp_id,
+            "device": identity,
+            "partition_table": table_hash,
+            "repartitioned": False,
+            "next": 0,
+            "completed": [],
+        }
+
+    def load(self):
+        """Return the stored checkpoint of this device, or None."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored.get("version") != self.VERSION:
+            return None
+        return stored
+
+    @staticmethod
+    def entry_record(index: int, img: dict, image_sources: dict) -> dict:
+        src = image_sources.get(img["file"]) if img["file"] else None
+        return {
+            "index": index,
+            "id": img["id"],
+            "partition": img["block_id"] if img["block_id"] else img["id"],
+            "size": src.size if src is not None else None,
+            "crc32": src.crc32 if src is not None else None,
+        }
+
+    def resume_from(self, logger, stored, images: list, image_sources: dict):
+        """
+        Take over the progress of a stored checkpoint made with the same AXP,
+        device and partition table.  Entries whose image no longer matches
+        the plan (size, CRC-32) are redone.  Returns True if anything is
+        taken over.
+        """
+        if not stored:
+            logger.info("Resume: no checkpoint for this device.")
+            return False
+        for key in ("axp", "device", "partition_table"):
+            if stored.get(key) != self.state[key]:
+                logger.info(
+                    f"Resume: checkpoint is for a different {key}; ignoring it."
+                )
+                return False
+
+        next_index = min(stored.get("next", 0), len(images))
+        completed = []
+        for rec in stored.get("completed", []):
+            index = rec.get("index")
+            if not isinstance(index, int) or index >= next_index:
+                continue
+            if rec != self.entry_record(index, images[index], image_sources):
+                logger.info(f"Resume: '{rec.get('id')}' changed since the checkpoint.")
+                next_index = index
+                break
+            completed.append(rec)
+        self.state["repartitioned"] = bool(stored.get("repartitioned"))
+        self.state["next"] = next_index
+        self.state["completed"] = [r for r in completed if r["index"] < next_index]
+        done = ", ".join(r["id"] for r in self.state["completed"]) or "none"
+        logger.info(
+            f"Resume: continuing at <ImgList> entry {next_index} (done: {done})."
+        )
+        return True
+
+    def save(self, logger):
+        """Write the checkpoint; failures only cost the ability to resume."""
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write session checkpoint {self.path}: {e}")
+
+    def mark_repartitioned(self, logger):
+        self.state["repartitioned"] = True
+        self.save(logger)
+
+    def mark_done(self, logger, index: int, img: dict, image_sources: dict):
+        self.state["next"] = index + 1
+        self.state["completed"].append(self.entry_record(index, img, image_sources))
+        self.save(logger)
+
+    def clear(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+# ======= ax630tool =======
+
+
+class AXDLGlobData:
+    MAGIC_NUMBER = 0x5C6D8E9F
+
+
+# ======= BSL packet codec =======
+
+# MAGIC(4) + LENGTH(2) + CMD(2), the trailing CRC(2), and a whole MIDST_DATA
+# header packet (Size(4) + Enable(4) + CheckSum(4) payload)
+PACKET_HEAD = struct.Struct("<IHH")
+PACKET_CRC = struct.Struct("<H")
+MIDST_DATA_PACKET = struct.Struct("<IHHIIIH")
+# MAGIC as sent on the wire, to find packet starts in a stream of reads
+PACKET_MAGIC = struct.pack("<I", AXDLGlobData.MAGIC_NUMBER)
+# LENGTH + CMD words of every MIDST_DATA header, as summed by the checksum
+MIDST_DATA_BASE_SUM = MIDST_DATA_PACKET.size - PACKET_HEAD.size - 2 + BSL_CMD_MIDST_DATA
+# Below this size array/sum() beats setting up a NumPy view
+NUMPY_MIN_BYTES = 4096
+# Packets with at most this much payload are built once and cached
+CACHED_PAYLOAD_MAX = 8
+
+_packet_cache = {}
+
+
+def sum16(data) -> int:
+    """
+    Sum of the little-endian 16-bit words of data (a trailing odd byte is
+    added as is), modulo 2**32.  The words are summed in bulk by NumPy when
+    available, else by array/sum(), never in a Python loop.
+    """
+    view = memoryview(data)
+    length = view.nbytes
+    even = length & ~1
+    if numpy is not None and length >= NUMPY_MIN_BYTES:
+        words = numpy.frombuffer(view, dtype="<u2", count=even // 2)
+        total = int(words.sum(dtype=numpy.uint64))
+    else:
+        words = array.array("H")
+        words.frombytes(view[:even])
+        if sys.byteorder == "big":
+            words.byteswap()
+        total = sum(words)
+    if length & 1:
+        total += view[-1]
+    return total & 0xFFFFFFFF
+
+
+def fold16(total: int) -> int:
+    """Fold a word sum to 16 bits (one's complement) and invert it."""
+    while (total >> 16) != 0:
+        total = (total & 0xFFFF) + (total >> 16)
+    return (~total) & 0xFFFF
+
+
+def data_checksum16(data) -> int:
+    """16-bit checksum of data, as AXDLTool.checksum16."""
+    return fold16(sum16(data))
+
+
+def encode_packet(cmd: int, payload=b"") -> bytes:
+    """Build MAGIC(4) + LENGTH(2) + CMD(2) + PAYLOAD + CRC(2)."""
+    length = len(payload)
+    csum = fold16((length + cmd + sum16(payload)) & 0xFFFFFFFF)
+    head = PACKET_HEAD.pack(AXDLGlobData.MAGIC_NUMBER, length, cmd)
+    return b"".join((head, payload, PACKET_CRC.pack(csum)))
+
+
+def midst_header_packet(size: int, enable: int = 0, checksum: int = 0) -> bytes:
+    """
+    BSL_CMD_MIDST_DATA header packet from a fixed template: the checksum is
+    the precomputed LENGTH/CMD sum plus the three payload fields.
+    """
+    total = (
+        MIDST_DATA_BASE_SUM
+        + (size & 0xFFFF)
+        + (size >> 16)
+        + (enable & 0xFFFF)
+        + (enable >> 16)
+        + (checksum & 0xFFFF)
+        + (checksum >> 16)
+    )
+    return MIDST_DATA_PACKET.pack(
+        AXDLGlobData.MAGIC_NUMBER,
+        12,
+        BSL_CMD_MIDST_DATA,
+        size,
+        enable,
+        checksum,
+        fold16(total),
+    )
+
+
+def decode_packet(resp):
+    """
+    Parse raw bytes -> (cmd, payload) or None if invalid.  The payload is a
+    memoryview into resp, so nothing is copied.
+    """
+    if len(resp) < 8:
+        return None
+    magic, length, cmd = PACKET_HEAD.unpack_from(resp, 0)
+    if magic != AXDLGlobData.MAGIC_NUMBER:
+        return None
+    end = 8 + length
+    if len(resp) < end + 2:
+        return None
+    payload = memoryview(resp)[8:end]
+    (csum,) = PACKET_CRC.unpack_from(resp, end)
+    if fold16((length + cmd + sum16(payload)) & 0xFFFFFFFF) != csum:
+        return None
+    return (cmd, payload)
+
+
+class AXDLTool:
+
+    def __init__(
+        self,
+        data_window: int = DEFAULT_DATA_WINDOW,
+        chunk_checksum: bool = False,
+        chunk_retries: int = 0,
+    ):
+        """
+        :param data_window: Number of MIDST_DATA chunks kept in flight while
+            streaming partition images (1 => lock-step, one chunk at a time)
+        :param chunk_checksum: Send each MIDST_DATA chunk with Enable=1 and
+            its checksum16, so the FDL verifies every chunk
+        :param chunk_retries: How often a chunk that gets a NAK or no ACK is
+            re-sent before the partition fails
+        """
+        self.data_window = max(1, data_window)
+        self.chunk_checksum = chunk_checksum
+        self.chunk_retries = max(0, chunk_retries)
+        # Progress bar label prefix and line, used when flashing several boards
+        self.progress_prefix = ""
+        self.progress_position = None
+        self.progress_enabled = True
+        # progress_callback(desc, done, total) replaces the bars when set
+        self.progress_callback = None
+        self.timer = PhaseTimer()
+        # BSL_REP_VER payload of each handshake, by stage name
+        self.handshake_versions = {}
+        # Delta flashing (see FlashHistory): skip images whose SHA-256 matches
+        # the one last written to the same partition of this device.
+        self.history = None
+        self.hasher = None
+        self.device_id = None
+        self.delta = False
+        # Resumable sessions (see SessionCheckpoint): checkpoint_dir enables
+        # them, axp_id is the AXP fingerprint, checkpoint the current session.
+        # force_resume also resumes boards without a serial number.
+        self.checkpoint_dir = None
+        self.axp_id = None
+        self.resume = False
+        self.force_resume = False
+        self.checkpoint = None
+        # Partition-selective flashing (see select_images): partial marks a
+        # run that leaves some partitions alone; force_repartition sends the
+        # table even when the history says the board already has it.
+        self.partial = False
+        self.force_repartition = False
+        # Read-back verification (see verify_steps): verify_samples > 0
+        # checks that many random blocks of each image instead of all of it.
+        self.verify = False
+        self.verify_samples = 0
+        self.rng = random.Random()
+        # FDL uploads are 1000-byte lock-step unless fdl_probe is set; the
+        # probed settings are kept per stage and model (see fdl_steps).
+        self.fdl_profile = None
+        self.fdl_probe = False
+        # BusScheduler shared by the boards of a run, gating the data phases
+        self.scheduler = None
+        # Send images stored uncompressed from a MappedImage (see
+        # image_chunks); drop_page_cache also evicts the pages once sent.
+        self.mmap_images = True
+        self.drop_page_cache = False
+        # (source, chunks, ExitStack) read ahead by prepare_image()
+        self._prepared = None
+        # Reply timeouts learnt per model (see reply_timeout); a reply that
+        # misses one is waited for until the fixed timeout, or with
+        # on_stall == "fail" fails the command.
+        self.command_timeouts = None
+        self.on_stall = "wait"
+        self._timeouts = None  # (model, {command: ms})
+        # Set by a stall that failed its command: the late reply may still
+        # come, so nothing more is sent in the session (no chunk retry)
+        self.stalled = False
+        # Handshake resends (see handshake)
+        self.backoff = Backoff()
+
+    def progress_bar(self, total: int, desc: str):
+        """
+        Create the progress bar of one transfer: a CallbackProgress when
+        progress_callback is set, otherwise a tqdm bar (if tqdm is installed).
+        """
+        if self.progress_callback is not None or tqdm is None:
+            return CallbackProgress(self.progress_callback, desc, total)
+        return tqdm(
+            total=total,
+            unit="B",
+            unit_scale=True,
+            desc=f"{self.progress_prefix}{desc}",
+            position=self.progress_position,
+            disable=not self.progress_enabled,
+        )
+
+    def checksum16(self, data: bytes) -> int:
+        """Compute 16-bit checksum over the given data bytes."""
+        return data_checksum16(data)
+
+    def build_packet(self, cmd: int, payload: bytes = b"") -> bytes:
+        """
+        Build a packet: MAGIC(4) + LENGTH(2) + CMD(2) + PAYLOAD + CRC(2).
+        Fixed packets (CONNECT, ENDED_DATA, RESET, ...) come from a cache.
+        """
+        if len(payload) > CACHED_PAYLOAD_MAX:
+            return encode_packet(cmd, payload)
+        key = (cmd, bytes(payload))
+        pkt = _packet_cache.get(key)
+        if pkt is None:
+            pkt = _packet_cache[key] = encode_packet(cmd, payload)
+        return pkt
+
+    def parse_packet(self, resp: bytes):
+        """
+        Parse the packet from raw bytes -> (cmd, payload) or None if invalid.
+        payload is a memoryview into resp.
+        """
+        return decode_packet(resp)
+
+    def open_axp(self, axp_path: str, logger: logging.Logger):
+        """
+        Index an AXP (zip) without extracting it, returning
+        (xml_content, image_sources) where image_sources maps each member's
+        file name to a ZipMemberImageSource.
+        Only the XML is read into memory here.
+
+        :raises AXPError: if the file is missing, not a zip or has no XML
+        """
+        if not os.path.isfile(axp_path):
+            raise AXPError(f"AXP file not found: {axp_path}")
+        xml_content = None
+        image_sources = {}
+        try:
+            with open(axp_path, "rb") as raw, zipfile.ZipFile(raw, "r") as zip_ref:
+                for file_info in zip_ref.infolist():
+                    if file_info.is_dir():
+                        continue
+                    file_name = os.path.basename(file_info.filename)
+                    try:
+                        data_offset = zip_member_data_offset(raw, file_info)
+                    except zipfile.BadZipFile as e:
+                        logger.warning(f"Skipping AXP member: {e}")
+                        continue
+                    image_sources[file_name] = ZipMemberImageSource(
+                        axp_path, file_info, data_offset
+                    )
+                    if file_name.lower().endswith(".xml"):
+                        xml_content = zip_ref.read(file_info).decode("utf-8")
+        except (OSError, zipfile.BadZipFile, UnicodeDecodeError) as e:
+            raise AXPError(f"Cannot read AXP {axp_path}: {e}") from e
+
+        if not xml_content:
+            raise AXPError("No XML found in AXP.")
+
+        return xml_content, image_sources
+
+    def parse_config_xml(self, xml_str: str, logger: logging.Logger):
+        """
+        Parse the XML to extract:
+        - FDL1 file name & base
+        - FDL2 file name & base
+        - The 'unit' from <Partitions unit="...">
+        - The list of partitions: (id, size, gap)
+        - The full <ImgList> in order (for subsequent downloading)
+        Returns a dict with e.g.:
+        {
+            'fdl1': {'file': 'fdl1.bin', 'base': 0x03000000},
+            'fdl2': {'file': 'fdl2.bin', 'base': 0x5C000000},
+            'unit': 2,
+            'partitions': [
+                {'id': 'spl', 'size': 768, 'gap': 0},
+                ...
+            ],
+            'imglist': [
+                {
+                    'id': 'FDL1',
+                    'file': 'fdl1.bin',
+                    'base': 0x3000000,
+                    'block_id': None or 'somepart',
+                    'select': True/False,
+                    'flag': 3,
+                    'type': 'FDL1'
+                },
+                ...
+            ]
+        }
+
+        :raises AXPError: if the XML is malformed or lacks a required element
+        """
+        try:
+            root = ET.fromstring(xml_str)  # <Config>
+        except ET.ParseError as e:
+            raise AXPError(f"Malformed AXP XML: {e}") from e
+        project = root.find("Project")
+        if project is None:
+            raise AXPError("No <Project> in XML.")
+
+        # Partitions
+        partitions_elem = project.find("Partitions")
+        if partitions_elem is None:
+            raise AXPError("No <Partitions> in XML.")
+        # read 'unit' from <Partitions unit="...">
+        str_unit = partitions_elem.get("unit", "2")
+        unit = int(str_unit, 0)  # parse as decimal or hex
+
+        # gather partition info
+        partition_list = []
+        for pe in partitions_elem.findall("Partition"):
+            pid = pe.get("id", "")
+            psize = int(pe.get("size", "0"), 0)
+            pgap = int(pe.get("gap", "0"), 0)
+            partition_list.append({"id": pid, "size": psize, "gap": pgap})
+
+        # parse <ImgList>
+        img_list_elem = project.find("ImgList")
+        if img_list_elem is None:
+            raise AXPError("No <ImgList> in XML.")
+
+        # placeholders
+        fdl1_info = {"file": None, "base": None}
+        fdl2_info = {"file": None, "base": None}
+        eip_info = {"file": None, "base": None}
+        full_img_list = []
+
+        for img_elem in img_list_elem.findall("Img"):
+            id_node = img_elem.find("ID")
+            file_node = img_elem.find("File")
+            block_elem = img_elem.find("Block")
+
+            if id_node is None:
+                continue
+            img_id = id_node.text.strip() if id_node.text else ""
+            fname = (
+                file_node.text.strip()
+                if (file_node is not None and file_node.text)
+                else ""
+            )
+            flag_str = img_elem.get("flag", "0")
+            select_str = img_elem.get("select", "0")
+            # parse base from <Block><Base>0x3000000</Base></Block> if present
+            base_addr = 0
+            block_id = None
+            if block_elem is not None:
+                base_text = block_elem.findtext("Base", "0")
+                block_id = block_elem.get("id", None)
+                if base_text.startswith("0x") or base_text.startswith("0X"):
+                    base_addr = int(base_text, 16)
+                else:
+                    base_addr = int(base_text)
+
+            # catch EIP / FDL1 / FDL2 specifically
+            if img_id == "FDL1":
+                fdl1_info["file"] = fname
+                fdl1_info["base"] = base_addr
+            elif img_id == "FDL2":
+                fdl2_info["file"] = fname
+                fdl2_info["base"] = base_addr
+            elif img_id == "EIP":
+                eip_info["file"] = fname
+                eip_info["base"] = base_addr
+            else:
+                # store
+                one_img = {
+                    "id": img_id,
+                    "file": fname,
+                    "base": base_addr,
+                    "block_id": block_id,
+                    "flag": int(flag_str),
+                    "select": (select_str == "1"),
+                    "type": img_elem.findtext("Type", "").strip(),
+                }
+                full_img_list.append(one_img)
+
+        if not fdl1_info["file"] or fdl1_info["base"] is None:
+            raise AXPError("FDL1 (file/base) not properly found in XML.")
+        if not fdl2_info["file"] or fdl2_info["base"] is None:
+            raise AXPError("FDL2 (file/base) not properly found in XML.")
+
+        return {
+            "fdl1": fdl1_info,
+            "fdl2": fdl2_info,
+            "eip": eip_info,
+            "unit": unit,
+            "partitions": partition_list,
+            "imglist": full_img_list,
+        }
+
+    def handshake(self, port, logger, stage_name="ROM CODE") -> str:
+        """Run handshake_steps() on a blocking port."""
+        return run_steps(self.handshake_steps(logger, stage_name), port, self)
+
+    def handshake_steps(self, logger, stage_name="ROM CODE"):
+        """
+        Repeatedly send 0x3C until receiving BSL_REP_VER; return the version
+        ("" if there was none).  Each read returns as soon as the reply is
+        in; 0x3C is sent again after each delay of self.backoff (at least
+        HANDSHAKE_MIN_WAIT ms) without one (a stage still starting drops
+        it), for up to HANDSHAKE_TIMEOUT seconds.  The replies to resends
+        that were not lost are skipped by connect_steps.  The wait is timed
+        as the phase "ready:<stage_name>".
+        """
+        with self.timer.phase(f"ready:{stage_name}"):
+            deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+            for attempt, delay in enumerate(self.backoff.delays()):
+                if attempt:
+                    self.timer.count_retry()
+                yield PortWrite(bytes([CMD_HANDSHAKE_BYTE] * 3))
+                parsed = yield PortPacket(max(HANDSHAKE_MIN_WAIT, round(delay * 1000)))
+                if parsed and parsed[0] == BSL_REP_VER:
+                    version = bytes(parsed[1]).decode("utf-8", errors="ignore")
+                    self.handshake_versions[stage_name] = version
+                    logger.info(f"{stage_name} handshake success. ({version})")
+                    return version
+                if not parsed:
+                    logger.debug(
+                        f"{stage_name} handshake attempt {attempt+1}: no data."
+                    )
+                if time.monotonic() >= deadline:
+                    return ""
+
+    def cmd_connect(self, port, logger):
+        """Run connect_steps() on a blocking port."""
+        return run_steps(self.connect_steps(logger), port, self)
+
+    def connect_steps(self, logger):
+        """
+        Send BSL_CMD_CONNECT -> expect ACK.  BSL_REP_VERs before it answer
+        0x3C resent during the handshake (see handshake_steps) and are
+        skipped.
+        """
+        yield PortWrite(self.build_packet(BSL_CMD_CONNECT))
+        parsed = yield PortPacket(120000)
+        stale = 0
+        while parsed and parsed[0] == BSL_REP_VER:
+            stale += 1
+            parsed = yield PortPacket(120000)
+        if stale:
+            logger.debug(f"Skipped {stale} BSL_REP_VER(s) of resent handshakes.")
+        if parsed and parsed[0] == BSL_REP_ACK:
+            logger.info("BSL_CMD_CONNECT -> ACK")
+            return True
+        logger.error("BSL_CMD_CONNECT -> no ACK")
+        return False
+
+    @staticmethod
+    def fdl_start_payload(stage_name: str, base_addr: int, size: int):
+        """START_DATA payload of an FDL upload, or None for an unknown stage."""
+        if stage_name == "FDL1":
+            return struct.pack("<II", base_addr, size)
+        if stage_name == "FDL2":
+            return struct.pack("<QQ", base_addr, size)
+        return None
+
+    def download_fdl(
+        self, port, logger, fdl, base_addr: int, stage_name="FDL?"
+    ) -> bool:
+        """Run fdl_steps() on a blocking port."""
+        return run_steps(self.fdl_steps(logger, fdl, base_addr, stage_name), port, self)
+
+    def fdl_steps(self, logger, fdl, base_addr: int, stage_name="FDL?"):
+        """
+        Download an FDL via (START_DATA -> chunked -> ENDED_DATA -> EXEC_DATA).
+
+        Chunks are FDL_LEGACY_CHUNK bytes, each header and its data sent
+        (and ACKed) separately.  With fdl_probe they are as large as the
+        running stage takes: MIDST_DATA headers are tried with the sizes of
+        FDL_CHUNK_SIZES from the largest down, and a refused header (any
+        reply but ACK, or none) just moves on to the next size.  The second
+        chunk is then sent with its header in one transfer.  Data is never
+        sent twice, as the stage may have taken it: if its ACK does not come
+        (the stage dropped the data), the upload fails and the next one
+        falls back to lock-step FDL_LEGACY_CHUNK chunks.  See
+        fdl_upload_plan for how the outcome is kept per stage.
+
+        :param fdl: ImageSource or file path of the FDL blob
+        """
+        fdl_src = as_image_source(fdl)
+        if fdl_src is None:
+            logger.error(f"File not found: {fdl}")
+            return False
+        size = fdl_src.size
+        logger.info(
+            f"Downloading {stage_name} from {fdl_src.name}, size={size} bytes, base=0x{base_addr:X}"
+        )
+
+        # Send BSL_CMD_START_DATA
+        start_payload = self.fdl_start_payload(stage_name, base_addr, size)
+        if start_payload is None:
+            logger.error(f"Unknown stage name for FDL download: {stage_name}")
+            return False
+        yield PortWrite(self.build_packet(BSL_CMD_START_DATA, start_payload))
+        parsed = yield PortPacket(120000)
+        if not (parsed and parsed[0] == BSL_REP_ACK):
+            logger.error(f"No ACK after START_DATA for {stage_name}.")
+            return False
+
+        key, sizes, combine = self.fdl_upload_plan(stage_name)
+        with fdl_src.open() as f:
+            blob = f.read()  # FDLs are a few hundred KB
+        pbar = self.progress_bar(size, stage_name)
+        started = time.monotonic()
+        size_known = len(sizes) == 1
+        pos = 0
+        while pos < size:
+            n = min(sizes[0], size - pos)
+            chunk = blob[pos : pos + n]
+            # BSL_CMD_MIDST_DATA with Enable=0 and CheckSum=0
+            header = midst_header_packet(n)
+            together = size_known and combine is not False
+            if not together:
+                yield PortWrite(header)
+                parsed = yield PortPacket(FDL_HEADER_TIMEOUT)
+                acked = parsed and parsed[0] == BSL_REP_ACK
+                if not acked and not size_known and len(sizes) > 1:
+                    logger.debug(
+                        f"{stage_name}: {n}-byte chunks refused "
+                        f"({self.describe_reply(parsed)}); trying smaller ones."
+                    )
+                    sizes.pop(0)
+                    if not parsed:
+                        # A late reply must not answer the next header
+                        yield PortDrain()
+                    continue
+                if not acked:
+                    logger.error(f"No ACK after MIDST_DATA header for {stage_name}.")
+                    return False
+                size_known = True
+                del sizes[1:]
+                yield PortWrite(chunk)
+            else:
+                yield PortWrite(header + chunk)
+                parsed = yield PortPacket(FDL_HEADER_TIMEOUT)
+                if not (parsed and parsed[0] == BSL_REP_ACK):
+                    logger.error(f"No ACK after MIDST_DATA header for {stage_name}.")
+                    return False
+            data_reply = yield PortPacket(FDL_DATA_TIMEOUT)
+            if not (data_reply and data_reply[0] == BSL_REP_ACK):
+                logger.error(f"No ACK after data chunk for {stage_name}.")
+                self.fdl_upload_failed(logger, key, stage_name, sizes[0], combine)
+                return False
+            if together:
+                # The data sent in the header's transfer was taken
+                combine = True
+            pos += n
+            pbar.update(n)
+
+        pbar.close()
+        self.fdl_upload_done(
+            logger, key, stage_name, sizes[0], combine, time.monotonic() - started
+        )
 
         # BSL_CMD_ENDED_DATA
-        pkt_end = self.build_packet(BSL_CMD_ENDED_DATA)
-        port.write(pkt_end)
-        resp = port.read(512)
-        parsed = self.parse_packet(resp)
+        yield PortWrite(self.build_packet(BSL_CMD_ENDED_DATA))
+        parsed = yield PortPacket(120000)
         if not (parsed and parsed[0] == BSL_REP_ACK):
             logger.error(f"No ACK after ENDED_DATA for {stage_name}, retrying.")
             return False
 
-        logger.info(f"{stage_name} download complete.")
+        logger.info(f"{stage_name} download complete.")
+
+        # EXEC_DATA => run this FDL
+        yield PortWrite(self.build_packet(BSL_CMD_EXEC_DATA))
+        parsed = yield PortPacket(3000)
+        if not (parsed and parsed[0] == BSL_REP_ACK):
+            logger.error(f"EXEC_DATA no ACK from {stage_name}.")
+            return False
+
+        logger.info(f"{stage_name} is now running.")
+        return True
+
+    def fdl_upload_plan(self, stage_name: str) -> tuple:
+        """
+        Return (key, chunk sizes to try, combine) for uploading stage_name.
+        key names the uploading stage and its handshake version in
+        self.fdl_profile; what that holds is used instead of probing.
+        combine is None while it is still to be probed.
+        """
+        uploader = FDL_UPLOADER.get(stage_name, stage_name)
+        key = f"{uploader}/{self.handshake_versions.get(uploader, '')}"
+        if not self.fdl_probe:
+            return key, [FDL_LEGACY_CHUNK], False
+        known = self.fdl_profile.get(key) if self.fdl_profile else {}
+        if known.get("chunk_size"):
+            return key, [known["chunk_size"]], known["combine"]
+        return key, list(FDL_CHUNK_SIZES), None
+
+    def fdl_upload_done(self, logger, key, stage_name, chunk_size, combine, seconds):
+        """Log and store the settings of a finished FDL upload."""
+        logger.debug(
+            f"{stage_name} uploaded in {chunk_size}-byte chunks"
+            f"{', header and data combined' if combine else ''} in {seconds:.3f}s."
+        )
+        if self.fdl_profile and self.fdl_probe:
+            known = self.fdl_profile.get(key)
+            if known.get("chunk_size") != chunk_size or known.get("combine") != combine:
+                self.fdl_profile.record(key, chunk_size, combine)
+
+    def fdl_upload_failed(self, logger, key, stage_name, chunk_size, combine):
+        """After a data chunk failed, store the legacy settings for the next try."""
+        if not self.fdl_profile or not self.fdl_probe:
+            return
+        if chunk_size == FDL_LEGACY_CHUNK and combine is False:
+            return
+        self.fdl_profile.record(key, FDL_LEGACY_CHUNK, False, fallback=True)
+        logger.warning(
+            f"{stage_name} upload failed with {chunk_size}-byte chunks; "
+            f"the next attempt uses {FDL_LEGACY_CHUNK}-byte chunks."
+        )
+
+    def str_to_unicode_le(self, s: str, max_chars=36):
+        """
+        Encode a python string as little-endian UTF-16, padded/truncated to max_chars,
+        returning the raw bytes. The doc requires wchar_t[36].
+        """
+        # Truncate if needed
+        s = s[:max_chars]
+        encoded = s.encode("utf-16-le")  # 2 bytes per char
+        # We need exactly max_chars * 2 bytes, pad with zeros if short
+        needed = max_chars * 2
+        if len(encoded) < needed:
+            encoded += b"\x00" * (needed - len(encoded))
+        return encoded
+
+    def repartition(self, port, logger, unit: int, partitions: list):
+        """
+        Sends BSL_CMD_REPARTITION(0x0B) with PARTITION_HEAD + PARTITION_BODY[].
+        struct PARTITION_HEAD {
+        uint32 magic=0x3A726170; // "par:"
+        uint8  version=1;
+        uint8  unit;
+        uint16 count; // number of PARTITION_BODY entries
+        }
+        struct PARTITION_BODY {
+        wchar_t id[36]; // partition name in UTF-16-LE
+        int64   size;   // final size in "unit" multiples
+        int64   gap;    // typically 0
+        }
+        """
+        return run_steps(self.repartition_steps(logger, unit, partitions), port, self)
+
+    def repartition_steps(self, logger, unit: int, partitions: list):
+        """Send the partition table (see repartition) -> expect ACK."""
+        count = len(partitions)
+        payload = self.repartition_payload(logger, unit, partitions)
+        yield PortWrite(self.build_packet(BSL_CMD_REPARTITION, payload))
+        parsed = yield PortPacket(3000)
+        if not parsed or parsed[0] != BSL_REP_ACK:
+            logger.error("BSL_CMD_REPARTITION -> no ACK.")
+            return False
+
+        logger.info(f"Repartition done. (#Partitions: {count}, unit={unit})")
+        return True
+
+    def repartition_payload(self, logger, unit: int, partitions: list) -> bytes:
+        """PARTITION_HEAD + PARTITION_BODY[] (see repartition)."""
+        MAGIC = PARTITION_MAGIC
+        version = 1
+        count = len(partitions)
+
+        # Print head and each parition info
+        logger.debug(
+            f"PARTITION_HEAD: MAGIC=0x{MAGIC:08X}, version={version}, unit={unit}, count={count}"
+        )
+        for p in partitions:
+            logger.debug(
+                f"PARTITION_BODY: id={p['id']}, size={p['size']}, gap={p['gap']}"
+            )
+
+        # Build PARTITION_HEAD
+        part_head = struct.pack("<IBBH", MAGIC, version, unit, count)
+
+        # Build array of PARTITION_BODY
+        body_bytes = b""
+        for p in partitions:
+            name_bytes = self.str_to_unicode_le(p["id"])
+            p_size = p["size"]
+            p_gap = p["gap"]
+            body_bytes += name_bytes
+            body_bytes += struct.pack("<qq", p_size, p_gap)
+
+        return part_head + body_bytes
+
+    def start_data_cmd(self, port, logger, part_id: str, file_size: int):
+        """
+        BSL_CMD_START_DATA(0x01)
+        Payload:
+        - Id(72 bytes, unicode)
+        - Size(8 bytes)
+        - Reserved(8 bytes=0)
+        """
+        return run_steps(self.start_data_steps(logger, part_id, file_size), port, self)
+
+    def start_data_steps(self, logger, part_id: str, file_size: int):
+        """Send START_DATA for a partition (see start_data_cmd) -> expect ACK."""
+        payload = self.start_data_payload(part_id, file_size)
+        yield PortWrite(self.build_packet(BSL_CMD_START_DATA, payload))
+        parsed = yield PortPacket(2000)
+        if not parsed or parsed[0] != BSL_REP_ACK:
+            logger.error(f"No ACK after START_DATA for partition '{part_id}'.")
+            return False
+        return True
+
+    def start_data_payload(self, part_id: str, file_size: int) -> bytes:
+        """START_DATA payload of a partition download (see start_data_cmd)."""
+        name_bytes = self.str_to_unicode_le(
+            part_id, max_chars=36
+        )  # 36 wide-chars => 72 bytes
+        return (
+            name_bytes
+            + struct.pack("<Q", file_size)  # 8 bytes
+            + struct.pack("<Q", 0)  # 8 bytes reserved
+        )
+
+    def send_data_chunks(self, port, logger, image, part_name: str):
+        """Run data_chunks_steps() on a blocking port."""
+        return run_steps(self.data_chunks_steps(logger, image, part_name), port, self)
+
+    def data_chunks_steps(self, logger, image, part_name: str):
+        """
+        Repeatedly send BSL_CMD_MIDST_DATA(0x02) -> {data}, until file is done.
+
+        :param image: ImageSource (e.g. a member of the AXP) or file path
+
+        Chunks come from image_chunks().  With data_window > 1 the header and payload of up to data_window chunks are
+        written before their ACKs are collected; the two ACKs of each chunk are
+        then matched back in order.  data_window == 1 keeps the lock-step
+        exchange for FDL builds that cannot buffer outstanding chunks.
+        Chunk retries also use the lock-step exchange: a re-sent chunk must
+        not have later chunks in flight behind it.
+        Android sparse images are cut at their chunk boundaries instead of
+        every DATA_CHUNK_SIZE bytes.
+        """
+        src = as_image_source(image)
+        if src is None:
+            logger.error(f"File not found: {image}")
+            return False
+
+        size = src.size
+        chunk_size = DATA_CHUNK_SIZE
+        window = self.command_windows()["DATA"]
+        sparse = src.sparse
+        if sparse:
+            logger.debug(f"'{part_name}' is a sparse image; aligning transfers.")
+        pbar = self.progress_bar(size, part_name)
+
+        # Chunks still queued on an async port must stay mapped
+        with self.image_chunks(
+            src, chunk_size, window + 1, keep=window * chunk_size
+        ) as chunks:
+            if window > 1:
+                ok = yield from self._send_chunks_windowed(
+                    logger, chunks, part_name, window, pbar
+                )
+            else:
+                ok = yield from self._send_chunks_lockstep(
+                    logger, chunks, part_name, pbar
+                )
+
+        pbar.close()
+        return ok
+
+    @contextlib.contextmanager
+    def image_chunks(self, src, chunk_size: int, depth: int, keep: int = 0):
+        """
+        Iterator over the MIDST_DATA transfers of src (see image_transfers):
+        memoryview slices of a MappedImage when the image is stored
+        uncompressed and mmap_images is set, else chunks read ahead by a
+        ChunkPrefetcher up to depth chunks.  keep is passed to
+        MappedImage.chunks().
+        """
+        prepared, self._prepared = self._prepared, None
+        if prepared is not None:
+            if prepared[0] is src:
+                with prepared[2]:
+                    yield prepared[1]
+                return
+            prepared[2].close()
+        mapped = None
+        if self.mmap_images and not src.sparse:
+            mapped = src.map(drop_cache=self.drop_page_cache)
+        if mapped is not None:
+            with mapped:
+                yield mapped.chunks(chunk_size, keep)
+            return
+        with src.open() as f, ChunkPrefetcher(
+            f,
+            chunk_size,
+            depth=depth,
+            chunks=image_transfers(f, chunk_size, src.sparse),
+        ) as chunks:
+            yield iter(chunks)
+
+    def midst_data_packet(self, chunk) -> bytes:
+        """
+        BSL_CMD_MIDST_DATA(0x02) payload => Size(4) + Enable(4) + CheckSum(4).
+        Without chunk_checksum: "Enable=0" => no sub-chunk checksumming,
+        then "CheckSum=0".
+        """
+        if self.chunk_checksum:
+            return midst_header_packet(len(chunk), 1, data_checksum16(chunk))
+        return midst_header_packet(len(chunk))
+
+    def command_windows(self) -> dict:
+        """
+        {command: requests kept in flight} of the windowed transfers: image
+        data chunks (lock-step with chunk retries) and read-back.  Other
+        commands go one at a time.
+        """
+        window = 1 if self.chunk_retries else self.data_window
+        return {
+            "MIDST_DATA": window,
+            "DATA": window,
+            "READ_FLASH_MIDST": self.data_window,
+        }
+
+    def reply_timeout(self, command: str, default: int) -> int:
+        """
+        Milliseconds to wait for the reply to command (see command_name()):
+        the timeout learnt for the board model and the window of command
+        (see command_windows) in command_timeouts, if any and shorter than
+        default, else default.
+        """
+        model = self.handshake_versions.get("ROM CODE")
+        if self.command_timeouts is None or not model:
+            return default
+        if self._timeouts is None or self._timeouts[0] != model:
+            self._timeouts = (model, self.command_timeouts.timeouts(model))
+        key = CommandTimeouts.key(command, self.command_windows().get(command, 1))
+        return min(default, self._timeouts[1].get(key, default))
+
+    def stall_wait(self, logger, command: str, timeout: int, default: int) -> int:
+        """
+        Report a reply to command missing its learnt timeout; return the
+        milliseconds still to wait for it (0 unless on_stall is "wait").
+        """
+        if self.on_stall == "wait":
+            logger.warning(
+                f"No reply to {command} within its learnt {timeout} ms; "
+                f"waiting up to {default} ms."
+            )
+            return default - timeout
+        logger.warning(
+            f"No reply to {command} within its learnt {timeout} ms; "
+            "the board stalled."
+        )
+        self.stalled = True
+        return 0
+
+    def reply_steps(self, logger, command: str, default: int, read_size=512):
+        """
+        Return the reply to command, waited for with the timeout from
+        reply_timeout().  A wait that times out on a learnt timeout is a
+        stall, see stall_wait().
+        """
+        timeout = self.reply_timeout(command, default)
+        start = time.monotonic()
+        reply = yield PortPacket(timeout, read_size)
+        if reply or timeout >= default or time.monotonic() - start < timeout / 1000:
+            return reply
+        rest = self.stall_wait(logger, command, timeout, default)
+        return (yield PortPacket(rest, read_size)) if rest else reply
+
+    @staticmethod
+    def describe_reply(parsed) -> str:
+        """Short reason for a missing ACK, for log messages."""
+        if not parsed:
+            return "timeout"
+        return f"reply 0x{parsed[0]:02X}"
+
+    def _send_chunk_once(self, logger, chunk):
+        """Send one chunk lock-step; return None on success, else the error."""
+        yield PortWrite(self.midst_data_packet(chunk))
+        parsed = yield from self.reply_steps(logger, "MIDST_DATA", 5000)
+        if not (parsed and parsed[0] == BSL_REP_ACK):
+            return f"No ACK after MIDST_DATA header ({self.describe_reply(parsed)})"
+
+        # Now send the actual chunk
+        yield PortWrite(chunk)
+        parsed = yield from self.reply_steps(logger, "DATA", 120000)
+        if not (parsed and parsed[0] == BSL_REP_ACK):
+            return f"No ACK after data chunk ({self.describe_reply(parsed)})"
+        return None
+
+    def _send_chunks_lockstep(self, logger, chunks, part_name: str, pbar):
+        """
+        Send chunk by chunk.  A chunk that fails is re-sent (header and data)
+        up to chunk_retries times; the FDL only advances past ACKed chunks.
+        """
+        index = 0
+        while True:
+            chunk = yield BlockingCall(next, (chunks, b""))
+            if not chunk:
+                return True
+            attempt = 0
+            while True:
+                error = yield from self._send_chunk_once(logger, chunk)
+                if error is None:
+                    break
+                if attempt >= self.chunk_retries or self.stalled:
+                    retried = f" after {attempt} retries" if attempt else ""
+                    logger.error(
+                        f"{error} for partition '{part_name}', chunk {index}{retried}."
+                    )
+                    return False
+                attempt += 1
+                self.timer.count_retry()
+                logger.warning(
+                    f"{error} for partition '{part_name}', chunk {index}; "
+                    f"retrying ({attempt}/{self.chunk_retries})."
+                )
+                # Discard late replies of the failed exchange
+                yield PortDrain()
+
+            pbar.update(len(chunk))
+            index += 1
+
+    def _send_chunks_windowed(self, logger, chunks, part_name: str, window: int, pbar):
+        in_flight = collections.deque()
+
+        def collect_oldest():
+            length, writes = in_flight.popleft()
+            # A failed write fails the chunk now rather than after an ACK timeout
+            yield PortSent(writes)
+            # Each chunk is answered twice: once for the header, once for the data.
+            for what, command in (
+                ("MIDST_DATA header", "MIDST_DATA"),
+                ("data chunk", "DATA"),
+            ):
+                parsed = yield from self.reply_steps(logger, command, 120000)
+                if not (parsed and parsed[0] == BSL_REP_ACK):
+                    logger.error(
+                        f"No ACK after {what} for partition '{part_name}' "
+                        f"({self.describe_reply(parsed)}, "
+                        f"{len(in_flight) + 1} chunk(s) in flight)."
+                    )
+                    return False
+            pbar.update(length)
+            return True
+
+        while True:
+            chunk = yield BlockingCall(next, (chunks, b""))
+            if not chunk:
+                break
+            header = yield PortSend(self.midst_data_packet(chunk))
+            # The device may still be flashing earlier chunks, so allow the
+            # OUT transfer the fixed ACK timeout: a held-up write is not a
+            # missing reply, so a learnt timeout never applies to it.
+            data = yield PortSend(chunk, 120000)
+            in_flight.append((len(chunk), (header, data)))
+            if len(in_flight) >= window and not (yield from collect_oldest()):
+                return False
+
+        while in_flight:
+            if not (yield from collect_oldest()):
+                return False
+        return True
+
+    def ended_data_cmd(self, port, logger, part_id: str):
+        """Run ended_data_steps() on a blocking port."""
+        return run_steps(self.ended_data_steps(logger, part_id), port, self)
+
+    def ended_data_steps(self, logger, part_id: str):
+        """
+        BSL_CMD_ENDED_DATA(0x03) => finalize.
+        """
+        yield PortWrite(self.build_packet(BSL_CMD_ENDED_DATA))
+        parsed = yield from self.reply_steps(logger, "ENDED_DATA", 120000)
+        if not (parsed and parsed[0] == BSL_REP_ACK):
+            logger.error(f"No ACK after ENDED_DATA for '{part_id}'.")
+            return False
+        else:
+            return True
+
+    def erase_partition(self, port, logger, part_id: str):
+        """Run erase_steps() on a blocking port."""
+        return run_steps(self.erase_steps(logger, part_id), port, self)
+
+    def erase_steps(self, logger, part_id: str):
+        """
+        Example of using BSL_CMD_ERASE_FLASH(0x0A) to erase a partition by name.
+        According to the doc:
+        Payload:
+            - Flag(8) = 0 => partial erase
+            - Id(72) = partition name in unicode
+            - Size(8) => portion to erase; 0 => entire partition
+        """
+        logger.info(f"Erasing partition '{part_id}' ...")
+        yield PortWrite(
+            self.build_packet(BSL_CMD_ERASE_FLASH, self.erase_payload(part_id))
+        )
+        parsed = yield from self.reply_steps(logger, "ERASE_FLASH", 120000)
+        if not parsed or parsed[0] != BSL_REP_ACK:
+            logger.error(f"No ACK after erase partition '{part_id}'.")
+            return False
+        logger.info(f"Partition '{part_id}' erased.")
+        return True
+
+    def erase_payload(self, part_id: str) -> bytes:
+        """ERASE_FLASH payload erasing a whole partition (see erase_steps)."""
+        name_bytes = self.str_to_unicode_le(part_id, 36)
+        return struct.pack("<Q", 0) + name_bytes + struct.pack("<Q", 0)
+
+    def read_flash_steps(self, logger, part_id: str, blocks: list, consume):
+        """
+        Read blocks of a partition back through the FDL:
+        BSL_CMD_READ_FLASH_START(0x10), payload as START_DATA with
+        Size = end of the last block; then per block
+        BSL_CMD_READ_FLASH_MIDST(0x11), payload Size(4) + Offset(8), answered
+        by BSL_REP_FLASH_DATA(0x93) carrying the data; then
+        BSL_CMD_READ_FLASH_END(0x12).  Up to data_window requests are kept in
+        flight; consume(offset, data) gets each block in order.
+        """
+        size = blocks[-1][0] + blocks[-1][1] if blocks else 0
+        yield PortWrite(
+            self.build_packet(
+                BSL_CMD_READ_FLASH_START, self.start_data_payload(part_id, size)
+            )
+        )
+        parsed = yield PortPacket(2000)
+        if not parsed or parsed[0] != BSL_REP_ACK:
+            logger.error(
+                f"No ACK after READ_FLASH_START for partition '{part_id}' "
+                f"({self.describe_reply(parsed)}); does the FDL support reading?"
+            )
+            return False
+
+        read_size = READ_CHUNK_SIZE + 12
+        pending = collections.deque()
+
+        def collect_oldest():
+            offset, length, write = pending.popleft()
+            yield PortSent((write,))
+            parsed = yield from self.reply_steps(
+                logger, "READ_FLASH_MIDST", 30000, read_size
+            )
+            if (
+                not parsed
+                or parsed[0] != BSL_REP_FLASH_DATA
+                or len(parsed[1]) != length
+            ):
+                logger.error(
+                    f"Bad READ_FLASH_MIDST reply for '{part_id}' at offset "
+                    f"{offset} ({self.describe_reply(parsed)})."
+                )
+                return False
+            # May wait for the verifier thread
+            yield BlockingCall(consume, (offset, parsed[1]))
+            return True
+
+        for offset, length in blocks:
+            write = yield PortSend(
+                self.build_packet(
+                    BSL_CMD_READ_FLASH_MIDST, struct.pack("<IQ", length, offset)
+                )
+            )
+            pending.append((offset, length, write))
+            if len(pending) >= self.data_window and not (yield from collect_oldest()):
+                return False
+        while pending:
+            if not (yield from collect_oldest()):
+                return False
+
+        yield PortWrite(self.build_packet(BSL_CMD_READ_FLASH_END))
+        parsed = yield PortPacket(2000, read_size)
+        if not parsed or parsed[0] != BSL_REP_ACK:
+            logger.error(f"No ACK after READ_FLASH_END for partition '{part_id}'.")
+            return False
+        return True
+
+    def verify_steps(self, logger, img: dict, part_id: str, src):
+        """
+        Read back the partition just written from src and compare it with the
+        image in a ReadbackVerifier thread.  With verify_samples only that
+        many random blocks are read; otherwise all of it, checked against the
+        image's SHA-256 from self.hasher when there is one.
+        """
+        # Waits for the background image hash
+        blocks, expected_sha256 = yield BlockingCall(self.verify_plan, (img, src))
+        if not blocks:
+            return True
+        nbytes = sum(length for _, length in blocks)
+        verifier = ReadbackVerifier(src, blocks, expected_sha256)
+        with self.timer.phase(f"verify:{img['id']}", nbytes=nbytes):
+            try:
+                ok = yield from self.read_flash_steps(
+                    logger, part_id, blocks, verifier.feed
+                )
+            except BaseException:
+                verifier.close()
+                raise
+            error = yield BlockingCall(verifier.close)
+        return ok and self.verify_done(logger, img["id"], blocks, error)
+
+    def verify_plan(self, img: dict, src) -> tuple:
+        """Return the blocks verify_steps reads and the SHA-256 they must have."""
+        blocks = verify_blocks(src, READ_CHUNK_SIZE)
+        if self.verify_samples:
+            count = min(self.verify_samples, len(blocks))
+            return sorted(self.rng.sample(blocks, count)), None
+        if self.hasher and not src.sparse:
+            return blocks, self.hasher.get(img["file"])
+        return blocks, None
+
+    def verify_done(self, logger, img_id: str, blocks: list, error) -> bool:
+        """Log the outcome of a read-back verification."""
+        if error:
+            logger.error(f"Read-back verification of '{img_id}' failed: {error}.")
+            return False
+        if self.verify_samples:
+            logger.info(f"Verified '{img_id}': {len(blocks)} random blocks match.")
+        else:
+            nbytes = sum(length for _, length in blocks)
+            logger.info(f"Verified '{img_id}': {nbytes} bytes read back match.")
+        return True
+
+    def download_images(
+        self, port, logger, images: list, image_sources: dict, start: int = 0
+    ):
+        """Run images_steps() on a blocking port."""
+        return run_steps(
+            self.images_steps(logger, images, image_sources, start), port, self
+        )
+
+    def images_steps(self, logger, images: list, image_sources: dict, start: int = 0):
+        """
+        Iterate over the parsed <ImgList> in the exact order.  For each:
+        - If select="0", skip
+        - If type="ERASEFLASH", do BSL_CMD_ERASE_FLASH(0x0A)
+        - Else do (START_DATA -> chunk -> ENDED_DATA) with the partition "id"
+            from <Block id="...">, and file content from <File>...
+
+        With self.history set, every written image is recorded by SHA-256;
+        with self.delta also set, images whose hash matches the record of the
+        same partition are skipped, together with their ERASEFLASH entries.
+        While the device erases, the next image is read ahead (see
+        prepare_image).
+
+        :param start: Index of the first entry to process (when resuming);
+            every finished entry is recorded in self.checkpoint, if set
+        """
+        # Waits for the background image hashes
+        unchanged = yield BlockingCall(
+            self.unchanged_partitions, (logger, images, image_sources)
+        )
+        try:
+            for index, img in enumerate(images):
+                if index < start:
+                    continue
+                if self.erases(img, unchanged):
+                    self.prepare_image(
+                        self.next_image(images, index, image_sources, unchanged),
+                        keep=self.data_window * DATA_CHUNK_SIZE,
+                    )
+                if not (
+                    yield from self.entry_steps(logger, img, image_sources, unchanged)
+                ):
+                    return False
+                if self.checkpoint:
+                    self.checkpoint.mark_done(logger, index, img, image_sources)
+        finally:
+            self.prepare_image(None)
+        return True
+
+    @staticmethod
+    def erases(img: dict, unchanged=()) -> bool:
+        """True if entry_steps sends an ERASE_FLASH for the entry img."""
+        return (
+            img["select"]
+            and img["type"].upper() == "ERASEFLASH"
+            and not img.get("elided")
+            and (img["block_id"] or img["id"]) not in unchanged
+        )
 
-        # EXEC_DATA => run this FDL
-        pkt_exec = self.build_packet(BSL_CMD_EXEC_DATA)
-        port.write(pkt_exec)
-        resp = port.read(512, timeout=3000)
-        parsed = self.parse_packet(resp)
-        if not (parsed and parsed[0] == BSL_REP_ACK):
-            logger.error(f"EXEC_DATA no ACK from {stage_name}.")
+    @staticmethod
+    def next_image(images: list, index: int, image_sources: dict, unchanged=()):
+        """The source of the first image entry_steps sends after index."""
+        for img in images[index + 1 :]:
+            if not img["select"] or img["type"].upper() == "ERASEFLASH":
+                continue
+            src = as_image_source(
+                image_sources.get(img["file"]) if img["file"] else None
+            )
+            if src is not None and (img["block_id"] or img["id"]) not in unchanged:
+                return src
+        return None
+
+    def prepare_image(self, src, keep: int = 0):
+        """
+        Start reading src ahead (see image_chunks), for the data_chunks_steps()
+        that follows, e.g. while the device erases.  Chunks prepared for an
+        image that is not sent next are dropped; None just drops them.
+        """
+        if self._prepared is not None:
+            self._prepared[2].close()
+            self._prepared = None
+        if src is None:
+            return
+        stack = contextlib.ExitStack()
+        chunks = stack.enter_context(
+            self.image_chunks(src, DATA_CHUNK_SIZE, PREPARE_DEPTH, keep)
+        )
+        self._prepared = (src, chunks, stack)
+
+    def entry_steps(self, logger, img: dict, image_sources: dict, unchanged=()):
+        """Process one <ImgList> entry (see images_steps)."""
+        if not img["select"]:
+            logger.info(f"Skipping '{img['id']}' (select=0).")
+            return True
+
+        img_id = img["id"]
+        src = image_sources.get(img["file"], None) if img["file"] else None
+        part_id = img["block_id"] if img["block_id"] else img_id  # fallback
+        typ = img["type"].upper()
+
+        # If it's an erase request
+        if typ == "ERASEFLASH":
+            if part_id in unchanged:
+                logger.info(f"Skipping erase of unchanged partition '{part_id}'.")
+                return True
+            if img.get("elided"):
+                logger.info(f"Skipping erase of '{part_id}': it is rewritten in full.")
+                return True
+            if self.history:
+                self.history.forget(self.device_id, part_id)
+            with self.timer.phase(f"erase:{part_id}"):
+                return (yield from self.erase_steps(logger, part_id))
+
+        # If there's no actual file (like "INIT"?), skip
+        src = as_image_source(src)
+        if src is None:
+            logger.debug(f"Image '{img_id}' has no valid file to burn. Skipping.")
+            return True
+
+        if part_id in unchanged:
+            logger.info(f"Skipping '{img_id}': partition '{part_id}' unchanged.")
+            return True
+
+        file_size = src.size
+        logger.info(
+            f"Burning '{img_id}' => partition '{part_id}', file='{src.name}', size={file_size} bytes."
+        )
+        if self.history:
+            self.history.forget(self.device_id, part_id)
+
+        with self.timer.phase(f"image:{img_id}", nbytes=file_size):
+            # 1) BSL_CMD_START_DATA
+            if not (yield from self.start_data_steps(logger, part_id, file_size)):
+                return False
+
+            # 2) BSL_CMD_MIDST_DATA (in chunks)
+            if not (yield from self.data_chunks_steps(logger, src, img_id)):
+                return False
+
+            # 3) BSL_CMD_ENDED_DATA
+            if not (yield from self.ended_data_steps(logger, img_id)):
+                return False
+
+        if self.verify and not (
+            yield from self.verify_steps(logger, img, part_id, src)
+        ):
             return False
 
-        logger.info(f"{stage_name} is now running.")
+        if self.history and self.hasher:
+            sha = yield BlockingCall(self.hasher.get, (img["file"],))
+            if sha:
+                self.history.record(self.device_id, part_id, sha, file_size, img_id)
         return True
 
-    def str_to_unicode_le(self, s: str, max_chars=36):
+    def begin_images(self, port, logger, cfg: dict, image_sources: dict) -> str:
         """
-        Encode a python string as little-endian UTF-16, padded/truncated to max_chars,
-        returning the raw bytes. The doc requires wchar_t[36].
+        Once FDL2 runs: identify the device and set up its session
+        checkpoint, taking over a stored one with self.resume.  A device
+        without a serial number gets no history (see identity_is_unique),
+        and is only resumed with self.force_resume.
+        Returns the partition table hash.
         """
-        # Truncate if needed
-        s = s[:max_chars]
-        encoded = s.encode("utf-16-le")  # 2 bytes per char
-        # We need exactly max_chars * 2 bytes, pad with zeros if short
-        needed = max_chars * 2
-        if len(encoded) < needed:
-            encoded += b"\x00" * (needed - len(encoded))
-        return encoded
+        self.device_id = device_identity(port, self.handshake_versions)
+        logger.debug(f"Device identity: {self.device_id}")
+        if self.history and not identity_is_unique(self.device_id):
+            # Another board may have been on this port: what the history
+            # says about it must neither be used nor recorded.
+            if self.delta:
+                logger.warning(
+                    "The board has no USB serial number, so --delta cannot tell "
+                    "it from another board on the same port; flashing every "
+                    "partition."
+                )
+            if self.partial:
+                logger.warning(
+                    "The board has no USB serial number, so the flash history "
+                    "cannot tell whether it already has this partition table; "
+                    "repartitioning."
+                )
+            self.history = None
+        table_hash = partition_table_hash(cfg["unit"], cfg["partitions"])
+        self.checkpoint = None
+        if self.checkpoint_dir:
+            self.checkpoint = SessionCheckpoint(
+                self.checkpoint_dir, self.device_id, self.axp_id, table_hash
+            )
+            if (
+                self.resume
+                and not self.force_resume
+                and not identity_is_unique(self.device_id)
+            ):
+                # Its checkpoint is that of whatever board was last on this
+                # port, which need not be this one.
+                logger.warning(
+                    "The board has no USB serial number, so its checkpoint may "
+                    "be another board's on the same port; flashing every image "
+                    "(--force-resume resumes anyway)."
+                )
+            elif self.resume:
+                self.checkpoint.resume_from(
+                    logger, self.checkpoint.load(), cfg["imglist"], image_sources
+                )
+        return table_hash
 
-    def repartition(self, port, logger, unit: int, partitions: list):
+    def repartition_needed(self, logger, table_hash=None) -> bool:
         """
-        Sends BSL_CMD_REPARTITION(0x0B) with PARTITION_HEAD + PARTITION_BODY[].
-        struct PARTITION_HEAD {
-        uint32 magic=0x3A726170; // "par:"
-        uint8  version=1;
-        uint8  unit;
-        uint16 count; // number of PARTITION_BODY entries
-        }
-        struct PARTITION_BODY {
-        wchar_t id[36]; // partition name in UTF-16-LE
-        int64   size;   // final size in "unit" multiples
-        int64   gap;    // typically 0
-        }
+        False when the resumed checkpoint already sent this table, or when
+        self.history records it as the table last written to this device
+        (unless self.force_repartition).  Boards without a serial number
+        have no history (see begin_images), so they are always
+        repartitioned.
         """
-        MAGIC = 0x3A726170
-        UNIT_SIZE_TABLE = {0: 1048576, 1: 524288, 2: 1024, 3: 1}
-        version = 1
-        count = len(partitions)
+        if self.checkpoint and self.checkpoint.state["repartitioned"]:
+            logger.info(
+                "Partition table unchanged since the checkpoint; not repartitioning."
+            )
+            return False
+        if self.history and table_hash and not self.force_repartition:
+            known = self.history.device(self.device_id).get("partition_table")
+            if known == table_hash:
+                logger.info(
+                    "Partition table unchanged since the last flash; not repartitioning."
+                )
+                return False
+        return True
 
-        # Print head and each parition info
-        logger.debug(
-            f"PARTITION_HEAD: MAGIC=0x{MAGIC:08X}, version={version}, unit={unit}, count={count}"
+    def unchanged_partitions(self, logger, images: list, image_sources: dict) -> set:
+        """
+        Return the partitions whose selected image has the same SHA-256 as
+        the one last written to this device (empty unless delta is enabled).
+        """
+        if not (self.delta and self.history and self.hasher and self.device_id):
+            return set()
+        record = self.history.device(self.device_id).get("partitions", {})
+        unchanged = set()
+        for img in images:
+            if not img["select"] or img["type"].upper() == "ERASEFLASH":
+                continue
+            if not img["file"] or img["file"] not in image_sources:
+                continue
+            part_id = img["block_id"] if img["block_id"] else img["id"]
+            last = record.get(part_id)
+            if last and last["sha256"] == self.hasher.get(img["file"]):
+                unchanged.add(part_id)
+        if unchanged:
+            logger.info(f"Delta: unchanged partitions {sorted(unchanged)}")
+        return unchanged
+
+
+class FlashPlan:
+    """
+    What flashing needs from one AXP, built once and shared read-only by any
+    number of FlashSessions, in any threads: the parsed <Config>, the image
+    sources of its members and both FDL blobs, held in memory.
+
+        plan = FlashPlan.load("M5_LLM_ubuntu22.04_20250210.axp")
+        for path in find_devices(0x32C9, 0x1000):
+            with FlashSession(plan, USBSerialPort(0x32C9, 0x1000, path=path)) as s:
+                s.run()
+    """
+
+    def __init__(
+        self, cfg: dict, image_sources: dict, fdl1_src, fdl2_src, axp_path=None
+    ):
+        self.cfg = cfg
+        self.image_sources = image_sources
+        self.fdl1_src = fdl1_src
+        self.fdl2_src = fdl2_src
+        self.axp_path = axp_path
+        # Set by select(): some partitions are left alone
+        self.partial = False
+        # Timings of load() (plan-cache, open-axp, parse-xml, load-fdl)
+        self.setup_phases = []
+        self._fingerprint = None
+        # SHA-256 of images known from the PlanCache, by file name
+        self.image_hashes = {}
+
+    @classmethod
+    def load(cls, axp_path: str, logger=None, cache=None, tool=None, hashes=False):
+        """
+        Open an AXP and parse it (see load_axp), or take its parsed plan from
+        a PlanCache.
+
+        :param cache: PlanCache looked up first and updated after parsing
+        :param tool: AXDLTool whose timer gets the setup phases
+        :param hashes: Take the image hashes of the cached plan as well (see
+            PlanCache.lookup)
+        :raises AXPError: if the AXP cannot be used
+        """
+        logger = logger if logger else logging.getLogger("ax_usb_serial_dl")
+        setup = tool if tool is not None else AXDLTool()
+        cached = None
+        if cache is not None:
+            with setup.timer.phase("plan-cache"):
+                cached = cache.lookup(axp_path, hashes=hashes)
+        if cached is None:
+            plan = cls(*load_axp(setup, axp_path, logger), axp_path=axp_path)
+            if cache is not None:
+                try:
+                    plan._fingerprint = cache.store(
+                        axp_path, plan.cfg, plan.image_sources
+                    )
+                except (OSError, zipfile.BadZipFile) as e:
+                    logger.warning(f"Cannot cache the AXP plan: {e}")
+        else:
+            fingerprint, cfg, image_sources, hashes = cached
+            logger.info(f"Opening AXP: {Path(axp_path).name} (cached plan)")
+            with setup.timer.phase("load-fdl"):
+                try:
+                    fdl1_src = image_sources[cfg["fdl1"]["file"]].materialize()
+                    fdl2_src = image_sources[cfg["fdl2"]["file"]].materialize()
+                except (OSError, zipfile.BadZipFile) as e:
+                    raise AXPError(f"Cannot read AXP {axp_path}: {e}") from e
+            plan = cls(cfg, image_sources, fdl1_src, fdl2_src, axp_path=axp_path)
+            plan._fingerprint = fingerprint
+            plan.image_hashes = hashes
+        plan.setup_phases = setup.timer.report()
+        return plan
+
+    @property
+    def name(self) -> str:
+        return Path(self.axp_path).stem if self.axp_path else "axp"
+
+    @property
+    def flash_args(self) -> tuple:
+        """(config, image sources, FDL1 source, FDL2 source) of flash_device()."""
+        return self.cfg, self.image_sources, self.fdl1_src, self.fdl2_src
+
+    @property
+    def fingerprint(self) -> str:
+        """axp_fingerprint() of the AXP ("" for a plan built without one)."""
+        if self._fingerprint is None:
+            self._fingerprint = axp_fingerprint(self.axp_path) if self.axp_path else ""
+        return self._fingerprint
+
+    @property
+    def axp_id(self) -> str:
+        """The AXP fingerprint, made distinct for a partial plan (see select)."""
+        if not self.partial:
+            return self.fingerprint
+        # A checkpoint of a partial flash must not resume a full one.
+        chosen = ",".join(img["id"] for img in self.cfg["imglist"] if img["select"])
+        return self.fingerprint + ":" + hashlib.sha256(chosen.encode()).hexdigest()[:16]
+
+    def operations(self, verify=False, reset=False) -> list:
+        """
+        What flashing this plan does, in order: dicts with "op" (stage,
+        repartition, erase, write or verify), "name" (its phase), "bytes"
+        (sent, erased or read back) and, for the <ImgList> entries,
+        "partition" and "partition_size" (bytes, None if not in the table).
+        Writes also get "image_size" (expanded, for a sparse image) and
+        whether it "fits" the partition.  A resumed or --delta flash may
+        leave some out; the EIP of secure boot parts is not listed.
+
+        :raises AXPError: for a malformed sparse image
+        """
+        sizes = partition_bytes(self.cfg)
+        ops = [
+            {"op": "stage", "name": "rom-handshake", "bytes": 0},
+            {"op": "stage", "name": "fdl1", "bytes": self.fdl1_src.size},
+            {"op": "stage", "name": "fdl1-handshake", "bytes": 0},
+            {"op": "stage", "name": "fdl2", "bytes": self.fdl2_src.size},
+            {"op": "repartition", "name": "repartition", "bytes": 0},
+        ]
+        for img in self.cfg["imglist"]:
+            if not img["select"]:
+                continue
+            part_id = img["block_id"] or img["id"]
+            part_size = sizes.get(part_id)
+            entry = {"partition": part_id, "partition_size": part_size}
+            if img["type"].upper() == "ERASEFLASH":
+                name = f"erase:{part_id}"
+                if img.get("elided"):
+                    ops.append(dict(entry, op="erase", name=name, bytes=0, elided=True))
+                    continue
+                ops.append(dict(entry, op="erase", name=name, bytes=part_size or 0))
+                continue
+            src = self.image_sources.get(img["file"]) if img["file"] else None
+            if src is None:
+                # entry_steps skips it as well
+                continue
+            image_size = src.size
+            if src.sparse:
+                try:
+                    with src.open() as f:
+                        image_size = SparseReader(f).expanded_size
+                except SparseFormatError as e:
+                    raise AXPError(f"Sparse image '{src.name}' is malformed: {e}")
+            ops.append(
+                dict(
+                    entry,
+                    op="write",
+                    name=f"image:{img['id']}",
+                    bytes=src.size,
+                    image_size=image_size,
+                    fits=part_size is None or image_size <= part_size,
+                )
+            )
+            if verify:
+                name = f"verify:{img['id']}"
+                ops.append(dict(entry, op="verify", name=name, bytes=image_size))
+        if reset:
+            ops.append({"op": "stage", "name": "reset", "bytes": 0})
+        return ops
+
+    def select(self, only=(), skip=()):
+        """
+        Return a plan flashing only some of the images (see select_images),
+        sharing this plan's image sources.
+
+        :raises SelectionError: for unknown names or when no image is left
+        """
+        imglist = select_images(self.cfg["imglist"], only, skip)
+        if not any(img["select"] for img in imglist):
+            raise SelectionError("The selection leaves no image to flash.")
+        plan = self._with_imglist(imglist)
+        plan.partial = True
+        return plan
+
+    def elide_erases(self):
+        """
+        Return a plan whose ERASEFLASH entries made redundant by a later
+        write of the whole partition (see redundant_erases) are marked
+        "elided", so entry_steps skips them, and how many there are.
+        """
+        elided = redundant_erases(self.cfg, self.image_sources)
+        if not elided:
+            return self, 0
+        imglist = [
+            dict(img, elided=True) if index in elided else img
+            for index, img in enumerate(self.cfg["imglist"])
+        ]
+        return self._with_imglist(imglist), len(elided)
+
+    def _with_imglist(self, imglist: list):
+        """A copy of this plan flashing imglist instead."""
+        plan = FlashPlan(
+            dict(self.cfg, imglist=imglist),
+            self.image_sources,
+            self.fdl1_src,
+            self.fdl2_src,
+            self.axp_path,
         )
-        for p in partitions:
-            logger.debug(
-                f"PARTITION_BODY: id={p['id']}, size={p['size']}, gap={p['gap']}"
+        plan.partial = self.partial
+        plan.setup_phases = self.setup_phases
+        plan._fingerprint = self._fingerprint
+        plan.image_hashes = self.image_hashes
+        return plan
+
+
+class FlashSession:
+    """
+    One board flashed from a FlashPlan by an AXDLTool, whose settings
+    (window, delta, checkpoints, verify, ...) apply.  run() goes through
+    every phase; the phase methods can also be called one at a time, in
+    order.  A failing phase raises its FlashError subclass.  Used as a
+    context manager, the session opens and closes the port.
+
+    Each phase is written as protocol steps (see run_steps), which
+    axdl_async.AsyncFlashSession runs on an AsyncPort instead.
+
+    :param progress: progress(desc, done, total) is called as data is sent,
+        instead of drawing progress bars
+    :param on_phase: on_phase(name) is called as each phase starts
+    """
+
+    def __init__(
+        self,
+        plan: FlashPlan,
+        port,
+        tool=None,
+        logger=None,
+        status=None,
+        progress=None,
+        on_phase=None,
+    ):
+        self.plan = plan
+        self.tool = tool if tool is not None else AXDLTool()
+        if progress is not None:
+            self.tool.progress_callback = progress
+        self.raw_port = port
+        self.port = TimedPort(port, self.tool.timer)
+        self.logger = logger if logger else logging.getLogger("ax_usb_serial_dl")
+        self.status = status if status else FlashStatus(port.path or "-")
+        self.on_phase = on_phase
+        self.rom_version = ""
+
+    def __enter__(self):
+        self.raw_port.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.raw_port.close()
+
+    def _enter(self, name: str):
+        self.status.phase = name
+        if self.on_phase is not None:
+            self.on_phase(name)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Enter a phase timed in tool.timer."""
+        self._enter(name)
+        with self.tool.timer.phase(name):
+            yield
+
+    def _fail(self, error_class, message: str):
+        raise error_class(message, phase=self.status.phase, device=self.status.device)
+
+    def _run(self, steps):
+        """Run protocol steps (see run_steps) on the session's port."""
+        return run_steps(steps, self.port, self.tool)
+
+    def handshake_rom(self):
+        """Handshake with the ROM CODE and connect."""
+        return self._run(self.handshake_rom_steps())
+
+    def handshake_rom_steps(self):
+        tool = self.tool
+        with self.phase("rom-handshake"):
+            self.rom_version = yield from tool.handshake_steps(
+                self.logger, stage_name="ROM CODE"
+            )
+            if not self.rom_version:
+                self._fail(HandshakeError, "ROM CODE handshake failed.")
+            self.status.model = tool.handshake_versions.get("ROM CODE")
+            self.status.windows = tool.command_windows()
+            if not (yield from tool.connect_steps(self.logger)):
+                self._fail(HandshakeError, "ROM CODE did not accept CONNECT.")
+
+    def load_fdl1(self):
+        """Upload and start FDL1 (after the EIP on secure boot parts)."""
+        return self._run(self.load_fdl1_steps())
+
+    def load_fdl1_steps(self):
+        tool, cfg = self.tool, self.plan.cfg
+        # TODO: This part is not tested.
+        if "secureboot" in self.rom_version:
+            self.logger.info("Secure boot detected...")
+            with self.phase("eip"):
+                if not (
+                    yield from tool.fdl_steps(
+                        self.logger,
+                        self.plan.fdl1_src,
+                        cfg["eip"]["base"],
+                        stage_name="EIP",
+                    )
+                ):
+                    self._fail(FdlError, "EIP download failed.")
+        with self.phase("fdl1"):
+            if not (
+                yield from tool.fdl_steps(
+                    self.logger,
+                    self.plan.fdl1_src,
+                    cfg["fdl1"]["base"],
+                    stage_name="FDL1",
+                )
+            ):
+                self._fail(FdlError, "FDL1 download failed.")
+
+    def handshake_fdl1(self):
+        """Handshake with FDL1 and connect."""
+        return self._run(self.handshake_fdl1_steps())
+
+    def handshake_fdl1_steps(self):
+        tool = self.tool
+        with self.phase("fdl1-handshake"):
+            if not (yield from tool.handshake_steps(self.logger, stage_name="FDL1")):
+                self._fail(HandshakeError, "FDL1 handshake failed.")
+            if not (yield from tool.connect_steps(self.logger)):
+                self._fail(HandshakeError, "FDL1 did not accept CONNECT.")
+
+    def load_fdl2(self):
+        """Upload and start FDL2."""
+        return self._run(self.load_fdl2_steps())
+
+    def load_fdl2_steps(self):
+        with self.phase("fdl2"):
+            if not (
+                yield from self.tool.fdl_steps(
+                    self.logger,
+                    self.plan.fdl2_src,
+                    self.plan.cfg["fdl2"]["base"],
+                    stage_name="FDL2",
+                )
+            ):
+                self._fail(FdlError, "FDL2 download failed.")
+
+    def repartition(self):
+        """
+        Identify the board (see AXDLTool.begin_images) and write the
+        partition table, unless it is known to be there already.
+        """
+        return self._run(self.repartition_steps())
+
+    def repartition_steps(self):
+        tool, logger, cfg = self.tool, self.logger, self.plan.cfg
+        logger.info("Preparing to repartition & burn images...")
+        table_hash = tool.begin_images(
+            self.raw_port, logger, cfg, self.plan.image_sources
+        )
+        if tool.repartition_needed(logger, table_hash):
+            if tool.partial and not tool.force_repartition:
+                logger.warning(
+                    "The board's partition table is not known to match the AXP; "
+                    "repartitioning. Partitions left out of this flash may need a "
+                    "full flash."
+                )
+            with self.phase("repartition"):
+                if not (
+                    yield from tool.repartition_steps(
+                        logger, cfg["unit"], cfg["partitions"]
+                    )
+                ):
+                    self._fail(PartitionError, "Repartition failed.")
+            if tool.checkpoint:
+                tool.checkpoint.mark_repartitioned(logger)
+        if tool.history:
+            tool.history.set_partition_table(tool.device_id, table_hash)
+
+    def write_images(self):
+        """
+        Burn the <ImgList> entries in order (each one is its own phase),
+        once the tool's BusScheduler, if any, lets the board in.
+        """
+        return self._run(self.write_images_steps())
+
+    def write_images_steps(self):
+        tool = self.tool
+        slot = None
+        if tool.scheduler is not None:
+            slot = yield DataSlot(
+                port_controller(self.raw_port), lambda: self._enter("wait-bus")
+            )
+        try:
+            self._enter("images")
+            start = tool.checkpoint.state["next"] if tool.checkpoint else 0
+            if not (
+                yield from tool.images_steps(
+                    self.logger,
+                    self.plan.cfg["imglist"],
+                    self.plan.image_sources,
+                    start=start,
+                )
+            ):
+                self._fail(ImageError, "Failed during image downloads.")
+        finally:
+            if slot is not None:
+                tool.scheduler.release(slot)
+        if tool.checkpoint:
+            tool.checkpoint.clear()
+        self.logger.info(
+            "All images downloaded successfully. Optionally reset device with BSL_CMD_RESET..."
+        )
+
+    def reset(self):
+        """Send BSL_CMD_RESET(0x05); a missing ACK is only logged."""
+        return self._run(self.reset_steps())
+
+    def reset_steps(self):
+        with self.phase("reset"):
+            payload = struct.pack("<I", 0)
+            yield PortWrite(self.tool.build_packet(BSL_CMD_RESET, payload))
+            parsed = yield PortPacket(10000)
+            if parsed and parsed[0] == BSL_REP_ACK:
+                self.logger.info(
+                    "Device has ACKed reset; it should reboot into normal mode."
+                )
+            else:
+                self.logger.warning("No ACK after reset command.")
+
+    def run(self, reset=False):
+        """
+        Run every phase on the opened port: ROM handshake, FDL1, FDL2,
+        repartition, images and, with reset, the reset.
+
+        :raises FlashError: naming the phase that failed
+        """
+        return self._run(self.steps(reset))
+
+    def steps(self, reset=False):
+        """The protocol steps of run()."""
+        yield from self.handshake_rom_steps()
+        yield from self.load_fdl1_steps()
+        yield from self.handshake_fdl1_steps()
+        yield from self.load_fdl2_steps()
+        yield from self.repartition_steps()
+        yield from self.write_images_steps()
+        if reset:
+            yield from self.reset_steps()
+        self.status.ok = True
+
+
+def flash_device(
+    AXDL,
+    port,
+    logger,
+    cfg: dict,
+    image_sources: dict,
+    fdl1_src,
+    fdl2_src,
+    reset=False,
+    status=None,
+) -> bool:
+    """
+    Run the full flow on an opened port (see FlashSession.run).  The port is
+    left open for the caller to close.  Every step is recorded as a phase in
+    AXDL.timer.
+
+    :param status: Optional FlashStatus updated with the current phase
+    :return: True on success, False (after logging it) on a FlashError
+    """
+    plan = FlashPlan(cfg, image_sources, fdl1_src, fdl2_src)
+    session = FlashSession(plan, port, AXDL, logger, status)
+    try:
+        session.run(reset=reset)
+    except FlashError as e:
+        session.status.error = str(e)
+        logger.error(str(e))
+        return False
+    return True
+
+
+class FlashStatus:
+    """Progress and outcome of one device in a multi-device run."""
+
+    def __init__(self, device: str):
+        self.device = device
+        self.phase = "open"
+        self.ok = False
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.phases = []
+        self.commands = {}
+        # AXP being flashed, when a run mixes several (see axdl_station.py)
+        self.axp = None
+        # ROM CODE version of the board, once it answered the handshake
+        self.model = None
+        # Requests kept in flight per command (see AXDLTool.command_windows)
+        self.windows = {}
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+
+class DeviceLogAdapter(logging.LoggerAdapter):
+    """Prefix every log line with the device's bus-port path."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['device']}] {msg}", kwargs
+
+
+def wait_for_devices(list_devices, logger, timeout=DEVICE_WAIT_TIMEOUT, backoff=None):
+    """
+    Return the paths of the boards in download mode (list_devices()), once
+    there is at least one: they are listed again on every USB uevent (with
+    pyudev) and otherwise after each delay of backoff, for up to timeout
+    seconds.
+    """
+    deadline = time.monotonic() + timeout
+    devices = list_devices()
+    if not devices:
+        logger.info("Waiting for devices...")
+        delays = (backoff if backoff else Backoff()).delays()
+        # Listening from here on, so no arrival is missed
+        with usb_monitor() as monitor:
+            devices = list_devices()
+            while not devices and time.monotonic() < deadline:
+                left = max(0.0, deadline - time.monotonic())
+                wait_usb_event(monitor, min(left, next(delays)))
+                devices = list_devices()
+    if devices:
+        logger.info(f"Found {len(devices)} device(s): {', '.join(devices)}")
+    return devices
+
+
+# Seconds of data transfer at one concurrency level before the throughput
+# of a controller there counts as measured
+BUS_SAMPLE_TIME = 0.5
+# Relative throughput gain one more concurrent board must bring
+BUS_MIN_GAIN = 0.1
+# Seconds after which a concurrency level found not to pay off is tried again
+BUS_REPROBE_TIME = 30.0
+
+
+def port_controller(port) -> str:
+    """Host controller of an opened port (see usb_topology), or "default"."""
+    topology = getattr(port, "topology", None)
+    return topology["controller"] if topology else "default"
+
+
+def timer_bytes(timer: PhaseTimer) -> int:
+    """
+    Image data bytes moved so far by the transfers of a timer: those of its
+    image downloads (MIDST_DATA) and read-back (READ_FLASH) phases.
+    """
+    return sum(
+        p["bytes_out"] + p["bytes_in"]
+        for p in timer.phases
+        if p["name"].startswith(("image:", "verify:"))
+    )
+
+
+class BusScheduler:
+    """
+    Admission control for the data phases (image downloads and read-back)
+    of boards flashed in parallel.  Boards behind one host controller share
+    its bandwidth: once it is saturated, another concurrent board only slows
+    the others down, so none of them finishes sooner.
+
+    For every controller the aggregate throughput of the boards in a data
+    phase is measured at each concurrency level, over stretches where every
+    one of them moved image data: a stretch where a board waited on an
+    erase or an ENDED_DATA reply measures that wait, not the bus, and is
+    dropped.  One more board is let in only once the current level has been
+    measured and raised the throughput by BUS_MIN_GAIN over the level below;
+    a level that did not is given up again, and tried once more after
+    BUS_REPROBE_TIME.  The others wait, and each board that finishes its
+    data phase lets the next one in.  Short phases (handshakes, FDL uploads,
+    repartition) are not gated, so they overlap the data phases of other
+    boards.  One instance is shared by all the boards of a run.
+
+    :param max_per_bus: Most concurrent data phases per controller
+        (None: as many as raise the throughput)
+    """
+
+    def __init__(self, max_per_bus=None, logger=None):
+        self.max_per_bus = max_per_bus
+        self.logger = logger if logger else logging.getLogger("ax_usb_serial_dl")
+        self._cond = threading.Condition()
+        self._buses = {}
+
+    def _bus(self, controller: str) -> dict:
+        bus = self._buses.get(controller)
+        if bus is None:
+            bus = self._buses[controller] = {
+                "limit": 1,
+                "active": [],
+                # Measured throughput (bytes/s) by number of active boards,
+                # and when each level was last measured
+                "rates": {},
+                "measured": {},
+                "since": time.monotonic(),
+                "bytes": 0,
+                # Data bytes of each active board when last polled
+                "seen": {},
+                "polled": time.monotonic(),
+                "stalled": False,
+            }
+        return bus
+
+    def _restart(self, bus: dict):
+        """Start a new measurement window at the current concurrency."""
+        now = time.monotonic()
+        bus["seen"] = {id(t): timer_bytes(t) for t in bus["active"]}
+        bus["since"] = bus["polled"] = now
+        bus["bytes"] = sum(bus["seen"].values())
+        bus["stalled"] = False
+
+    def _sample(self, controller: str, bus: dict):
+        """Close the measurement window if it is long enough."""
+        k = len(bus["active"])
+        now = time.monotonic()
+        if not k:
+            return
+        # Polls closer together than this cannot tell a wait from a board
+        # between two transfers
+        if now - bus["polled"] >= BUS_SAMPLE_TIME / 4:
+            seen = {id(t): timer_bytes(t) for t in bus["active"]}
+            if any(seen[key] == bus["seen"][key] for key in seen):
+                bus["stalled"] = True
+            bus["seen"], bus["polled"] = seen, now
+        elapsed = now - bus["since"]
+        if elapsed < BUS_SAMPLE_TIME:
+            return
+        if bus["stalled"]:
+            self._restart(bus)
+            return
+        total = sum(timer_bytes(t) for t in bus["active"])
+        rate = (total - bus["bytes"]) / elapsed
+        rates = bus["rates"]
+        rates[k] = rate if k not in rates else (rates[k] + rate) / 2
+        bus["measured"][k] = now
+        self._restart(bus)
+        if k > 1 and rates[k] < rates.get(k - 1, 0.0) * (1 + BUS_MIN_GAIN):
+            if bus["limit"] >= k:
+                bus["limit"] = k - 1
+                self.logger.info(
+                    f"Controller {controller}: {k - 1} board(s) at a time "
+                    f"({rates[k - 1] / 1e6:.1f} MB/s; {rates[k] / 1e6:.1f} MB/s "
+                    f"with {k})."
+                )
+
+    def _admit(self, controller: str, bus: dict) -> bool:
+        self._sample(controller, bus)
+        k = len(bus["active"])
+        if k < bus["limit"]:
+            return True
+        if self.max_per_bus and k >= self.max_per_bus:
+            return False
+        rates = bus["rates"]
+        if k not in rates or rates[k] < rates.get(k - 1, 0.0) * (1 + BUS_MIN_GAIN):
+            return False
+        # A level already found not to pay off is not tried again until its
+        # measurement is BUS_REPROBE_TIME old
+        when = bus["measured"].get(k + 1)
+        if when is not None and time.monotonic() - when >= BUS_REPROBE_TIME:
+            rates.pop(k + 1, None)
+        if rates.get(k + 1, math.inf) >= rates[k] * (1 + BUS_MIN_GAIN):
+            bus["limit"] = k + 1
+            self.logger.debug(
+                f"Controller {controller}: trying {k + 1} boards at a time "
+                f"({rates[k] / 1e6:.1f} MB/s with {k})."
+            )
+            return True
+        return False
+
+    def acquire(self, controller: str, timer: PhaseTimer, on_wait=None):
+        """
+        Wait until a board behind controller may start a data phase whose
+        transfers timer counts; returns the slot to release().
+
+        :param on_wait: Called once if the board has to wait
+        """
+        with self._cond:
+            slot = self.try_acquire(controller, timer)
+            if slot is None and on_wait is not None:
+                on_wait()
+            while slot is None:
+                # Wake up now and then to measure the throughput again
+                self._cond.wait(BUS_SAMPLE_TIME / 2)
+                slot = self.try_acquire(controller, timer)
+        return slot
+
+    def try_acquire(self, controller: str, timer: PhaseTimer):
+        """acquire() without waiting: the slot, or None."""
+        with self._cond:
+            bus = self._bus(controller)
+            if not self._admit(controller, bus):
+                return None
+            bus["active"].append(timer)
+            self._restart(bus)
+        return controller, timer
+
+    def release(self, slot):
+        controller, timer = slot
+        with self._cond:
+            bus = self._buses[controller]
+            self._sample(controller, bus)
+            bus["active"].remove(timer)
+            self._restart(bus)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def data_phase(self, controller: str, timer: PhaseTimer, on_wait=None):
+        """Hold a slot (see acquire) for the duration of the block."""
+        slot = self.acquire(controller, timer, on_wait)
+        try:
+            yield
+        finally:
+            self.release(slot)
+
+
+def flash_devices(
+    logger,
+    device_paths: list,
+    flash_args: tuple,
+    make_port,
+    make_tool,
+    reset=False,
+) -> list:
+    """
+    Flash every device in device_paths in parallel, one worker per device.
+    flash_args (config, image sources, FDL blobs) is shared read-only by all
+    workers.  make_port(path, logger) creates the transport of one device and
+    make_tool() a configured AXDLTool for it.
+    Returns one FlashStatus per device, in device_paths order.
+    """
+    statuses = [FlashStatus(dev_path) for dev_path in device_paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(statuses)) as pool:
+        for index, status in enumerate(statuses):
+            pool.submit(
+                flash_one_device,
+                logger,
+                status,
+                flash_args,
+                make_port,
+                make_tool,
+                reset=reset,
+                position=index,
+            )
+    return statuses
+
+
+def flash_one_device(
+    logger, status, flash_args, make_port, make_tool, reset=False, position=0
+):
+    """
+    Open, flash and close the device of status (a FlashStatus), recording the
+    outcome, timings and command latencies in it.  Never raises; errors end
+    up in status.error.  position is the row of its progress bars.
+    """
+    dev_logger = DeviceLogAdapter(logger, {"device": status.device})
+    AXDL = make_tool()
+    AXDL.progress_prefix = f"{status.device} "
+    AXDL.progress_position = position
+    status.started = time.monotonic()
+    port = None
+    try:
+        port = make_port(status.device, dev_logger)
+        port.open()
+        status.ok = flash_device(
+            AXDL,
+            port,
+            dev_logger,
+            *flash_args,
+            reset=reset,
+            status=status,
+        )
+    except Exception as e:
+        status.error = str(e)
+        dev_logger.error(f"Flashing failed during {status.phase}: {e}")
+    finally:
+        if port is not None:
+            port.close()
+        status.finished = time.monotonic()
+        status.phases = AXDL.timer.report()
+        status.commands = AXDL.timer.command_report()
+    if status.ok:
+        status.phase = "done"
+    return status
+
+
+# Phases timed once per run in main(), before any device is touched
+SETUP_PHASES = ("plan-cache", "open-axp", "parse-xml", "load-fdl", "check-sparse")
+
+
+def load_axp(AXDL, axp_path: str, logger) -> tuple:
+    """
+    Open an AXP, parse its XML and load both FDL blobs, timing each step in
+    AXDL.timer.  Returns the flash_args of flash_device():
+    (config, image sources, FDL1 source, FDL2 source).
+
+    :raises AXPError: if the AXP cannot be used
+    """
+    logger.info(f"Opening AXP: {Path(axp_path).name}")
+    with AXDL.timer.phase("open-axp"):
+        xml_content, image_sources = AXDL.open_axp(axp_path, logger)
+    with AXDL.timer.phase("parse-xml"):
+        try:
+            cfg = AXDL.parse_config_xml(xml_content, logger)
+        except ValueError as e:  # a number attribute that is not one
+            raise AXPError(f"Bad value in AXP XML: {e}") from e
+    fdl1_src = image_sources.get(cfg["fdl1"]["file"], None)
+    fdl2_src = image_sources.get(cfg["fdl2"]["file"], None)
+    if fdl1_src is None:
+        raise AXPError(f"FDL1 file '{cfg['fdl1']['file']}' not found in AXP.")
+    if fdl2_src is None:
+        raise AXPError(f"FDL2 file '{cfg['fdl2']['file']}' not found in AXP.")
+    # FDL blobs are small and sent once per stage; keep them in memory.
+    with AXDL.timer.phase("load-fdl"):
+        fdl1_src = fdl1_src.materialize()
+        fdl2_src = fdl2_src.materialize()
+    return cfg, image_sources, fdl1_src, fdl2_src
+
+
+def image_names(img: dict) -> set:
+    """Lower-case names --only/--skip match an <ImgList> entry by: ID and block id."""
+    return {name.lower() for name in (img["id"], img["block_id"]) if name}
+
+
+def select_images(imglist: list, only=(), skip=()) -> list:
+    """
+    Return a copy of the <ImgList> in which only the selected entries chosen
+    by the names in only (all entries when empty) and not named in skip
+    stay selected.  Names are IDs or partition (block) ids, in any case, so
+    "kernel" picks both the KERNEL image and its ERASEFLASH entry.
+
+    :raises SelectionError: if a name matches no entry
+    """
+    known = set()
+    for img in imglist:
+        known |= image_names(img)
+    only = {name.lower() for name in only}
+    skip = {name.lower() for name in skip}
+    unknown = (only | skip) - known
+    if unknown:
+        raise SelectionError(
+            f"Unknown image/partition name(s): {', '.join(sorted(unknown))} "
+            f"(known: {', '.join(sorted(known))})"
+        )
+    selected = []
+    for img in imglist:
+        names = image_names(img)
+        chosen = (not only or names & only) and not names & skip
+        selected.append(dict(img, select=bool(img["select"] and chosen)))
+    return selected
+
+
+def partition_bytes(cfg: dict) -> dict:
+    """Size in bytes of every partition of cfg (given in UNIT_SIZE_TABLE units)."""
+    unit_size = UNIT_SIZE_TABLE.get(cfg["unit"], 1)
+    return {p["id"]: p["size"] * unit_size for p in cfg["partitions"]}
+
+
+def redundant_erases(cfg: dict, image_sources: dict) -> set:
+    """
+    Indexes of the selected ERASEFLASH entries of cfg's <ImgList> that a
+    later selected image overwrites entirely: it goes to the same partition,
+    is at least as large and is not sparse (a sparse image leaves its
+    DONT_CARE blocks as they were).
+    """
+    sizes = partition_bytes(cfg)
+    images = cfg["imglist"]
+    redundant = set()
+    for index, img in enumerate(images):
+        if not img["select"] or img["type"].upper() != "ERASEFLASH":
+            continue
+        part_id = img["block_id"] or img["id"]
+        part_size = sizes.get(part_id)
+        if not part_size:
+            continue
+        for later in images[index + 1 :]:
+            if not later["select"] or (later["block_id"] or later["id"]) != part_id:
+                continue
+            if later["type"].upper() == "ERASEFLASH":
+                continue
+            src = image_sources.get(later["file"]) if later["file"] else None
+            if src is not None and src.size >= part_size and not src.sparse:
+                redundant.add(index)
+                break
+    return redundant
+
+
+def check_sparse_images(cfg: dict, image_sources: dict, logger) -> bool:
+    """
+    Validate every selected Android sparse image of the <ImgList> and log its
+    real and expanded size and estimated transfer time (see axdl_sparse.py).
+    Returns False if one is malformed or does not fit its partition.
+    """
+    part_sizes = partition_bytes(cfg)
+    ok = True
+    for img in cfg["imglist"]:
+        src = image_sources.get(img["file"]) if img["file"] else None
+        if not img["select"] or src is None or not src.sparse:
+            continue
+        try:
+            with src.open() as f:
+                info = scan_sparse(f, DATA_CHUNK_SIZE)
+        except SparseFormatError as e:
+            logger.error(f"Sparse image '{src.name}' is malformed: {e}")
+            ok = False
+            continue
+        logger.info(
+            f"Sparse image '{src.name}': {info['file_size']} bytes, "
+            f"{info['expanded_size']} expanded "
+            f"({info['raw_bytes']} raw, {info['fill_bytes']} fill, "
+            f"{info['dont_care_bytes']} don't care), {info['transfers']} transfers, "
+            f"~{estimate_transfer_time(info):.1f}s."
+        )
+        part_id = img["block_id"] or img["id"]
+        part_size = part_sizes.get(part_id)
+        if part_size is not None and info["expanded_size"] > part_size:
+            logger.error(
+                f"Sparse image '{src.name}' expands to {info['expanded_size']} bytes, "
+                f"partition '{part_id}' holds {part_size}."
+            )
+            ok = False
+    return ok
+
+
+def check_image_sizes(ops: list, logger) -> bool:
+    """Log every write of FlashPlan.operations() too large for its partition."""
+    ok = True
+    for op in ops:
+        if op["op"] == "write" and not op["fits"]:
+            logger.error(
+                f"Image '{op['name'][6:]}' is {op['image_size']} bytes, partition "
+                f"'{op['partition']}' holds {op['partition_size']}."
             )
+            ok = False
+    return ok
+
+
+def estimate_operations(ops: list, profile: dict) -> tuple:
+    """
+    Set the "estimate" (seconds, or None without a measurement) of every
+    operation of FlashPlan.operations() from a ThroughputProfile entry.
+    Returns the total of the estimates and the number of operations left
+    without one.
+    """
+    phases = profile.get("phases", {})
+    rates = {
+        "write": profile.get("write_rate"),
+        "verify": profile.get("verify_rate"),
+        "erase": profile.get("erase_rate"),
+    }
+    total = 0.0
+    unknown = 0
+    for op in ops:
+        rate = rates.get(op["op"])
+        if op.get("elided"):
+            estimate = 0.0
+        elif rate and op["bytes"]:
+            estimate = op["bytes"] / rate
+        elif op["op"] == "erase":
+            estimate = phases.get("erase")
+        else:
+            estimate = phases.get(op["name"])
+        op["estimate"] = estimate
+        if estimate is None:
+            unknown += 1
+        else:
+            total += estimate
+    return total, unknown
+
+
+def plan_report(plan: FlashPlan, ops: list, model, profile: dict) -> dict:
+    """
+    The --plan report of the operations of plan, estimated from the
+    ThroughputProfile entry of model (JSON serialisable).
+    """
+    total, unknown = estimate_operations(ops, profile)
+    written = collections.Counter()
+    for op in ops:
+        if op["op"] == "write":
+            written[op["partition"]] += op["image_size"]
+    return {
+        "axp": os.path.abspath(plan.axp_path) if plan.axp_path else None,
+        "model": model,
+        "sessions": profile.get("sessions", 0),
+        "unit": plan.cfg["unit"],
+        "unit_size": UNIT_SIZE_TABLE.get(plan.cfg["unit"], 1),
+        "partitions": [
+            {"id": part_id, "size": size, "written": written[part_id]}
+            for part_id, size in partition_bytes(plan.cfg).items()
+        ],
+        "operations": ops,
+        "estimate_s": total,
+        "unmeasured": unknown,
+        "oversized": [
+            op["name"][6:] for op in ops if op["op"] == "write" and not op["fits"]
+        ],
+    }
+
+
+def print_plan(report: dict):
+    """Print a plan_report() for people."""
+
+    def seconds(value):
+        return "?" if value is None else f"{value:.2f}s"
+
+    print(f"Plan for {Path(report['axp'] or 'axp').name}", end="")
+    if report["sessions"]:
+        print(f" (measured on {report['model']}, {report['sessions']} sessions)")
+    else:
+        print(" (no measurements yet: flash a board or run axdl_bench.py)")
+    print(f"{'#':>3}  {'operation':<13}{'target':<28}{'bytes':>12}{'time':>10}")
+    for index, op in enumerate(report["operations"], 1):
+        target = op["name"].partition(":")[2] or op["name"]
+        if op["op"] == "write":
+            target = f"{target} -> {op['partition']}"
+        elif op["op"] == "repartition":
+            target = f"{len(report['partitions'])} partitions, unit {report['unit']}"
+        nbytes = f"{op['bytes']}" if op["bytes"] else "-"
+        note = "" if op.get("fits", True) else "  DOES NOT FIT"
+        if op.get("elided"):
+            note = "  elided: rewritten in full"
+        print(
+            f"{index:>3}  {op['op']:<13}{target:<28}{nbytes:>12}"
+            f"{seconds(op['estimate']):>10}{note}"
+        )
+    print(f"Partitions (unit {report['unit']} = {report['unit_size']} bytes):")
+    for part in report["partitions"]:
+        used = f"{part['written'] / part['size']:.1%}" if part["size"] else "-"
+        print(
+            f"  {part['id']:<20}{part['size']:>14} bytes"
+            f"{part['written']:>14} written ({used})"
+        )
+    unmeasured = report["unmeasured"]
+    print(
+        f"Estimated time: {report['estimate_s']:.1f}s"
+        + (f" + {unmeasured} operation(s) never measured" if unmeasured else "")
+    )
+    for name in report["oversized"]:
+        print(f"Image '{name}' does not fit its partition.")
 
-        # Build PARTITION_HEAD
-        part_head = struct.pack("<IBBH", MAGIC, version, unit, count)
 
-        # Build array of PARTITION_BODY
-        body_bytes = b""
-        for p in partitions:
-            name_bytes = self.str_to_unicode_le(p["id"])
-            p_size = p["size"]
-            p_gap = p["gap"]
-            body_bytes += name_bytes
-            body_bytes += struct.pack("<qq", p_size, p_gap)
+def record_throughput(profile: ThroughputProfile, statuses: list, cfg: dict, sim=False):
+    """Fold the successful sessions of statuses into a ThroughputProfile."""
+    part_sizes = partition_bytes(cfg)
+    for status in statuses:
+        if status.ok and status.model:
+            model = f"sim:{status.model}" if sim else status.model
+            profile.record(model, status.phases, part_sizes)
 
-        payload = part_head + body_bytes
-        pkt = self.build_packet(BSL_CMD_REPARTITION, payload)
-        port.write(pkt)
-        resp = port.read(512, timeout=3000)
-        parsed = self.parse_packet(resp)
-        if not parsed or parsed[0] != BSL_REP_ACK:
-            logger.error("BSL_CMD_REPARTITION -> no ACK.")
-            return False
 
-        logger.info(f"Repartition done. (#Partitions: {count}, unit={unit})")
-        return True
+def record_timeouts(store: CommandTimeouts, statuses: list):
+    """Fold the command latencies of the successful sessions into store."""
+    for status in statuses:
+        if status.ok and status.model and status.commands:
+            store.record(status.model, status.commands, status.windows)
 
-    def start_data_cmd(self, port, logger, part_id: str, file_size: int):
-        """
-        BSL_CMD_START_DATA(0x01)
-        Payload:
-        - Id(72 bytes, unicode)
-        - Size(8 bytes)
-        - Reserved(8 bytes=0)
-        """
-        name_bytes = self.str_to_unicode_le(
-            part_id, max_chars=36
-        )  # 36 wide-chars => 72 bytes
-        payload = (
-            name_bytes
-            + struct.pack("<Q", file_size)  # 8 bytes
-            + struct.pack("<Q", 0)  # 8 bytes reserved
-        )
-        pkt = self.build_packet(BSL_CMD_START_DATA, payload)
-        port.write(pkt)
-        resp = port.read(512, timeout=2000)
-        parsed = self.parse_packet(resp)
-        if not parsed or parsed[0] != BSL_REP_ACK:
-            logger.error(f"No ACK after START_DATA for partition '{part_id}'.")
-            return False
-        return True
 
-    def send_data_chunks(self, port, logger, fpath: str, part_name: str):
-        """
-        Repeatedly send BSL_CMD_MIDST_DATA(0x02) -> {data}, until file is done.
-        """
-        if not os.path.isfile(fpath):
-            logger.error(f"File not found: {fpath}")
-            return False
+def failed_phase(status: FlashStatus):
+    """Innermost phase that was running when the device failed, or None."""
+    if status.ok:
+        return None
+    # Phases are recorded as they start, so the last one is the innermost.
+    return status.phases[-1]["name"] if status.phases else status.phase
 
-        size = os.path.getsize(fpath)
-        chunk_size = 0xB000
-        pbar = tqdm(total=size, unit="B", unit_scale=True, desc=part_name)
 
-        with open(fpath, "rb") as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                length = len(chunk)
-
-                # BSL_CMD_MIDST_DATA(0x02) payload => Size(4) + Enable(4) + CheckSum(4)
-                # We'll do "Enable=0" => no sub-chunk checksumming, then "CheckSum=0".
-                mids_payload = struct.pack("<III", length, 0, 0)
-                pkt_midst = self.build_packet(BSL_CMD_MIDST_DATA, mids_payload)
-                port.write(pkt_midst)
-                resp = port.read(512, timeout=5000)
-                parsed = self.parse_packet(resp)
-                if not (parsed and parsed[0] == BSL_REP_ACK):
-                    logger.error(
-                        f"No ACK after MIDST_DATA header for partition '{part_name}'."
-                    )
-                    return False
+def device_report(status: FlashStatus) -> dict:
+    """Summary, phases and command latencies of one device, for the reports."""
+    images = [p for p in status.phases if p["name"].startswith("image:")]
+    image_bytes = sum(p["bytes"] for p in images)
+    image_wall = sum(p["wall"] for p in images)
+    return {
+        "device": status.device,
+        "ok": status.ok,
+        "phase": status.phase,
+        "failed_phase": failed_phase(status),
+        "error": status.error,
+        "elapsed": status.elapsed,
+        "retries": sum(p["retries"] for p in status.phases),
+        "handshake_retries": sum(
+            p["retries"] for p in status.phases if p["name"].startswith("ready:")
+        ),
+        "image_bytes": image_bytes,
+        "image_mb_per_s": image_bytes / image_wall / 1e6 if image_wall else 0.0,
+        "phases": status.phases,
+        "commands": status.commands,
+    }
 
-                # Now send the actual chunk
-                port.write(chunk)
-                resp = port.read(512, timeout=120000)
-                parsed = self.parse_packet(resp)
-                if not (parsed and parsed[0] == BSL_REP_ACK):
-                    logger.error(
-                        f"No ACK after data chunk for partition '{part_name}'."
-                    )
-                    return False
 
-                pbar.update(length)
+def write_timings(path: str, axp_path: str, setup_timer: PhaseTimer, statuses: list):
+    """
+    Write the session report of a run as JSON:
+    {"axp": ..., "host": ..., "created": ..., "setup": [phase, ...],
+    "devices": [{"device", "ok", "failed_phase", ..., "phases": [phase, ...],
+    "commands": {command: latency stats}}, ...]}
+    """
+    report = {
+        "axp": os.path.abspath(axp_path),
+        "host": socket.gethostname(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "setup": [p for p in setup_timer.report() if p["name"] in SETUP_PHASES],
+        "devices": [device_report(st) for st in statuses],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
 
-        pbar.close()
-        return True
 
-    def ended_data_cmd(self, port, logger, part_id: str):
-        """
-        BSL_CMD_ENDED_DATA(0x03) => finalize.
-        """
-        pkt = self.build_packet(BSL_CMD_ENDED_DATA)
-        port.write(pkt)
-        resp = port.read(512, timeout=120000)
-        parsed = self.parse_packet(resp)
-        if not (parsed and parsed[0] == BSL_REP_ACK):
-            logger.error(f"No ACK after ENDED_DATA for '{part_id}'.")
-            return False
-        else:
-            return True
+def prometheus_labels(**labels) -> str:
+    """Format labels as {name="value",...} with Prometheus escaping."""
+    items = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        items.append(f'{name}="{value}"'.replace("\n", "\\n"))
+    return "{" + ",".join(items) + "}"
 
-    def erase_partition(self, port, logger, part_id: str):
-        """
-        Example of using BSL_CMD_ERASE_FLASH(0x0A) to erase a partition by name.
-        According to the doc:
-        Payload:
-            - Flag(8) = 0 => partial erase
-            - Id(72) = partition name in unicode
-            - Size(8) => portion to erase; 0 => entire partition
-        """
-        logger.info(f"Erasing partition '{part_id}' ...")
-        name_bytes = self.str_to_unicode_le(part_id, 36)
-        payload = struct.pack("<Q", 0) + name_bytes + struct.pack("<Q", 0)
-        pkt = self.build_packet(BSL_CMD_ERASE_FLASH, payload)
-        port.write(pkt)
-        resp = port.read(512, timeout=120000)
-        parsed = self.parse_packet(resp)
-        if not parsed or parsed[0] != BSL_REP_ACK:
-            logger.error(f"No ACK after erase partition '{part_id}'.")
-            return False
-        logger.info(f"Partition '{part_id}' erased.")
-        return True
 
-    def download_images(self, port, logger, images: list, extracted_files: dict):
-        """
-        Iterate over the parsed <ImgList> in the exact order.  For each:
-        - If select="0", skip
-        - If type="ERASEFLASH", do BSL_CMD_ERASE_FLASH(0x0A)
-        - Else do (START_DATA -> chunk -> ENDED_DATA) with the partition "id"
-            from <Block id="...">, and file content from <File>...
-        """
-        for img in images:
-            if not img["select"]:
-                logger.info(f"Skipping '{img['id']}' (select=0).")
-                continue
+def merged_phases(phases: list) -> list:
+    """
+    Phases of a report() with the repeats of a name (the handshakes of a
+    stage, a partition erased twice) folded into its first entry, their
+    counts and times summed.
+    """
+    merged = collections.OrderedDict()
+    for p in phases:
+        entry = merged.get(p["name"])
+        if entry is None:
+            merged[p["name"]] = dict(p)
+            continue
+        for key, value in p.items():
+            if key not in ("name", "mb_per_s"):
+                entry[key] += value
+    for entry in merged.values():
+        if entry["bytes"] and entry["wall"] > 0:
+            entry["mb_per_s"] = entry["bytes"] / entry["wall"] / 1e6
+    return list(merged.values())
 
-            img_id = img["id"]
-            fpath = extracted_files.get(img["file"], None) if img["file"] else None
-            part_id = img["block_id"] if img["block_id"] else img_id  # fallback
-            typ = img["type"].upper()
 
-            # If it's an erase request
-            if typ == "ERASEFLASH":
-                self.erase_partition(port, logger, part_id)
-                continue
+def write_prometheus(path: str, axp_path: str, statuses: list):
+    """
+    Write the metrics of a run in the Prometheus text format, for the
+    node_exporter textfile collector.  The file is replaced atomically so the
+    collector never scrapes a partial run.  Boards are labelled with their
+    own AXP (FlashStatus.axp), else axp_path; repeated phases are summed
+    (see merged_phases).
+    """
+    metrics = collections.OrderedDict()
 
-            # If there's no actual file (like "INIT"?), skip
-            if not fpath or not os.path.isfile(fpath):
-                logger.debug(f"Image '{img_id}' has no valid file to burn. Skipping.")
-                continue
+    def add(name, kind, help_text, labels, value, suffix=""):
+        family = metrics.setdefault(name, (kind, help_text, []))
+        family[2].append(f"{name}{suffix}{prometheus_labels(**labels)} {value}")
 
-            file_size = os.path.getsize(fpath)
-            logger.info(
-                f"Burning '{img_id}' => partition '{part_id}', file='{Path(fpath).name}', size={file_size} bytes."
+    for st in statuses:
+        dev = {"device": st.device, "axp": Path(st.axp or axp_path).name}
+        add(
+            "axdl_flash_success",
+            "gauge",
+            "1 if the last flash of the board succeeded.",
+            dev,
+            int(bool(st.ok)),
+        )
+        add(
+            "axdl_flash_duration_seconds",
+            "gauge",
+            "Wall time of the last flash of the board.",
+            dev,
+            f"{st.elapsed:.6f}",
+        )
+        if not st.ok:
+            add(
+                "axdl_flash_failed_phase",
+                "gauge",
+                "Phase in which the last flash of the board failed.",
+                dict(dev, phase=failed_phase(st)),
+                1,
             )
+        for p in merged_phases(st.phases):
+            phase = dict(dev, phase=p["name"])
+            add(
+                "axdl_phase_duration_seconds",
+                "gauge",
+                "Wall time of a flashing phase.",
+                phase,
+                f"{p['wall']:.6f}",
+            )
+            add(
+                "axdl_phase_retries",
+                "gauge",
+                "Handshake attempts and chunks re-sent in a flashing phase.",
+                phase,
+                p["retries"],
+            )
+            if p["name"].startswith("image:"):
+                part = dict(dev, partition=p["name"][len("image:") :])
+                add(
+                    "axdl_partition_bytes",
+                    "gauge",
+                    "Image bytes written to a partition.",
+                    part,
+                    p["bytes"],
+                )
+                add(
+                    "axdl_partition_throughput_bytes_per_second",
+                    "gauge",
+                    "Image bytes per second written to a partition.",
+                    part,
+                    f"{p.get('mb_per_s', 0.0) * 1e6:.0f}",
+                )
+        for command, stats in st.commands.items():
+            cmd = dict(dev, command=command)
+            help_text = "Time from a request to its reply, per protocol command."
+            for bound, count in stats["buckets"].items():
+                add(
+                    "axdl_command_latency_seconds",
+                    "histogram",
+                    help_text,
+                    dict(cmd, le=bound),
+                    count,
+                    suffix="_bucket",
+                )
+            for suffix, value in (
+                ("_sum", f"{stats['sum']:.6f}"),
+                ("_count", stats["count"]),
+            ):
+                add(
+                    "axdl_command_latency_seconds",
+                    "histogram",
+                    help_text,
+                    cmd,
+                    value,
+                    suffix=suffix,
+                )
+            add(
+                "axdl_command_timeouts",
+                "gauge",
+                "Requests that got no reply before the read timed out.",
+                cmd,
+                stats["timeouts"],
+            )
+    add(
+        "axdl_last_run_timestamp_seconds",
+        "gauge",
+        "Unix time the last flashing run finished.",
+        {},
+        f"{time.time():.3f}",
+    )
 
-            # 1) BSL_CMD_START_DATA
-            if not self.start_data_cmd(port, logger, part_id, file_size):
-                return False
-
-            # 2) BSL_CMD_MIDST_DATA (in chunks)
-            if not self.send_data_chunks(port, logger, fpath, img_id):
-                return False
+    lines = []
+    for name, (kind, help_text, samples) in metrics.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
 
-            # 3) BSL_CMD_ENDED_DATA
-            if not self.ended_data_cmd(port, logger, img_id):
-                return False
 
-        return True
+def print_status_table(statuses: list):
+    """Print one line per device, followed by a summary of the failures."""
+    width = max([len("DEVICE")] + [len(st.device) for st in statuses])
+    print(f"{'DEVICE':<{width}}  {'RESULT':<6}  {'PHASE':<14}  TIME")
+    for st in statuses:
+        result = "OK" if st.ok else "FAIL"
+        print(f"{st.device:<{width}}  {result:<6}  {st.phase:<14}  {st.elapsed:.1f}s")
+    failed = [st for st in statuses if not st.ok]
+    print(f"{len(statuses) - len(failed)}/{len(statuses)} device(s) flashed.")
+    for st in failed:
+        reason = f": {st.error}" if st.error else ""
+        print(f"  {st.device} failed during {st.phase}{reason}")
 
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Axera chip USB downloader tool.",
     )
-    parser.add_argument("--axp", required=True, help="Path to the AXP package (.axp).")
+    parser.add_argument("--axp", help="Path to the AXP package (.axp).")
     parser.add_argument("--reset", action="store_true", help="Reset after finish.")
 
     parser.add_argument(
@@ -825,114 +4894,520 @@ def main():
         default=0x1000,
         help="USB Product ID in hex (e.g. 0x1000).",
     )
+    parser.add_argument(
+        "--poll-backoff",
+        type=Backoff.parse,
+        default=Backoff(),
+        metavar="FIRST_MS[,MAX_MS]",
+        help="Delays between looks for a board that is not there yet and "
+        "between handshake resends, doubling from FIRST_MS up to MAX_MS "
+        f"(default {BACKOFF_FIRST * 1000:g},{BACKOFF_LONGEST * 1000:g}).",
+    )
+
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_DATA_WINDOW,
+        help="MIDST_DATA chunks kept in flight while burning images "
+        f"(default {DEFAULT_DATA_WINDOW}, lock-step).  4 pipelines the transfer; "
+        "it is only tested against the simulator so far.",
+    )
+
+    parser.add_argument(
+        "--chunk-checksum",
+        action="store_true",
+        help="Send every MIDST_DATA chunk with its checksum for the FDL to verify.",
+    )
+    parser.add_argument(
+        "--chunk-retries",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Re-send a chunk that gets a NAK or no ACK up to N times before the "
+        "partition fails (chunks are then sent lock-step; default 0).",
+    )
+    parser.add_argument(
+        "--on-stall",
+        choices=("fail", "wait"),
+        default="wait",
+        help="What a reply missing the timeout learnt for its command on the "
+        "board model does: 'wait' logs it and waits for the fixed timeout "
+        "(default), 'fail' fails the board at once.",
+    )
+    parser.add_argument(
+        "--fixed-timeouts",
+        action="store_true",
+        help="Wait for every reply as long as the fixed timeouts allow instead "
+        "of the timeouts learnt from earlier sessions.",
+    )
+
+    parser.add_argument(
+        "--no-mmap",
+        action="store_true",
+        help="Read images from disk chunk by chunk instead of memory-mapping "
+        "the ones stored uncompressed.",
+    )
+    parser.add_argument(
+        "--drop-page-cache",
+        action="store_true",
+        help="Evict image pages from the page cache once sent (saves memory "
+        "for a single board; boards flashed together would read them again).",
+    )
+
+    parser.add_argument(
+        "--fdl-probe",
+        action="store_true",
+        help="Upload the FDLs in the largest chunks the stage takes, probed "
+        f"once per board model, instead of {FDL_LEGACY_CHUNK}-byte chunks with "
+        "separate header and data transfers.",
+    )
+
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the bus-port paths of all boards in download mode, with their "
+        "speed and host controller, and exit.",
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Flash every board in download mode in parallel.",
+    )
+    parser.add_argument(
+        "--devices",
+        help="Comma separated bus-port paths (see --list) to flash in parallel.",
+    )
+    parser.add_argument(
+        "--max-per-bus",
+        type=int,
+        metavar="N",
+        help="Let at most N boards behind one host controller transfer image "
+        "data at a time (implies --bus-schedule).",
+    )
+    parser.add_argument(
+        "--bus-schedule",
+        action="store_true",
+        help="Let boards behind one host controller transfer image data only "
+        "as many at a time as raise its measured throughput (default: all "
+        "boards at once).",
+    )
+
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Drive all boards from one asyncio event loop (axdl_async.py) "
+        "instead of one thread per board.",
+    )
+    parser.add_argument(
+        "--device-timeout",
+        type=float,
+        metavar="SEC",
+        help="With --async, cancel a board's session after SEC seconds.",
+    )
+
+    parser.add_argument(
+        "--sim",
+        nargs="?",
+        const="",
+        metavar="OPTIONS",
+        help="Flash the in-process device simulator (axdl_sim.py) instead of USB, "
+        "e.g. --sim latency_ms=0.5,bandwidth_mbps=40,flash_mbps=20,devices=4",
+    )
+
+    parser.add_argument(
+        "--only",
+        action="append",
+        default=[],
+        metavar="NAMES",
+        help="Flash only these images, by ID or partition name, comma separated "
+        "(e.g. --only kernel,dtb); the handshake and FDL stages always run.",
+    )
+    parser.add_argument(
+        "--skip",
+        action="append",
+        default=[],
+        metavar="NAMES",
+        help="Do not flash these images (ID or partition names, comma separated).",
+    )
+    parser.add_argument(
+        "--force-repartition",
+        action="store_true",
+        help="Repartition even when the flash history (see --history) records "
+        "the same partition table for the board; --only, --skip and --delta "
+        "otherwise skip it.",
+    )
+
+    parser.add_argument(
+        "--plan",
+        nargs="?",
+        const="text",
+        choices=("text", "json"),
+        help="Print what flashing the AXP does (stages, partition table, erases "
+        "and writes with their sizes) and how long it should take, from the "
+        "throughput measured in earlier sessions, then exit; 'json' prints it "
+        "as JSON.  Fails if an image does not fit its partition.",
+    )
+    parser.add_argument(
+        "--model",
+        help="Board model (ROM CODE version) whose measurements --plan uses "
+        "(default: the one flashed last).",
+    )
+
+    parser.add_argument(
+        "--keep-erases",
+        action="store_true",
+        help="Send every ERASEFLASH entry, even for a partition the next image "
+        "rewrites in full.",
+    )
+
+    parser.add_argument(
+        "--check-sparse",
+        action="store_true",
+        help="Validate the Android sparse images of the AXP and estimate their "
+        "transfer time before touching a board; stop if one is malformed.",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Read every written partition back through the FDL and compare it "
+        "with its image.",
+    )
+    parser.add_argument(
+        "--verify-sample",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Spot-check: read back only N random blocks of each image "
+        f"({READ_CHUNK_SIZE // 1024} KiB each); implies --verify.",
+    )
+
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Skip images whose SHA-256 matches the one last written to the same "
+        "partition of this board (see --history).  Needs a board with a USB "
+        "serial number; others are flashed in full.",
+    )
+    parser.add_argument(
+        "--history",
+        metavar="JSON",
+        help="Flash history store used by --delta "
+        "(default $XDG_CACHE_HOME/axdl_tool/history.json).",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted flash of the same AXP from its checkpoint: "
+        "redo the handshake and FDL stages, then only the unfinished images.",
+    )
+    parser.add_argument(
+        "--force-resume",
+        action="store_true",
+        help="--resume boards without a USB serial number too, trusting that "
+        "the board on the port is the one that was interrupted.",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        metavar="DIR",
+        help="Where session checkpoints are kept "
+        "(default $XDG_CACHE_HOME/axdl_tool/sessions).",
+    )
+
+    parser.add_argument(
+        "--no-progress",
+        action="store_true",
+        help="Do not draw progress bars.",
+    )
+    parser.add_argument(
+        "--timings",
+        metavar="JSON",
+        help="Write a session report to JSON: wall/CPU time, bytes, transfers and "
+        "retries of every phase, command latency histograms and the failure phase.",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="Write the same metrics in the Prometheus text format, e.g. to "
+        "node_exporter's textfile collector directory (FILE should end in .prom).",
+    )
+    parser.add_argument(
+        "--no-plan-cache",
+        action="store_true",
+        help="Parse the AXP even if its plan is cached from an earlier run "
+        "($XDG_CACHE_HOME/axdl_tool/plans.json).",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Record every bulk transfer in a binary session trace, for "
+        "axdl_trace.py (with --all/--devices one FILE.<bus-port> per board).",
+    )
+    parser.add_argument(
+        "--trace-digest",
+        action="store_true",
+        help="Also store a digest of every data transfer in the trace.",
+    )
 
     parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.axp and not args.list:
+        parser.error("--axp is required")
 
     log_level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(
         level=log_level, format="%(asctime)s [%(levelname)s] %(message)s"
     )
     logger = logging.getLogger("ax_usb_serial_dl")
-    AXDL = AXDLTool()
-    # 1) Extract AXP & parse config
-    logger.info(f"Extracting AXP: {Path(args.axp).name}")
-    xml_content, extracted_files = AXDL.extract_axp(args.axp, logger)
-    cfg = AXDL.parse_config_xml(xml_content, logger)
-    fdl1_path = extracted_files.get(cfg["fdl1"]["file"], None)
-    fdl2_path = extracted_files.get(cfg["fdl2"]["file"], None)
-    if not fdl1_path or not os.path.isfile(fdl1_path):
-        logger.error(
-            f"FDL1 file '{cfg['fdl1']['file']}' not found among extracted files."
-        )
-        sys.exit(1)
-    if not fdl2_path or not os.path.isfile(fdl2_path):
-        logger.error(
-            f"FDL2 file '{cfg['fdl2']['file']}' not found among extracted files."
-        )
-        sys.exit(1)
 
-    # 2) Open the USB port
-    port = USBSerialPort(args.vid, args.pid, logger=logger)
-    port.open()
+    sim_spec = None
+    if args.sim is not None:
+        import axdl_sim
 
-    # 3) Handshake with ROM CODE
-    rom_resp = AXDL.handshake(port, logger, stage_name="ROM CODE")
-    if len(rom_resp) == 0:
-        logger.error("ROM CODE handshake failed.")
-        port.close()
-        sys.exit(1)
-    if not AXDL.cmd_connect(port, logger):
-        port.close()
-        sys.exit(1)
+        try:
+            sim_spec = axdl_sim.parse_sim_spec(args.sim)
+        except ValueError as e:
+            parser.error(f"--sim {args.sim}: {e}")
 
-    # 3.1) EIP
-    # TODO: This part is not tested.
-    if "secureboot" in rom_resp:
-        logger.info("Secure boot detected...")
-        if not AXDL.download_fdl(
-            port, logger, fdl1_path, cfg["eip"]["base"], stage_name="EIP"
-        ):
-            port.close()
+    def make_port(path=None, port_logger=logger):
+        if sim_spec is not None:
+            port = axdl_sim.make_sim_device(sim_spec, path, port_logger)
+        else:
+            port = USBSerialPort(
+                args.vid,
+                args.pid,
+                logger=port_logger,
+                path=path,
+                backoff=args.poll_backoff,
+            )
+        if args.trace:
+            trace_path = f"{args.trace}.{path}" if path else args.trace
+            meta = {"axp": os.path.basename(args.axp)}
+            port = TracePort(port, trace_path, digest=args.trace_digest, meta=meta)
+        return port
+
+    def list_devices():
+        if sim_spec is not None:
+            return axdl_sim.sim_device_paths(sim_spec)
+        return find_devices(args.vid, args.pid)
+
+    if args.list:
+        if sim_spec is not None:
+            devices = axdl_sim.sim_device_topologies(sim_spec)
+        else:
+            devices = find_device_topologies(args.vid, args.pid)
+        for topology in devices:
+            print(
+                f"{topology['path']}\t{topology['speed']} speed\t"
+                f"hub {topology['hub']}\tcontroller {topology['controller']}"
+            )
+        if not devices:
+            logger.error(
+                f"No device in download mode (VID=0x{args.vid:04X}, PID=0x{args.pid:04X})."
+            )
             sys.exit(1)
+        return
 
-    # 4) Download FDL1
-    if not AXDL.download_fdl(
-        port, logger, fdl1_path, cfg["fdl1"]["base"], stage_name="FDL1"
-    ):
-        port.close()
-        sys.exit(1)
+    history = None
+    hasher = None
+    checkpoint_dir = None
+    axp_id = None
+    fdl_profile = FdlProfile(os.path.join(cache_dir(), "fdl_profile.json"))
+    timeouts = CommandTimeouts(
+        os.path.join(cache_dir(), "timeouts.json"),
+        prefix="sim:" if sim_spec is not None else "",
+    )
+    plan_cache = None
+    if not args.no_plan_cache:
+        plan_cache = PlanCache(os.path.join(cache_dir(), "plans.json"))
+    scheduler = None
+    if args.bus_schedule or args.max_per_bus:
+        scheduler = BusScheduler(args.max_per_bus, logger)
 
-    # 5) Handshake with FDL1
-    if not AXDL.handshake(port, logger, stage_name="FDL1"):
-        logger.error("FDL1 handshake failed.")
-        port.close()
+    def make_tool():
+        tool = AXDLTool(
+            data_window=args.window,
+            chunk_checksum=args.chunk_checksum,
+            chunk_retries=args.chunk_retries,
+        )
+        tool.progress_enabled = not args.no_progress
+        tool.history = history
+        tool.hasher = hasher
+        tool.delta = args.delta
+        tool.checkpoint_dir = checkpoint_dir
+        tool.axp_id = axp_id
+        tool.resume = args.resume or args.force_resume
+        tool.force_resume = args.force_resume
+        tool.partial = bool(args.only or args.skip)
+        tool.force_repartition = args.force_repartition
+        tool.verify = args.verify or args.verify_sample > 0
+        tool.verify_samples = max(0, args.verify_sample)
+        tool.fdl_profile = fdl_profile
+        tool.fdl_probe = args.fdl_probe
+        tool.scheduler = scheduler
+        tool.mmap_images = not args.no_mmap
+        tool.drop_page_cache = args.drop_page_cache
+        tool.command_timeouts = None if args.fixed_timeouts else timeouts
+        tool.on_stall = args.on_stall
+        tool.backoff = args.poll_backoff
+        return tool
+
+    AXDL = make_tool()
+    # 1) Extract AXP & parse config
+    try:
+        plan = FlashPlan.load(
+            args.axp,
+            logger,
+            cache=plan_cache,
+            tool=AXDL,
+            hashes=args.delta or (args.verify and not args.verify_sample),
+        )
+        if args.only or args.skip:
+            only = [n.strip() for v in args.only for n in v.split(",") if n.strip()]
+            skip = [n.strip() for v in args.skip for n in v.split(",") if n.strip()]
+            plan = plan.select(only, skip)
+            chosen = [img["id"] for img in plan.cfg["imglist"] if img["select"]]
+            logger.info(f"Flashing only: {', '.join(chosen)}")
+    except AXDLError as e:
+        logger.error(str(e))
         sys.exit(1)
-    if not AXDL.cmd_connect(port, logger):
-        port.close()
+    if not args.keep_erases:
+        plan, elided = plan.elide_erases()
+        if elided:
+            logger.info(
+                f"Eliding {elided} erase(s) of partitions rewritten in full "
+                "(--keep-erases sends them)."
+            )
+    flash_args = plan.flash_args
+    cfg, image_sources = plan.cfg, plan.image_sources
+    partial = plan.partial
+    if args.check_sparse:
+        with AXDL.timer.phase("check-sparse"):
+            if not check_sparse_images(cfg, image_sources, logger):
+                sys.exit(1)
+    throughput = ThroughputProfile(os.path.join(cache_dir(), "throughput.json"))
+    try:
+        ops = plan.operations(
+            verify=args.verify and not args.verify_sample, reset=args.reset
+        )
+    except AXPError as e:
+        logger.error(str(e))
         sys.exit(1)
-
-    # 6) Download FDL2
-    if not AXDL.download_fdl(
-        port, logger, fdl2_path, cfg["fdl2"]["base"], stage_name="FDL2"
-    ):
-        port.close()
+    if args.plan:
+        model, profile = throughput.get(args.model)
+        report = plan_report(plan, ops, model, profile)
+        if args.plan == "json":
+            print(json.dumps(report, indent=2))
+        else:
+            print_plan(report)
+        sys.exit(1 if report["oversized"] else 0)
+    if not check_image_sizes(ops, logger):
         sys.exit(1)
 
-    logger.info("Preparing to repartition & burn images...")
+    # A partial flash needs the history to know the board's partition table.
+    if args.delta or partial:
+        history = FlashHistory(
+            args.history or os.path.join(cache_dir(), "history.json")
+        )
+        AXDL.history = history
+    if args.delta or (args.verify and not args.verify_sample):
+        # Hash in <ImgList> order while the ROM/FDL stages run; a full
+        # read-back is then checked against the hash.
+        hasher = ImageHasher(known=plan.image_hashes)
+        for img in cfg["imglist"]:
+            if img["select"] and img["file"] in image_sources:
+                hasher.submit(img["file"], image_sources[img["file"]])
+        AXDL.hasher = hasher
 
-    # 7) Repartition (BSL_CMD_REPARTITION)
-    if not AXDL.repartition(port, logger, cfg["unit"], cfg["partitions"]):
-        logger.error("Repartition failed.")
-        port.close()
-        sys.exit(1)
+    checkpoint_dir = args.checkpoint_dir or os.path.join(cache_dir(), "sessions")
+    axp_id = plan.axp_id
+    AXDL.checkpoint_dir = checkpoint_dir
+    AXDL.axp_id = axp_id
+    AXDL.resume = args.resume or args.force_resume
+    AXDL.force_resume = args.force_resume
 
-    # 8) Burn images in <ImgList> order
-    if not AXDL.download_images(port, logger, cfg["imglist"], extracted_files):
-        logger.error("Failed during image downloads.")
-        port.close()
-        sys.exit(1)
+    def finish_run(statuses):
+        if args.timings:
+            write_timings(args.timings, args.axp, AXDL.timer, statuses)
+        if args.prometheus:
+            write_prometheus(args.prometheus, args.axp, statuses)
+        if plan_cache is not None and hasher is not None:
+            plan_cache.record_hashes(plan.fingerprint, hasher.digests())
+        record_throughput(throughput, statuses, cfg, sim=sim_spec is not None)
+        record_timeouts(timeouts, statuses)
 
-    logger.info(
-        "All images downloaded successfully. Optionally reset device with BSL_CMD_RESET..."
-    )
+    def run_flash_devices(device_paths):
+        if args.use_async:
+            import axdl_async
 
-    # 9) (Optional) Send BSL_CMD_RESET(0x05):
-    if args.reset:
-        payload = struct.pack("<I", 0)
-        pkt_reset = AXDL.build_packet(BSL_CMD_RESET, payload)
-        port.write(pkt_reset)
-        resp = port.read(512, timeout=10000)
-        parsed = AXDL.parse_packet(resp)
-        if parsed and parsed[0] == BSL_REP_ACK:
-            logger.info("Device has ACKed reset; it should reboot into normal mode.")
+            return axdl_async.flash_devices_async(
+                logger,
+                device_paths,
+                flash_args,
+                make_port,
+                make_tool,
+                reset=args.reset,
+                timeout=args.device_timeout,
+            )
+        return flash_devices(
+            logger, device_paths, flash_args, make_port, make_tool, reset=args.reset
+        )
+
+    if args.use_async and not (args.all or args.devices):
+        # One board through the async API: the first one found
+        (status,) = run_flash_devices([None])
+        finish_run([status])
+        if not status.ok:
+            sys.exit(1)
+        logger.info("All operations completed. Exiting.")
+        return
+
+    if args.all or args.devices:
+        if args.devices:
+            device_paths = [d.strip() for d in args.devices.split(",") if d.strip()]
         else:
-            logger.warning("No ACK after reset command.")
+            device_paths = wait_for_devices(
+                list_devices, logger, backoff=args.poll_backoff
+            )
+        if not device_paths:
+            logger.error("No device in download mode found.")
+            sys.exit(1)
+        statuses = run_flash_devices(device_paths)
+        print_status_table(statuses)
+        finish_run(statuses)
+        if not all(st.ok for st in statuses):
+            sys.exit(1)
+        return
 
-    # close port
-    port.close()
+    # 2) Open the USB port
+    port = make_port()
+    status = FlashStatus(port.path or "usb")
+    status.started = time.monotonic()
+    port.open()
+    try:
+        status.ok = flash_device(
+            AXDL, port, logger, *flash_args, reset=args.reset, status=status
+        )
+    except Exception as e:
+        status.error = str(e)
+        raise
+    finally:
+        # close port
+        port.close()
+        status.finished = time.monotonic()
+        status.phases = [
+            p for p in AXDL.timer.report() if p["name"] not in SETUP_PHASES
+        ]
+        status.commands = AXDL.timer.command_report()
+        finish_run([status])
+    if not status.ok:
+        sys.exit(1)
     logger.info("All operations completed. Exiting.")
 
 
 if __name__ == "__main__":
+    # Let axdl_sim/axdl_async import this module instead of a second copy.
+    sys.modules.setdefault("axdl_tool", sys.modules[__name__])
     main()
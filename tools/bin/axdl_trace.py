@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Filename: axdl_trace.py
+Description: analysis and replay of the session traces of axdl_tool.py.
+
+axdl_tool.py --trace FILE (axdl_station.py --trace-dir DIR) records every
+bulk transfer of a flash in a compact binary trace (see axdl_tool.TracePort).
+summary reads one back and reports:
+- the latency distribution of every protocol command, from the start of the
+  request to the end of the read that brought its reply,
+- host gaps: spans in which no transfer was pending, so the board waited
+  for the host (reading images, hashing, scheduling),
+- the time and throughput of every stage and partition download.
+replay sends the recorded OUT transfers to axdl_sim.SimulatedDevice and
+reads its replies as the recorded session did, either as fast as possible
+or keeping the recorded host gaps, and compares the two sessions.  Only the
+head of a data transfer is in the trace, so the rest is replayed as zeros:
+replay with a simulator that neither checks chunk checksums nor unpacks
+sparse images.
+
+# SPDX-FileCopyrightText: 2024 M5Stack Technology CO LTD
+#
+# SPDX-License-Identifier: MIT
+
+use: python3 axdl_trace.py summary station4.axtrace
+     python3 axdl_trace.py replay station4.axtrace --sim latency_ms=0.25 --pace
+
+"""
+import argparse
+import bisect
+import collections
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from axdl_tool import (
+    BSL_CMD_READ_FLASH_START,
+    BSL_CMD_REPARTITION,
+    BSL_CMD_RESET,
+    BSL_CMD_START_DATA,
+    LATENCY_BUCKETS,
+    MIDST_DATA_PACKET,
+    TRACE_DIGEST,
+    TRACE_DIGEST_SIZE,
+    TRACE_FAILED,
+    TRACE_HEADER,
+    TRACE_IN,
+    TRACE_MAGIC,
+    TRACE_OUT,
+    TRACE_RECORD,
+    TRACE_VERSION,
+    TRACE_WHOLE,
+    TracePort,
+    command_name,
+    decode_packet,
+)
+
+# Times are in seconds; data holds the stored bytes (see TracePort)
+TraceRecord = collections.namedtuple(
+    "TraceRecord", "kind flags packets start duration length data digest"
+)
+
+
+class TraceFormatError(ValueError):
+    """The file is not a well-formed session trace."""
+
+
+def read_trace(path: str) -> tuple:
+    """
+    Read a session trace, returning (metadata, records) with the records (a
+    list of TraceRecord) in the order the transfers completed.  A trace cut
+    short by a crash keeps its complete records.
+
+    :raises TraceFormatError: if the file is not a trace
+    """
+    with open(path, "rb") as f:
+        blob = f.read()
+    if len(blob) < TRACE_HEADER.size:
+        raise TraceFormatError("too short for a session trace")
+    magic, version, meta_len = TRACE_HEADER.unpack_from(blob)
+    if magic != TRACE_MAGIC:
+        raise TraceFormatError("not a session trace")
+    if version != TRACE_VERSION:
+        raise TraceFormatError(f"unsupported trace version {version}")
+    pos = TRACE_HEADER.size + meta_len
+    try:
+        meta = json.loads(blob[TRACE_HEADER.size : pos].decode("utf-8"))
+    except ValueError as e:
+        raise TraceFormatError(f"bad trace metadata ({e})") from e
+    records = []
+    while pos + TRACE_RECORD.size <= len(blob):
+        kind, flags, packets, stored, start, duration, length = (
+            TRACE_RECORD.unpack_from(blob, pos)
+        )
+        pos += TRACE_RECORD.size
+        data = blob[pos : pos + stored]
+        pos += stored
+        digest = None
+        if flags & TRACE_DIGEST:
+            digest = blob[pos : pos + TRACE_DIGEST_SIZE]
+            pos += TRACE_DIGEST_SIZE
+        if pos > len(blob):
+            break
+        records.append(
+            TraceRecord(
+                kind, flags, packets, start / 1e6, duration / 1e6, length, data, digest
+            )
+        )
+    return meta, records
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile (q in 0..100) of sorted values."""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, math.ceil(q / 100.0 * len(values)) - 1))
+    return values[rank]
+
+
+def match_replies(records: list) -> tuple:
+    """
+    Pair every request with the read that completed it, as PhaseTimer does:
+    an OUT transfer queues a request, every reply packet read completes the
+    oldest one and an empty read times it out.  A MIDST_DATA header sent
+    with its data counts as two requests.
+    Returns ({command: [latencies]}, {command: timeouts}, labels) where
+    labels[i] names what record i was (the command sent, or "<command>
+    reply").
+    """
+    latencies = collections.defaultdict(list)
+    timeouts = collections.Counter()
+    labels = [""] * len(records)
+    pending = collections.deque()
+    for i, rec in enumerate(records):
+        if rec.kind == TRACE_OUT:
+            labels[i] = command_name(rec.data)
+            if not rec.flags & TRACE_FAILED:
+                pending.append((labels[i], rec.start))
+                if labels[i] == "MIDST_DATA" and rec.length > MIDST_DATA_PACKET.size:
+                    # Header and data in one transfer: both are ACKed
+                    pending.append(("DATA", rec.start))
+            continue
+        if rec.flags & TRACE_FAILED:
+            labels[i] = "failed read"
+            continue
+        if not rec.length:
+            if pending:
+                name = pending.popleft()[0]
+                timeouts[name] += 1
+                labels[i] = f"{name} timeout"
+            continue
+        end = rec.start + rec.duration
+        answered = []
+        for _ in range(rec.packets):
+            if not pending:
+                break
+            name, sent = pending.popleft()
+            latencies[name].append(end - sent)
+            answered.append(name)
+        labels[i] = f"{answered[0]} reply" if answered else "data"
+    return latencies, timeouts, labels
+
+
+def host_gaps(records: list) -> list:
+    """
+    Spans in which no transfer was pending, as (start, length, before, after)
+    with before/after the indices of the records around the gap.
+    """
+    order = sorted(range(len(records)), key=lambda i: records[i].start)
+    gaps = []
+    busy_until = None
+    last = None
+    for i in order:
+        rec = records[i]
+        if busy_until is not None and rec.start > busy_until:
+            gaps.append((busy_until, rec.start - busy_until, last, i))
+        end = rec.start + rec.duration
+        if busy_until is None or end >= busy_until:
+            busy_until = end
+            last = i
+    return gaps
+
+
+def segment_name(rec) -> str:
+    """Stage that a START_DATA, READ_FLASH_START, ... request begins, or None."""
+    if rec.kind != TRACE_OUT or not rec.flags & TRACE_WHOLE:
+        return None
+    parsed = decode_packet(rec.data)
+    if not parsed:
+        return None
+    cmd, payload = parsed
+    if cmd in (BSL_CMD_START_DATA, BSL_CMD_READ_FLASH_START):
+        if len(payload) < 72:
+            (base,) = struct.unpack_from("<I", payload)
+            return f"fdl@0x{base:X}"
+        name = bytes(payload[:72]).decode("utf-16-le").split("\0", 1)[0]
+        return name if cmd == BSL_CMD_START_DATA else f"read {name}"
+    if cmd == BSL_CMD_REPARTITION:
+        return "repartition"
+    if cmd == BSL_CMD_RESET:
+        return "reset"
+    return None
+
+
+def segments(records: list) -> list:
+    """
+    Split the session at the requests of segment_name, returning a list of
+    {"name", "start", "seconds", "bytes"} ("bytes" counts both directions).
+    The first segment, before any of them, is "handshake".
+    """
+    result = []
+    current = {"name": "handshake", "start": 0.0, "bytes": 0}
+    end = 0.0
+    for rec in sorted(records, key=lambda r: r.start):
+        name = segment_name(rec)
+        if name is not None:
+            current["seconds"] = rec.start - current["start"]
+            result.append(current)
+            current = {"name": name, "start": rec.start, "bytes": 0}
+        current["bytes"] += rec.length
+        end = max(end, rec.start + rec.duration)
+    current["seconds"] = end - current["start"]
+    result.append(current)
+    for seg in result:
+        if seg["seconds"] > 0:
+            seg["mb_per_s"] = seg["bytes"] / seg["seconds"] / 1e6
+    return result
+
+
+def analyze(meta: dict, records: list, min_gap=0.005, top=10) -> dict:
+    """
+    Summarize a trace (see read_trace) as a JSON serialisable dict: totals,
+    command latency distributions, host gaps (the top longest of at least
+    min_gap seconds) and segments.
+    """
+    latencies, timeouts, labels = match_replies(records)
+    commands = {}
+    for name in sorted(set(latencies) | set(timeouts)):
+        values = sorted(latencies.get(name, ()))
+        buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        for value in values:
+            buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        commands[name] = {
+            "count": len(values),
+            "timeouts": timeouts.get(name, 0),
+            "mean": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else 0.0,
+            "buckets": dict(
+                zip([f"{b:g}" for b in LATENCY_BUCKETS] + ["+Inf"], buckets)
+            ),
+        }
+    duration = max((r.start + r.duration for r in records), default=0.0)
+    gaps = host_gaps(records)
+    idle = sum(length for _, length, _, _ in gaps)
+    longest = sorted(
+        (g for g in gaps if g[1] >= min_gap), key=lambda g: g[1], reverse=True
+    )
+    stages = segments(records)
+    seg_starts = [seg["start"] for seg in stages]
+    return {
+        "device": meta.get("device"),
+        "axp": meta.get("axp"),
+        "started": meta.get("started"),
+        "duration": duration,
+        "transfers_out": sum(1 for r in records if r.kind == TRACE_OUT),
+        "transfers_in": sum(1 for r in records if r.kind == TRACE_IN),
+        "bytes_out": sum(r.length for r in records if r.kind == TRACE_OUT),
+        "bytes_in": sum(r.length for r in records if r.kind == TRACE_IN),
+        "failed": sum(1 for r in records if r.flags & TRACE_FAILED),
+        "commands": commands,
+        "host_idle": idle,
+        "host_idle_ratio": idle / duration if duration else 0.0,
+        "host_gaps": len(gaps),
+        "longest_gaps": [
+            {
+                "at": start,
+                "length": length,
+                "segment": stages[bisect.bisect_right(seg_starts, start) - 1]["name"],
+                "after": labels[before],
+                "before": labels[after],
+            }
+            for start, length, before, after in longest[:top]
+        ],
+        "segments": stages,
+    }
+
+
+def print_summary(path: str, summary: dict):
+    device = summary["device"] or "?"
+    axp = f", {summary['axp']}" if summary["axp"] else ""
+    print(f"{path}: {device}{axp}")
+    print(
+        f"  {summary['duration']:.3f}s, {summary['transfers_out']} OUT "
+        f"({summary['bytes_out'] / 1e6:.1f} MB) / {summary['transfers_in']} IN "
+        f"({summary['bytes_in'] / 1e6:.1f} MB) transfers"
+        + (f", {summary['failed']} failed" if summary["failed"] else "")
+    )
+    print(
+        f"  host idle {summary['host_idle']:.3f}s "
+        f"({summary['host_idle_ratio']:.1%}) in {summary['host_gaps']} gaps"
+    )
+    print("  commands (ms):       count     mean      p50      p90      p99      max")
+    for name, st in summary["commands"].items():
+        timeouts = f"  {st['timeouts']} timeout(s)" if st["timeouts"] else ""
+        print(
+            f"    {name:<18}{st['count']:>6} "
+            + " ".join(
+                f"{st[k] * 1000:8.2f}" for k in ("mean", "p50", "p90", "p99", "max")
+            )
+            + timeouts
+        )
+    print("  segments:")
+    for seg in summary["segments"]:
+        rate = f"  {seg['mb_per_s']:.1f} MB/s" if seg.get("mb_per_s") else ""
+        print(
+            f"    {seg['name']:<24}{seg['seconds']:9.3f}s "
+            f"{seg['bytes'] / 1e6:9.2f} MB{rate}"
+        )
+    if summary["longest_gaps"]:
+        print("  longest host gaps:")
+        for gap in summary["longest_gaps"]:
+            print(
+                f"    {gap['length'] * 1000:8.2f} ms at {gap['at']:.3f}s in "
+                f"{gap['segment']}: after {gap['after']}, before {gap['before']}"
+            )
+
+
+def replay(records: list, port, pace=False, timeout=10000) -> dict:
+    """
+    Replay records (see read_trace) against an opened port: OUT transfers are
+    written again (the part of a data transfer not in the trace as zeros)
+    and every IN transfer becomes a read of the recorded length.  An empty
+    read is replayed with its recorded duration as timeout.  With pace, the
+    recorded host gaps are kept before each transfer.
+    Returns {"seconds", "transfers", "mismatched" (stored replies read back
+    different), "stopped" (why the replay ended early, or None)}.
+    """
+    gaps = {}
+    if pace:
+        gaps = {after: length for _, length, _, after in host_gaps(records)}
+    result = {"seconds": 0.0, "transfers": 0, "mismatched": 0, "stopped": None}
+    start = last_end = time.monotonic()
+    # Recorded host time not spent yet; the replay's own overhead counts
+    # against it and short gaps add up until worth a sleep.
+    owed = 0.0
+    for i, rec in enumerate(records):
+        if rec.flags & TRACE_FAILED:
+            result["stopped"] = f"transfer {i} failed in the recorded session"
+            break
+        if i in gaps:
+            owed += gaps[i] - (time.monotonic() - last_end)
+            if owed > 0.001:
+                slept = time.monotonic()
+                time.sleep(owed)
+                owed -= time.monotonic() - slept
+        if rec.kind == TRACE_OUT:
+            data = rec.data
+            if not rec.flags & TRACE_WHOLE:
+                data += bytes(rec.length - len(data))
+            port.write(data)
+        elif rec.length:
+            data = port.read(rec.length, timeout=timeout)
+            if not data:
+                result["stopped"] = f"no reply to transfer {i} in {timeout} ms"
+                break
+            if rec.flags & TRACE_WHOLE and data != rec.data:
+                result["mismatched"] += 1
+        else:
+            port.read(512, timeout=max(1, int(rec.duration * 1000)))
+        result["transfers"] += 1
+        last_end = time.monotonic()
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def print_comparison(recorded: dict, replayed: dict):
+    print(
+        f"  total:  {recorded['duration']:9.3f}s recorded, "
+        f"{replayed['duration']:9.3f}s replayed"
+    )
+    print(
+        f"  host idle: {recorded['host_idle']:.3f}s recorded, "
+        f"{replayed['host_idle']:.3f}s replayed"
+    )
+    print("  mean latency (ms):   recorded  replayed")
+    for name, st in recorded["commands"].items():
+        other = replayed["commands"].get(name)
+        again = f"{other['mean'] * 1000:10.2f}" if other else "         -"
+        print(f"    {name:<18}{st['mean'] * 1000:10.2f}{again}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze or replay the session traces of axdl_tool.py --trace.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary_parser = sub.add_parser(
+        "summary", help="Command latencies, host gaps and segments of traces."
+    )
+    summary_parser.add_argument("traces", nargs="+", help="Trace files.")
+    summary_parser.add_argument(
+        "--gap-ms",
+        type=float,
+        default=5.0,
+        help="List host gaps of at least this length (default 5).",
+    )
+    summary_parser.add_argument(
+        "--top", type=int, default=10, help="Longest gaps listed (default 10)."
+    )
+    summary_parser.add_argument("--json", action="store_true", help="Print JSON.")
+    replay_parser = sub.add_parser(
+        "replay", help="Replay a trace against the device simulator."
+    )
+    replay_parser.add_argument("trace", help="Trace file.")
+    replay_parser.add_argument(
+        "--sim",
+        default="",
+        help="Simulator options (see axdl_sim.py), e.g. latency_ms=0.25.",
+    )
+    replay_parser.add_argument(
+        "--pace",
+        action="store_true",
+        help="Keep the recorded host gaps instead of replaying flat out.",
+    )
+    replay_parser.add_argument(
+        "--timeout",
+        type=int,
+        default=10000,
+        help="Read timeout in ms for a recorded reply (default 10000).",
+    )
+    replay_parser.add_argument(
+        "--out", metavar="FILE", help="Keep the trace of the replay in FILE."
+    )
+    replay_parser.add_argument("--json", action="store_true", help="Print JSON.")
+    parser.add_argument("--debug", action="store_true", help="Enable debug logging.")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+    )
+
+    if args.command == "summary":
+        failed = False
+        results = {}
+        for path in args.traces:
+            try:
+                meta, records = read_trace(path)
+            except (OSError, TraceFormatError) as e:
+                print(f"{path}: {e}", file=sys.stderr)
+                failed = True
+                continue
+            results[path] = analyze(meta, records, args.gap_ms / 1000.0, args.top)
+            if not args.json:
+                print_summary(path, results[path])
+        if args.json:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        sys.exit(1 if failed else 0)
+
+    import axdl_sim
+
+    try:
+        meta, records = read_trace(args.trace)
+    except (OSError, TraceFormatError) as e:
+        parser.error(f"{args.trace}: {e}")
+    recorded = analyze(meta, records)
+    out = args.out
+    if out is None:
+        fd, out = tempfile.mkstemp(suffix=".axtrace")
+        os.close(fd)
+    try:
+        device = axdl_sim.make_sim_device(axdl_sim.parse_sim_spec(args.sim))
+        port = TracePort(device, out, meta={"replay_of": args.trace})
+        port.open()
+        try:
+            result = replay(records, port, pace=args.pace, timeout=args.timeout)
+        finally:
+            port.close()
+        replayed = analyze(*read_trace(out))
+    finally:
+        if args.out is None:
+            os.unlink(out)
+    if args.json:
+        json.dump(
+            {"replay": result, "recorded": recorded, "replayed": replayed},
+            sys.stdout,
+            indent=2,
+        )
+        print()
+    else:
+        print(
+            f"{args.trace}: replayed {result['transfers']}/{len(records)} "
+            f"transfers in {result['seconds']:.3f}s"
+            + (" keeping the host gaps" if args.pace else "")
+        )
+        if result["mismatched"]:
+            print(f"  {result['mismatched']} reply(s) differ from the recording")
+        if result["stopped"]:
+            print(f"  stopped: {result['stopped']}")
+        print_comparison(recorded, replayed)
+    sys.exit(1 if result["stopped"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Shared helpers of the simulator-driven regression tests.
+
+Run from tools/bin with: python -m pytest -q tests
+"""
+import json
+import os
+import sys
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import axdl_bench  # noqa: E402
+import axdl_sim  # noqa: E402
+import axdl_tool  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep flash history, checkpoints and learnt timeouts per test."""
+    path = tmp_path / "cache"
+    monkeypatch.setenv("XDG_CACHE_HOME", str(path))
+    return path
+
+
+def make_axp(path, spec: str, fill="random", seed=0) -> str:
+    """Write a synthetic AXP (see axdl_bench.parse_partitions) and return its path."""
+    axdl_bench.make_synthetic_axp(
+        str(path), axdl_bench.parse_partitions(spec), fill=fill, seed=seed
+    )
+    return str(path)
+
+
+def replace_image(axp: str, part_id: str, data: bytes):
+    """Rewrite the image of one partition of an AXP in place."""
+    with zipfile.ZipFile(axp, "r") as zf:
+        members = [(info, zf.read(info)) for info in zf.infolist()]
+    with zipfile.ZipFile(axp, "w") as zf:
+        for info, content in members:
+            zf.writestr(info, data if info.filename == f"{part_id}.img" else content)
+
+
+def image_bytes(axp: str, part_id: str) -> bytes:
+    with zipfile.ZipFile(axp, "r") as zf:
+        return zf.read(f"{part_id}.img")
+
+
+def flash(tmp_path, axp: str, sim: str, *args) -> tuple:
+    """
+    Run axdl_tool.main() against the simulator, one board through --all.
+    Returns (exit code, device entry of the --timings report), the entry
+    being None when the run ended before any board was flashed.
+    """
+    code, devices = flash_boards(tmp_path, axp, sim, *args)
+    if devices is None:
+        return code, None
+    (device,) = devices
+    return code, device
+
+
+def flash_boards(tmp_path, axp: str, sim: str, *args) -> tuple:
+    """
+    flash() for any number of boards (sim "devices=N"): returns (exit code,
+    device entries of the --timings report, by device path) or (code, None).
+    """
+    timings = str(tmp_path / "timings.json")
+    if os.path.exists(timings):
+        os.remove(timings)
+    argv = ["--axp", axp, "--sim", sim, "--all", "--no-progress"]
+    argv += ["--timings", timings] + list(args)
+    try:
+        axdl_tool.main(argv)
+        code = 0
+    except SystemExit as e:
+        code = e.code or 0
+    if not os.path.exists(timings):
+        return code, None
+    with open(timings, "r", encoding="utf-8") as f:
+        devices = json.load(f)["devices"]
+    return code, sorted(devices, key=lambda d: d["device"])
+
+
+def image_phases(device: dict) -> list:
+    """Names of the images a run sent, e.g. ["SPL", "ROOTFS"]."""
+    return [
+        p["name"][len("image:") :]
+        for p in device["phases"]
+        if p["name"].startswith("image:")
+    ]
+
+
+def read_partition(backing: str, name: str, length: int) -> bytes:
+    """First length bytes of a partition in a simulator's backing file."""
+    dev = axdl_sim.SimulatedDevice(backing_path=backing)
+    dev.open()
+    try:
+        return dev.read_partition(name, 0, length)
+    finally:
+        dev.close()
@@ -0,0 +1,89 @@
+"""--async: boards flashed from one event loop, by the same protocol steps."""
+
+import asyncio
+
+import pytest
+
+import axdl_async
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash_boards, image_phases, make_axp
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+
+
+def test_async_flashes_several_boards(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, devices = flash_boards(tmp_path, axp, "latency_ms=2,devices=3", "--async")
+    assert code == 0
+    assert [d["device"] for d in devices] == ["sim-1", "sim-2", "sim-3"]
+    for dev in devices:
+        assert dev["ok"] and dev["phase"] == "done"
+        assert image_phases(dev) == ["SPL", "KERNEL", "ROOTFS"]
+
+
+def test_async_board_failure_leaves_the_others(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    # Every board disconnects part way through KERNEL
+    sim = "latency_ms=1,devices=2,disconnect_after=900000"
+    code, devices = flash_boards(tmp_path, axp, sim, "--async", "--window", "4")
+    assert code == 1
+    for dev in devices:
+        assert not dev["ok"] and dev["failed_phase"] == "image:KERNEL"
+        assert dev["error"]
+
+
+def session_phases(tool) -> list:
+    return [(p["name"], p["bytes_out"], p["bytes_in"]) for p in tool.timer.report()]
+
+
+@pytest.mark.parametrize("window", [1, 4])
+def test_both_transports_make_the_same_transfers(tmp_path, window):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+
+    def make_tool():
+        tool = axdl_tool.AXDLTool(data_window=window)
+        tool.progress_enabled = False
+        tool.verify = True
+        return tool
+
+    sync_tool = make_tool()
+    with axdl_tool.FlashSession(plan, SimulatedDevice(), tool=sync_tool) as session:
+        session.run(reset=True)
+
+    async def run_async():
+        port = axdl_async.AsyncPort(SimulatedDevice())
+        async with axdl_async.AsyncFlashSession(plan, port, tool=async_tool) as s:
+            await s.run(reset=True)
+        return s.status
+
+    async_tool = make_tool()
+    status = asyncio.run(run_async())
+    assert status.ok
+    assert session_phases(async_tool) == session_phases(sync_tool)
+
+
+class EraseFails(SimulatedDevice):
+    def _erase(self, payload):
+        self._respond(axdl_tool.BSL_REP_OPERATION_FAILED)
+
+
+def test_async_session_raises_flash_errors(tmp_path):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    tool = axdl_tool.AXDLTool()
+    tool.progress_enabled = False
+
+    async def run():
+        port = axdl_async.AsyncPort(EraseFails(latency=0.002))
+        async with axdl_async.AsyncFlashSession(plan, port, tool=tool) as session:
+            await session.handshake_rom()
+            await session.load_fdl1()
+            await session.handshake_fdl1()
+            await session.load_fdl2()
+            await session.repartition()
+            await session.write_images()
+
+    with pytest.raises(axdl_tool.ImageError) as info:
+        asyncio.run(run())
+    assert info.value.phase == "images"
+    assert tool.timer.report()[-1]["name"] == "erase:kernel"
@@ -0,0 +1,87 @@
+"""Images streamed straight out of the AXP zip, never extracted."""
+
+import os
+import tempfile
+import zipfile
+
+import pytest
+
+import axdl_tool
+from conftest import flash, image_bytes, make_axp, read_partition
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+MODES = pytest.mark.parametrize("mode", [[], ["--async"]], ids=["sync", "async"])
+
+
+def no_extraction(*args, **kwargs):
+    raise AssertionError("an AXP member was extracted")
+
+
+@MODES
+def test_images_are_flashed_without_extracting_them(tmp_path, monkeypatch, mode):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    monkeypatch.setattr(zipfile.ZipFile, "extract", no_extraction)
+    monkeypatch.setattr(zipfile.ZipFile, "extractall", no_extraction)
+    monkeypatch.setattr(tempfile, "TemporaryDirectory", no_extraction)
+    monkeypatch.setattr(tempfile, "mkdtemp", no_extraction)
+    code, dev = flash(tmp_path, axp, f"latency_ms=1,backing={backing}", *mode)
+    assert code == 0 and dev["ok"]
+    for part_id in ("spl", "kernel", "rootfs"):
+        data = image_bytes(axp, part_id)
+        assert read_partition(str(backing), part_id, len(data)) == data
+
+
+def test_member_readers_return_the_member(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    plan = axdl_tool.FlashPlan.load(axp)
+    for part_id, stored in (("kernel", True), ("rootfs", False)):
+        src = plan.image_sources[f"{part_id}.img"]
+        assert isinstance(src, axdl_tool.ZipMemberImageSource)
+        assert src.is_stored == stored
+        # Odd read sizes cross the inflater's internal pieces
+        pieces = []
+        with src.open() as f:
+            while True:
+                piece = f.read(12345)
+                if not piece:
+                    break
+                pieces.append(piece)
+        assert b"".join(pieces) == image_bytes(axp, part_id)
+
+
+def recompress(axp: str, member: str, compress_type: int):
+    with zipfile.ZipFile(axp, "r") as zf:
+        members = [(info, zf.read(info)) for info in zf.infolist()]
+    with zipfile.ZipFile(axp, "w") as zf:
+        for info, content in members:
+            if info.filename == member:
+                info.compress_type = compress_type
+            zf.writestr(info, content)
+
+
+def test_other_compression_is_streamed_through_zipfile(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    recompress(axp, "spl.img", zipfile.ZIP_BZIP2)
+    backing = tmp_path / "flash.bin"
+    code, dev = flash(tmp_path, axp, f"latency_ms=1,backing={backing}")
+    assert code == 0 and dev["ok"]
+    data = image_bytes(axp, "spl")
+    assert read_partition(str(backing), "spl", len(data)) == data
+
+
+def test_damaged_deflated_member_fails_its_image(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    with zipfile.ZipFile(axp, "r") as zf:
+        info = zf.getinfo("rootfs.img")
+    with open(axp, "r+b") as f:
+        offset = axdl_tool.zip_member_data_offset(f, info)
+        # Flip a byte well inside the compressed data
+        f.seek(offset + info.compress_size // 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    code, dev = flash(tmp_path, axp, "latency_ms=1")
+    assert code == 1 and not dev["ok"]
+    assert dev["failed_phase"] == "image:ROOTFS"
+    assert "Bad CRC-32" in dev["error"]
@@ -0,0 +1,133 @@
+"""--bus-schedule: image data admission per host controller."""
+
+import types
+
+import pytest
+
+import axdl_tool
+from conftest import flash_boards, make_axp
+
+POLL = axdl_tool.BUS_SAMPLE_TIME / 2
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(axdl_tool, "time", types.SimpleNamespace(monotonic=clock))
+    return clock
+
+
+class Board:
+    """A board in an image download, moving data when told to."""
+
+    def __init__(self, scheduler):
+        self.timer = axdl_tool.PhaseTimer()
+        self.timer.phases.append(
+            {"name": "image:ROOTFS", "bytes_out": 0, "bytes_in": 0}
+        )
+        self.scheduler = scheduler
+        self.slot = None
+
+    def enter(self) -> bool:
+        self.slot = self.scheduler.try_acquire("bus", self.timer)
+        return self.slot is not None
+
+    def leave(self):
+        self.scheduler.release(self.slot)
+        self.slot = None
+
+
+def run(clock, scheduler, boards, rate: float, polls=2, stalled=()):
+    """
+    Let the active boards share rate bytes/s for polls wait intervals, the
+    scheduler polled after each as its waiters do; stalled boards move none.
+    """
+    moving = [b for b in boards if b.slot is not None and b not in stalled]
+    for _ in range(polls):
+        clock.now += POLL
+        for board in moving:
+            board.timer.phases[0]["bytes_out"] += int(rate * POLL / len(moving))
+        with scheduler._cond:
+            scheduler._sample("bus", scheduler._bus("bus"))
+
+
+def test_next_board_waits_for_a_measured_level(clock):
+    scheduler = axdl_tool.BusScheduler()
+    first, second = Board(scheduler), Board(scheduler)
+    assert first.enter()
+    assert not second.enter()
+    run(clock, scheduler, [first], 10e6)
+    assert second.enter()
+    assert scheduler._buses["bus"]["rates"] == {1: pytest.approx(10e6, rel=0.01)}
+
+
+def test_level_that_does_not_pay_off_is_given_up(clock):
+    scheduler = axdl_tool.BusScheduler()
+    boards = [Board(scheduler) for _ in range(3)]
+    assert boards[0].enter()
+    run(clock, scheduler, boards, 10e6)
+    assert boards[1].enter()
+    # Two boards share what one had: the bus is saturated
+    run(clock, scheduler, boards, 10e6)
+    bus = scheduler._buses["bus"]
+    assert bus["limit"] == 1
+    assert not boards[2].enter()
+    boards[1].leave()
+    # The level was measured not to pay off, so it is not tried again...
+    run(clock, scheduler, boards, 10e6)
+    assert not boards[2].enter()
+    # ...until its measurement is old
+    run(clock, scheduler, boards, 10e6, polls=int(axdl_tool.BUS_REPROBE_TIME / POLL))
+    assert boards[2].enter()
+    assert bus["limit"] == 2
+
+
+def test_level_that_pays_off_lets_one_more_in(clock):
+    scheduler = axdl_tool.BusScheduler()
+    boards = [Board(scheduler) for _ in range(3)]
+    assert boards[0].enter()
+    run(clock, scheduler, boards, 10e6)
+    assert boards[1].enter()
+    run(clock, scheduler, boards, 18e6)
+    assert boards[2].enter()
+    assert scheduler._buses["bus"]["limit"] == 3
+
+
+def test_waits_between_transfers_are_not_measured(clock):
+    scheduler = axdl_tool.BusScheduler()
+    boards = [Board(scheduler) for _ in range(3)]
+    assert boards[0].enter()
+    run(clock, scheduler, boards, 10e6)
+    assert boards[1].enter()
+    # The second board waits on an erase: the other one alone moves data
+    run(clock, scheduler, boards, 10e6, polls=4, stalled=[boards[1]])
+    bus = scheduler._buses["bus"]
+    assert 2 not in bus["rates"] and bus["limit"] == 2
+    run(clock, scheduler, boards, 18e6)
+    assert boards[2].enter()
+
+
+def test_max_per_bus_caps_a_level_that_pays_off(clock):
+    scheduler = axdl_tool.BusScheduler(max_per_bus=2)
+    boards = [Board(scheduler) for _ in range(3)]
+    assert boards[0].enter()
+    run(clock, scheduler, boards, 10e6)
+    assert boards[1].enter()
+    run(clock, scheduler, boards, 18e6)
+    assert not boards[2].enter()
+
+
+def test_bus_schedule_flashes_several_boards(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", "spl:256K,kernel:512K:erase,rootfs:1M")
+    sim = "latency_ms=1,devices=3"
+    code, devices = flash_boards(tmp_path, axp, sim, "--bus-schedule")
+    assert code == 0
+    assert [d["ok"] for d in devices] == [True, True, True]
@@ -0,0 +1,98 @@
+"""BSL packet codec: word sums, packet templates and the packet cache."""
+
+import struct
+
+import pytest
+
+import axdl_tool
+from axdl_tool import (
+    AXDLGlobData,
+    AXDLTool,
+    BSL_CMD_CONNECT,
+    BSL_CMD_MIDST_DATA,
+    data_checksum16,
+    decode_packet,
+    encode_packet,
+    midst_header_packet,
+)
+
+
+def reference_checksum16(data: bytes) -> int:
+    """The original byte-at-a-time AXDLTool.checksum16."""
+    total = 0
+    for idx in range(0, len(data) - 1, 2):
+        total = (total + (data[idx] | (data[idx + 1] << 8))) & 0xFFFFFFFF
+    if len(data) % 2 == 1:
+        total = (total + data[-1]) & 0xFFFFFFFF
+    while (total >> 16) != 0:
+        total = (total & 0xFFFF) + (total >> 16)
+    return (~total) & 0xFFFF
+
+
+def reference_packet(cmd: int, payload: bytes) -> bytes:
+    body = struct.pack("<HH", len(payload), cmd) + payload
+    return (
+        struct.pack("<I", AXDLGlobData.MAGIC_NUMBER)
+        + body
+        + struct.pack("<H", reference_checksum16(body))
+    )
+
+
+PAYLOADS = [
+    b"",
+    b"\x01",
+    b"\xff\xfe\xfd",
+    bytes(range(256)) * 3,
+    b"\xff" * 70001,
+    bytes(range(7)) * 9363,
+]
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+@pytest.mark.parametrize("payload", PAYLOADS, ids=lambda p: f"{len(p)}B")
+def test_checksum_matches_the_original(monkeypatch, payload, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(axdl_tool, "numpy", None)
+    assert data_checksum16(payload) == reference_checksum16(payload)
+    assert data_checksum16(memoryview(payload)) == reference_checksum16(payload)
+
+
+@pytest.mark.parametrize(
+    "payload", [p for p in PAYLOADS if len(p) <= 0xFFFF], ids=lambda p: f"{len(p)}B"
+)
+def test_packet_round_trip(payload):
+    pkt = encode_packet(BSL_CMD_MIDST_DATA, payload)
+    assert pkt == reference_packet(BSL_CMD_MIDST_DATA, payload)
+    cmd, decoded = decode_packet(pkt)
+    assert cmd == BSL_CMD_MIDST_DATA
+    assert bytes(decoded) == payload
+
+
+def test_decode_rejects_damaged_packets():
+    pkt = encode_packet(BSL_CMD_CONNECT, b"\x12\x34\x56")
+    assert decode_packet(pkt[:7]) is None
+    assert decode_packet(pkt[:-1]) is None
+    assert decode_packet(b"\x00" + pkt[1:]) is None
+    damaged = bytearray(pkt)
+    damaged[9] ^= 0x01
+    assert decode_packet(bytes(damaged)) is None
+
+
+@pytest.mark.parametrize(
+    "size,enable,checksum",
+    [(0, 0, 0), (0xB000, 0, 0), (0xB000, 1, 0xBEEF), (0xFFFFFFFF, 1, 0xFFFF)],
+)
+def test_midst_header_template(size, enable, checksum):
+    payload = struct.pack("<III", size, enable, checksum)
+    assert midst_header_packet(size, enable, checksum) == reference_packet(
+        BSL_CMD_MIDST_DATA, payload
+    )
+
+
+def test_cached_packets_match_fresh_ones():
+    tool = AXDLTool()
+    for payload in (b"", b"\x01\x02", bytes(100)):
+        first = tool.build_packet(BSL_CMD_CONNECT, payload)
+        assert first == reference_packet(BSL_CMD_CONNECT, payload)
+        assert tool.build_packet(BSL_CMD_CONNECT, payload) == first
+        assert tool.parse_packet(first)[0] == BSL_CMD_CONNECT
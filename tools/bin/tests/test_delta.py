@@ -0,0 +1,92 @@
+"""--delta: partitions unchanged since the last flash of a board are skipped."""
+
+import os
+
+from conftest import (
+    flash,
+    image_bytes,
+    image_phases,
+    make_axp,
+    read_partition,
+    replace_image,
+)
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+TOTAL = (256 + 512 + 1024) * 1024
+
+
+def sim_spec(tmp_path, serial=None) -> str:
+    spec = f"latency_ms=0,backing={tmp_path / 'flash.bin'}"
+    return f"{spec},serial={serial}" if serial else spec
+
+
+def test_unchanged_partitions_are_skipped(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = sim_spec(tmp_path, serial="SN1")
+    code, dev = flash(tmp_path, axp, sim, "--delta")
+    assert code == 0 and dev["image_bytes"] == TOTAL
+
+    code, dev = flash(tmp_path, axp, sim, "--delta")
+    assert code == 0
+    assert dev["image_bytes"] == 0
+    assert image_phases(dev) == []
+
+
+def test_changed_partition_is_flashed(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = sim_spec(tmp_path, serial="SN1")
+    assert flash(tmp_path, axp, sim, "--delta")[0] == 0
+
+    replace_image(axp, "rootfs", os.urandom(len(image_bytes(axp, "rootfs"))))
+    code, dev = flash(tmp_path, axp, sim, "--delta")
+    assert code == 0
+    assert image_phases(dev) == ["ROOTFS"]
+    assert dev["image_bytes"] == 1024 * 1024
+
+
+def test_axp_rewritten_with_the_same_size_and_mtime(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = sim_spec(tmp_path, serial="SN1")
+    assert flash(tmp_path, axp, sim, "--delta")[0] == 0
+
+    # KERNEL is stored, so the AXP keeps its size; its mtime is put back
+    st = os.stat(axp)
+    kernel = os.urandom(len(image_bytes(axp, "kernel")))
+    replace_image(axp, "kernel", kernel)
+    os.utime(axp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.path.getsize(axp) == st.st_size
+
+    code, dev = flash(tmp_path, axp, sim, "--delta")
+    assert code == 0
+    assert image_phases(dev) == ["KERNEL"]
+    backing = str(tmp_path / "flash.bin")
+    assert read_partition(backing, "kernel", len(kernel)) == kernel
+
+
+def test_another_board_is_flashed_in_full(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    assert flash(tmp_path, axp, sim_spec(tmp_path, serial="SN1"), "--delta")[0] == 0
+
+    code, dev = flash(tmp_path, axp, sim_spec(tmp_path, serial="SN2"), "--delta")
+    assert code == 0 and dev["image_bytes"] == TOTAL
+
+
+def test_board_without_serial_is_flashed_in_full(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = sim_spec(tmp_path)
+    for _ in range(2):
+        code, dev = flash(tmp_path, axp, sim, "--delta")
+        assert code == 0 and dev["image_bytes"] == TOTAL
+
+
+def test_partial_flash_without_serial_repartitions(tmp_path, caplog):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    assert flash(tmp_path, axp, sim_spec(tmp_path), "--delta")[0] == 0
+
+    # A blank board on the same port, which only its path identifies
+    sim = f"latency_ms=0,backing={tmp_path / 'blank.bin'}"
+    code, dev = flash(tmp_path, axp, sim, "--only", "spl")
+    assert code == 0
+    assert image_phases(dev) == ["SPL"]
+    assert "repartitioning" in caplog.text
+    assert any(p["name"] == "repartition" for p in dev["phases"])
@@ -0,0 +1,97 @@
+"""ERASEFLASH entries elided when the next image rewrites the whole partition."""
+
+import json
+import logging
+
+import pytest
+
+import axdl_station
+import axdl_tool
+from conftest import flash, flash_boards, image_bytes, make_axp, read_partition
+
+FULL = "spl:256K,kernel:1M:erase,rootfs:1M:deflate"
+PARTIAL = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+
+
+def phase_names(dev: dict) -> list:
+    return [p["name"] for p in dev["phases"]]
+
+
+def test_erase_of_a_rewritten_partition_is_elided(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    backing = tmp_path / "flash.bin"
+    # Leave other data in the partition first
+    old = make_axp(tmp_path / "old.axp", FULL, seed=1)
+    code, _ = flash_boards(tmp_path, old, f"latency_ms=0,devices=2,backing={backing}")
+    assert code == 0
+    axp = make_axp(tmp_path / "a.axp", FULL, seed=2)
+    sim = f"latency_ms=2,erase_ms=50,devices=2,backing={backing}"
+    code, devices = flash_boards(tmp_path, axp, sim, "--window", "4")
+    assert code == 0
+    assert "Eliding 1 erase(s) of partitions rewritten in full" in caplog.text
+    for dev in devices:
+        assert dev["ok"]
+        assert "erase:kernel" not in phase_names(dev)
+        data = image_bytes(axp, "kernel")
+        assert read_partition(f"{backing}.{dev['device']}", "kernel", len(data)) == data
+
+
+def test_keep_erases_sends_them(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", FULL)
+    code, dev = flash(tmp_path, axp, "latency_ms=1", "--keep-erases")
+    assert code == 0 and dev["ok"]
+    assert "erase:kernel" in phase_names(dev)
+
+
+def test_erase_of_a_partly_written_partition_is_kept(tmp_path):
+    backing = tmp_path / "flash.bin"
+    old = make_axp(tmp_path / "old.axp", FULL, seed=1)
+    code, _ = flash(tmp_path, old, f"latency_ms=0,backing={backing}")
+    assert code == 0
+    axp = make_axp(tmp_path / "a.axp", PARTIAL, seed=2)
+    code, dev = flash(tmp_path, axp, f"latency_ms=1,backing={backing}")
+    assert code == 0 and dev["ok"]
+    assert "erase:kernel" in phase_names(dev)
+    # The rest of the partition no longer holds the old image
+    kernel = read_partition(str(backing), "kernel", 1 << 20)
+    assert kernel[: 512 << 10] == image_bytes(axp, "kernel")
+    assert kernel[512 << 10 :] == bytes(512 << 10)
+
+
+def test_erase_before_a_sparse_image_is_kept(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", "spl:256K,kernel:1M:erase:sparse")
+    plan = axdl_tool.FlashPlan.load(axp)
+    assert plan.image_sources["kernel.img"].sparse
+    assert plan.elide_erases()[1] == 0
+    code, dev = flash(tmp_path, axp, "latency_ms=1,unsparse=1")
+    assert code == 0 and dev["ok"]
+    assert "erase:kernel" in phase_names(dev)
+
+
+def test_plan_shows_the_elided_erase(tmp_path, capsys):
+    axp = make_axp(tmp_path / "a.axp", FULL)
+    with pytest.raises(SystemExit):
+        axdl_tool.main(["--axp", axp, "--plan", "json"])
+    ops = json.loads(capsys.readouterr().out)["operations"]
+    (erase,) = [op for op in ops if op["op"] == "erase"]
+    assert erase["elided"] and erase["bytes"] == 0 and erase["estimate"] == 0
+    with pytest.raises(SystemExit):
+        axdl_tool.main(["--axp", axp, "--plan", "json", "--keep-erases"])
+    ops = json.loads(capsys.readouterr().out)["operations"]
+    (erase,) = [op for op in ops if op["op"] == "erase"]
+    assert "elided" not in erase and erase["bytes"] == 1 << 20
+
+
+@pytest.mark.parametrize("keep", [[], ["--keep-erases"]], ids=["elided", "kept"])
+def test_station_elides_erases(tmp_path, keep):
+    axp = make_axp(tmp_path / "a.axp", FULL)
+    report = tmp_path / "report.jsonl"
+    argv = ["--axp", axp, "--sim", "latency_ms=1,devices=2", "--count", "2"]
+    argv += ["--watch", "poll", "--settle", "0.05", "--report", str(report)]
+    axdl_station.main(argv + keep)
+    with open(report, "r", encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == 2
+    for entry in entries:
+        assert entry["ok"]
+        assert ("erase:kernel" in phase_names(entry)) == bool(keep)
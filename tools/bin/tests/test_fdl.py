@@ -0,0 +1,106 @@
+"""FDL uploads: lock-step by default, probed chunk sizes with --fdl-probe."""
+
+import json
+import logging
+import os
+import random
+
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash, make_axp
+
+SPEC = "spl:256K"
+LOGGER = logging.getLogger("test_fdl")
+
+
+def upload(port, blob: bytes, profile=None) -> bool:
+    """Upload blob as FDL1 to the ROM of port with --fdl-probe settings."""
+    tool = axdl_tool.AXDLTool()
+    tool.progress_enabled = False
+    tool.fdl_probe = True
+    tool.fdl_profile = profile
+    port.open()
+    try:
+        assert tool.handshake(port, LOGGER) and tool.cmd_connect(port, LOGGER)
+        src = axdl_tool.BytesImageSource("fdl1.bin", blob)
+        return tool.download_fdl(port, LOGGER, src, 0x3000000, "FDL1")
+    finally:
+        port.close()
+
+
+def kept(path) -> dict:
+    """Settings an FdlProfile file holds, by uploading stage."""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["stages"]
+
+
+def test_picky_stages_take_the_default_upload(tmp_path, cache_dir):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=1,fdl_chunk_max=1000,fdl_split=1"
+    code, dev = flash(tmp_path, axp, sim)
+    assert code == 0 and dev["ok"]
+    # Nothing was probed, so nothing is kept
+    assert not os.path.exists(cache_dir / "axdl_tool" / "fdl_profile.json")
+
+
+def test_probe_finds_the_largest_chunks_taken(tmp_path, cache_dir):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=1,fdl_chunk_max=16384"
+    code, dev = flash(tmp_path, axp, sim, "--fdl-probe")
+    assert code == 0 and dev["ok"]
+    known = kept(cache_dir / "axdl_tool" / "fdl_profile.json")
+    assert sorted(key.split("/")[0] for key in known) == ["FDL1", "ROM CODE"]
+    assert all(v["chunk_size"] == 16384 for v in known.values())
+    # FDL2 (384 KB) also probed header and data in one transfer
+    (fdl1,) = [v for key, v in known.items() if key.startswith("FDL1/")]
+    assert fdl1["combine"] is True
+
+    # The next board takes the kept settings straight away
+    code, dev = flash(tmp_path, axp, sim, "--fdl-probe")
+    assert code == 0 and dev["ok"]
+
+
+class SilentOnLargeChunks(SimulatedDevice):
+    """A stage that does not answer FDL chunk headers above 4 KB at all."""
+
+    def _midst_header(self, payload):
+        fdl = self._download is not None and "data" in self._download
+        if fdl and int.from_bytes(payload[:4], "little") > 4096:
+            return
+        super()._midst_header(payload)
+
+
+def test_unanswered_header_is_a_refused_size(monkeypatch):
+    monkeypatch.setattr(axdl_tool, "FDL_HEADER_TIMEOUT", 200)
+    blob = random.Random(1).randbytes(3 * 4096 + 100)
+    port = SilentOnLargeChunks()
+    assert upload(port, blob)
+    assert list(port.fdl_images.values()) == [blob]
+
+
+def test_slow_data_ack_is_waited_for(tmp_path):
+    # Slower than any probe would wait; the data must not be sent twice
+    blob = random.Random(2).randbytes(2 * 4096)
+    port = SimulatedDevice(fdl_chunk_max=4096, fdl_ack_time=1.2)
+    profile = axdl_tool.FdlProfile(str(tmp_path / "fdl_profile.json"))
+    assert upload(port, blob, profile)
+    assert list(port.fdl_images.values()) == [blob]
+    (known,) = kept(profile.path).values()
+    assert known["chunk_size"] == 4096 and known["combine"] is True
+
+
+def test_stage_dropping_combined_data_falls_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(axdl_tool, "FDL_DATA_TIMEOUT", 300)
+    blob = random.Random(3).randbytes(3 * 4096)
+    profile = axdl_tool.FdlProfile(str(tmp_path / "fdl_profile.json"))
+    # The chunk sent with its header is dropped: the upload fails rather
+    # than send data the stage may have taken
+    assert not upload(
+        SimulatedDevice(fdl_chunk_max=4096, fdl_split=True), blob, profile
+    )
+    (known,) = kept(profile.path).values()
+    assert known["fallback"] and known["chunk_size"] == axdl_tool.FDL_LEGACY_CHUNK
+
+    port = SimulatedDevice(fdl_chunk_max=4096, fdl_split=True)
+    assert upload(port, blob, profile)
+    assert list(port.fdl_images.values()) == [blob]
@@ -0,0 +1,72 @@
+"""Handshakes and CONNECT on slow links and with booting stages."""
+
+import asyncio
+
+import pytest
+
+import axdl_async
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash, make_axp
+
+SPEC = "spl:64K"
+MODES = pytest.mark.parametrize("mode", ["sync", "async"])
+
+
+def up_to_fdl1(tmp_path, mode: str, **sim) -> axdl_tool.AXDLTool:
+    """Run the session up to the FDL1 CONNECT; return its tool."""
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    tool = axdl_tool.AXDLTool()
+    tool.progress_enabled = False
+    if mode == "sync":
+        with axdl_tool.FlashSession(plan, SimulatedDevice(**sim), tool=tool) as s:
+            s.handshake_rom()
+            s.load_fdl1()
+            s.handshake_fdl1()
+        return tool
+
+    async def run():
+        port = axdl_async.AsyncPort(SimulatedDevice(**sim))
+        async with axdl_async.AsyncFlashSession(plan, port, tool=tool) as s:
+            await s.handshake_rom()
+            await s.load_fdl1()
+            await s.handshake_fdl1()
+
+    asyncio.run(run())
+    return tool
+
+
+def handshake_retries(tool) -> int:
+    return sum(
+        p["retries"] for p in tool.timer.report() if p["name"].startswith("ready:")
+    )
+
+
+@MODES
+def test_reply_slower_than_the_first_backoff_is_waited_for(tmp_path, mode):
+    # 2 x 60 ms round trip: past BACKOFF_FIRST, within HANDSHAKE_MIN_WAIT
+    tool = up_to_fdl1(tmp_path, mode, latency=0.06)
+    assert set(tool.handshake_versions) == {"ROM CODE", "FDL1"}
+    assert handshake_retries(tool) == 0
+
+
+@MODES
+def test_replies_to_resent_handshakes_are_skipped(tmp_path, mode):
+    # Each resend gets its own BSL_REP_VER ahead of the CONNECT ACK
+    tool = up_to_fdl1(tmp_path, mode, latency=0.2)
+    assert set(tool.handshake_versions) == {"ROM CODE", "FDL1"}
+    assert handshake_retries(tool) > 0
+
+
+@MODES
+def test_handshake_bytes_lost_while_fdl1_boots(tmp_path, mode):
+    tool = up_to_fdl1(tmp_path, mode, latency=0.005, boot_time=0.5)
+    assert "FDL1" in tool.handshake_versions
+    assert handshake_retries(tool) > 0
+
+
+def test_slow_link_flash(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, dev = flash(tmp_path, axp, "latency_ms=80,boot_ms=300", "--async")
+    assert code == 0 and dev["ok"]
+    assert dev["handshake_retries"] > 0
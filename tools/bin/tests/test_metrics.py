@@ -0,0 +1,87 @@
+"""--prometheus: one sample per metric and label set, boards by their own AXP."""
+
+import axdl_tool
+from conftest import make_axp
+
+
+def samples(path) -> dict:
+    """{metric{labels}: value} of a Prometheus text file; no sample repeats."""
+    found = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            key, value = line.rsplit(" ", 1)
+            assert key not in found, f"{key} repeated"
+            found[key] = float(value)
+    return found
+
+
+def phase(name: str, wall: float, retries=0, nbytes=0) -> dict:
+    return {
+        "name": name,
+        "bytes": nbytes,
+        "wall": wall,
+        "cpu": 0.0,
+        "reads": 1,
+        "writes": 1,
+        "bytes_out": nbytes,
+        "bytes_in": 0,
+        "retries": retries,
+    }
+
+
+def board(device: str, axp: str, phases: list) -> axdl_tool.FlashStatus:
+    status = axdl_tool.FlashStatus(device)
+    status.axp = axp
+    status.ok = True
+    status.phases = phases
+    return status
+
+
+def test_repeated_phases_are_summed(tmp_path):
+    path = tmp_path / "axdl.prom"
+    st = board(
+        "1-1",
+        "/srv/a.axp",
+        [
+            phase("ready:FDL1", 0.5, retries=2),
+            phase("erase:kernel", 1.0),
+            phase("image:KERNEL", 2.0, nbytes=4000000),
+            phase("ready:FDL1", 0.25, retries=1),
+            phase("erase:kernel", 0.5),
+            phase("image:KERNEL", 2.0, nbytes=4000000),
+        ],
+    )
+    axdl_tool.write_prometheus(str(path), "/srv/other.axp", [st])
+    found = samples(path)
+    labels = 'device="1-1",axp="a.axp"'
+    assert found[f'axdl_phase_duration_seconds{{{labels},phase="ready:FDL1"}}'] == 0.75
+    assert found[f'axdl_phase_retries{{{labels},phase="ready:FDL1"}}'] == 3
+    assert found[f'axdl_phase_duration_seconds{{{labels},phase="erase:kernel"}}'] == 1.5
+    part = f'{labels},partition="KERNEL"'
+    assert found[f"axdl_partition_bytes{{{part}}}"] == 8000000
+    assert found[f"axdl_partition_throughput_bytes_per_second{{{part}}}"] == 2000000
+
+
+def test_boards_are_labelled_with_their_own_axp(tmp_path):
+    path = tmp_path / "axdl.prom"
+    statuses = [
+        board("1-1", "/srv/a.axp", [phase("fdl1", 0.1)]),
+        board("1-2", "/srv/b.axp", [phase("fdl1", 0.1)]),
+    ]
+    axdl_tool.write_prometheus(str(path), "/srv/a.axp", statuses)
+    found = samples(path)
+    assert 'axdl_flash_success{device="1-1",axp="a.axp"}' in found
+    assert 'axdl_flash_success{device="1-2",axp="b.axp"}' in found
+
+
+def test_flash_run_metrics_do_not_repeat(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", "spl:256K,kernel:512K:erase")
+    path = tmp_path / "axdl.prom"
+    # Booting stages make the handshakes retry
+    argv = ["--axp", axp, "--sim", "latency_ms=2,boot_ms=300,devices=2", "--all"]
+    axdl_tool.main(argv + ["--no-progress", "--prometheus", str(path)])
+    found = samples(path)
+    for device in ("sim-1", "sim-2"):
+        assert found[f'axdl_flash_success{{device="{device}",axp="a.axp"}}'] == 1
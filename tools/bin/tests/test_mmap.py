@@ -0,0 +1,108 @@
+"""Images stored uncompressed sent straight from a memory map."""
+
+import os
+
+import pytest
+
+import axdl_tool
+from conftest import flash, flash_boards, image_bytes, make_axp, read_partition
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+PARTS = ("spl", "kernel", "rootfs")
+
+
+def assert_written(backing: str, axp: str):
+    for part_id in PARTS:
+        data = image_bytes(axp, part_id)
+        assert read_partition(backing, part_id, len(data)) == data
+
+
+def count_maps(monkeypatch) -> list:
+    mapped = []
+    chunks = axdl_tool.MappedImage.chunks
+
+    def counting_chunks(self, *args):
+        mapped.append(self.size)
+        return chunks(self, *args)
+
+    monkeypatch.setattr(axdl_tool.MappedImage, "chunks", counting_chunks)
+    return mapped
+
+
+@pytest.mark.parametrize("mode", [[], ["--async"]], ids=["sync", "async"])
+def test_mapped_and_read_images_write_the_same(tmp_path, monkeypatch, mode):
+    mapped = count_maps(monkeypatch)
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=1,backing={}"
+    args = ["--window", "4"] + mode
+    code, _ = flash(tmp_path, axp, sim.format(tmp_path / "mapped.bin"), *args)
+    assert code == 0
+    # Only the stored members are mapped; the deflated one is inflated
+    assert sorted(mapped) == [256 << 10, 512 << 10]
+    del mapped[:]
+    read = tmp_path / "read.bin"
+    code, _ = flash(tmp_path, axp, sim.format(read), *args, "--no-mmap")
+    assert code == 0 and not mapped
+    assert_written(str(tmp_path / "mapped.bin"), axp)
+    assert_written(str(read), axp)
+
+
+def test_boards_are_sent_the_same_map(tmp_path, monkeypatch):
+    mapped = count_maps(monkeypatch)
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=2,devices=3,fdl_chunk_max=1000,fdl_split=1,backing={backing}"
+    code, devices = flash_boards(tmp_path, axp, sim)
+    assert code == 0 and len(mapped) == 6
+    for dev in devices:
+        assert dev["ok"]
+        assert_written(f"{backing}.{dev['device']}", axp)
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_fadvise"), reason="no posix_fadvise")
+def test_drop_page_cache_evicts_the_sent_pages(tmp_path, monkeypatch):
+    dropped = []
+    fadvise = os.posix_fadvise
+
+    def recording_fadvise(fd, offset, length, advice):
+        if advice == os.POSIX_FADV_DONTNEED:
+            dropped.append(length)
+        return fadvise(fd, offset, length, advice)
+
+    monkeypatch.setattr(os, "posix_fadvise", recording_fadvise)
+    axp = make_axp(tmp_path / "a.axp", "spl:256K,kernel:9M")
+    code, _ = flash(tmp_path, axp, "latency_ms=0")
+    assert code == 0 and not dropped
+    code, _ = flash(tmp_path, axp, "latency_ms=0", "--drop-page-cache")
+    assert code == 0
+    # Dropped in steps while sending, and the rest once the image is sent
+    assert len(dropped) > 2
+    assert sum(dropped) >= (9 << 20) - os.sysconf("SC_PAGE_SIZE")
+
+
+def test_mapped_member_reads_its_bytes(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    plan = axdl_tool.FlashPlan.load(axp)
+    src = plan.image_sources["kernel.img"]
+    # The member does not start on a page of the AXP
+    assert src.data_offset % 4096
+    with src.map() as mapped:
+        chunks = list(mapped.chunks(100000, keep=300000))
+        assert b"".join(chunks) == image_bytes(axp, "kernel")
+        assert {len(c) for c in chunks[:-1]} == {100000}
+    assert plan.image_sources["rootfs.img"].map() is None
+
+
+def test_mapped_file_closes_with_chunks_held(tmp_path):
+    path = tmp_path / "kernel.img"
+    data = os.urandom(300000)
+    path.write_bytes(data)
+    src = axdl_tool.FileImageSource(str(path))
+    mapped = src.map(drop_cache=True)
+    chunk = next(mapped.chunks(65536))
+    # A chunk still queued for writing keeps the map alive
+    mapped.close()
+    mapped.close()
+    assert bytes(chunk) == data[:65536]
+    (tmp_path / "empty.img").write_bytes(b"")
+    assert axdl_tool.FileImageSource(str(tmp_path / "empty.img")).map() is None
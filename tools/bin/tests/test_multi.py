@@ -0,0 +1,80 @@
+"""--all / --devices: boards flashed in parallel, one worker thread each."""
+
+import logging
+import time
+
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash_boards, image_bytes, make_axp, read_partition
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+
+
+def test_boards_are_flashed_in_parallel(tmp_path, monkeypatch):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    parsed = []
+    load_axp = axdl_tool.load_axp
+
+    def counting_load_axp(*args):
+        parsed.append(args)
+        return load_axp(*args)
+
+    monkeypatch.setattr(axdl_tool, "load_axp", counting_load_axp)
+    started = time.monotonic()
+    sim = f"latency_ms=2,devices=4,backing={backing}"
+    code, devices = flash_boards(tmp_path, axp, sim, "--no-plan-cache")
+    wall = time.monotonic() - started
+    assert code == 0
+    assert [d["device"] for d in devices] == ["sim-1", "sim-2", "sim-3", "sim-4"]
+    # The AXP is parsed once for all of them
+    assert len(parsed) == 1
+    for dev in devices:
+        assert dev["ok"]
+        for part_id in ("spl", "kernel", "rootfs"):
+            data = image_bytes(axp, part_id)
+            path = f"{backing}.{dev['device']}"
+            assert read_partition(path, part_id, len(data)) == data
+    # Four boards take far less than four boards one after the other
+    assert wall < 0.6 * sum(d["elapsed"] for d in devices)
+
+
+def test_devices_flashes_only_the_boards_named(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=1,devices=3"
+    code, devices = flash_boards(tmp_path, axp, sim, "--devices", "sim-1,sim-3")
+    assert code == 0
+    assert [d["device"] for d in devices] == ["sim-1", "sim-3"]
+
+
+class EraseFails(SimulatedDevice):
+    def _erase(self, payload):
+        self._respond(axdl_tool.BSL_REP_OPERATION_FAILED)
+
+
+def test_failing_board_leaves_the_others(tmp_path, capsys):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+
+    def make_port(path, logger):
+        board = EraseFails if path == "sim-2" else SimulatedDevice
+        return board(path=path, latency=0.001, logger=logger)
+
+    def make_tool():
+        tool = axdl_tool.AXDLTool()
+        tool.progress_enabled = False
+        return tool
+
+    statuses = axdl_tool.flash_devices(
+        logging.getLogger("test_multi"),
+        ["sim-1", "sim-2", "sim-3"],
+        plan.flash_args,
+        make_port,
+        make_tool,
+    )
+    assert [st.ok for st in statuses] == [True, False, True]
+    assert statuses[1].error == "Failed during image downloads."
+
+    axdl_tool.print_status_table(statuses)
+    out = capsys.readouterr().out
+    assert "2/3 device(s) flashed." in out
+    assert "sim-2 failed during images: Failed during image downloads." in out
@@ -0,0 +1,104 @@
+"""--plan: what flashing an AXP does and how long it should take."""
+
+import json
+import os
+
+import pytest
+
+import axdl_tool
+from conftest import flash, flash_boards, make_axp, replace_image
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+MODEL = "sim:AX620E ROM CODE"
+
+
+def plan(capsys, axp: str, *args) -> tuple:
+    """Run axdl_tool.main(--plan); returns (exit code, output)."""
+    capsys.readouterr()
+    with pytest.raises(SystemExit) as e:
+        axdl_tool.main(["--axp", axp, "--plan"] + list(args))
+    return e.value.code or 0, capsys.readouterr().out
+
+
+def plan_json(capsys, axp: str, *args) -> dict:
+    code, out = plan(capsys, axp, "json", *args)
+    assert code == 0
+    return json.loads(out)
+
+
+def test_plan_lists_the_operations_without_a_board(tmp_path, capsys):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    report = plan_json(capsys, axp)
+    assert [(op["op"], op["name"]) for op in report["operations"]] == [
+        ("stage", "rom-handshake"),
+        ("stage", "fdl1"),
+        ("stage", "fdl1-handshake"),
+        ("stage", "fdl2"),
+        ("repartition", "repartition"),
+        ("write", "image:SPL"),
+        ("erase", "erase:kernel"),
+        ("write", "image:KERNEL"),
+        ("write", "image:ROOTFS"),
+    ]
+    # Nothing measured yet, so nothing is guessed
+    assert report["sessions"] == 0 and report["estimate_s"] == 0
+    assert report["unmeasured"] == len(report["operations"])
+    written = {p["id"]: p["written"] for p in report["partitions"]}
+    assert written == {"spl": 256 << 10, "kernel": 512 << 10, "rootfs": 1 << 20}
+    code, out = plan(capsys, axp)
+    assert code == 0
+    assert "no measurements yet" in out
+    assert "9 operation(s) never measured" in out
+
+
+def test_plan_follows_the_selection(tmp_path, capsys):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    report = plan_json(capsys, axp, "--only", "kernel", "--verify", "--reset")
+    assert [op["name"] for op in report["operations"]][4:] == [
+        "repartition",
+        "erase:kernel",
+        "image:KERNEL",
+        "verify:KERNEL",
+        "reset",
+    ]
+
+
+def test_plan_is_estimated_from_earlier_sessions(tmp_path, capsys):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=2,devices=2,fdl_chunk_max=1000,fdl_split=1"
+    code, devices = flash_boards(tmp_path, axp, sim, "--window", "4")
+    assert code == 0
+    report = plan_json(capsys, axp)
+    assert report["model"] == MODEL and report["sessions"] == 2
+    assert report["unmeasured"] == 0
+    # The estimate is of the order of what the boards took
+    elapsed = sum(d["elapsed"] for d in devices) / len(devices)
+    assert 0.5 * elapsed < report["estimate_s"] < 2 * elapsed
+    (rootfs,) = [op for op in report["operations"] if op["name"] == "image:ROOTFS"]
+    assert rootfs["estimate"] > 0
+    # Read-back was never measured
+    report = plan_json(capsys, axp, "--verify")
+    assert report["unmeasured"] == 3
+
+
+def test_model_picks_the_measurements(tmp_path, capsys):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, _ = flash(tmp_path, axp, "latency_ms=1")
+    assert code == 0
+    assert plan_json(capsys, axp, "--model", MODEL)["sessions"] == 1
+    other = plan_json(capsys, axp, "--model", "AX650 ROM CODE")
+    assert other["model"] == "AX650 ROM CODE" and other["sessions"] == 0
+
+
+def test_oversized_image_fails_the_plan_and_the_flash(tmp_path, capsys):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    replace_image(axp, "spl", os.urandom(2 << 20))
+    code, out = plan(capsys, axp)
+    assert code == 1
+    assert "DOES NOT FIT" in out
+    assert "Image 'SPL' does not fit its partition." in out
+    code, out = plan(capsys, axp, "json")
+    assert code == 1 and json.loads(out)["oversized"] == ["SPL"]
+    # A flash refuses it before touching the board
+    code, dev = flash(tmp_path, axp, "latency_ms=1")
+    assert code == 1 and dev is None
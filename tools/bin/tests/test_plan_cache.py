@@ -0,0 +1,110 @@
+"""Parsed AXPs cached, so a release flashed again skips its zip and XML."""
+
+import json
+import logging
+import os
+import shutil
+
+import axdl_tool
+from conftest import flash, flash_boards, image_bytes, make_axp, read_partition
+from conftest import replace_image
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+PARTS = ("spl", "kernel", "rootfs")
+
+
+def count_parses(monkeypatch) -> list:
+    parsed = []
+    load_axp = axdl_tool.load_axp
+
+    def counting_load_axp(*args):
+        parsed.append(args)
+        return load_axp(*args)
+
+    monkeypatch.setattr(axdl_tool, "load_axp", counting_load_axp)
+    return parsed
+
+
+def setup_phases(tmp_path) -> list:
+    with open(tmp_path / "timings.json", "r", encoding="utf-8") as f:
+        return [p["name"] for p in json.load(f)["setup"]]
+
+
+def assert_written(backing: str, axp: str):
+    for part_id in PARTS:
+        data = image_bytes(axp, part_id)
+        assert read_partition(backing, part_id, len(data)) == data
+
+
+def test_second_run_takes_the_cached_plan(tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO)
+    parsed = count_parses(monkeypatch)
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=2,fdl_chunk_max=1000,fdl_split=1,backing={backing}"
+    code, _ = flash(tmp_path, axp, sim)
+    assert code == 0 and len(parsed) == 1
+    assert "parse-xml" in setup_phases(tmp_path)
+    os.remove(backing)
+    code, dev = flash(tmp_path, axp, sim)
+    assert code == 0 and dev["ok"]
+    # Nothing parsed again, the FDLs and images come from the cached members
+    assert len(parsed) == 1
+    assert "a.axp (cached plan)" in caplog.text
+    phases = setup_phases(tmp_path)
+    assert "plan-cache" in phases and "parse-xml" not in phases
+    assert_written(str(backing), axp)
+
+
+def test_boards_share_the_cached_plan(tmp_path, monkeypatch):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, _ = flash(tmp_path, axp, "latency_ms=0")
+    assert code == 0
+    parsed = count_parses(monkeypatch)
+    backing = tmp_path / "flash.bin"
+    code, devices = flash_boards(
+        tmp_path, axp, f"latency_ms=1,devices=3,backing={backing}"
+    )
+    assert code == 0 and not parsed
+    for dev in devices:
+        assert dev["ok"]
+        assert_written(f"{backing}.{dev['device']}", axp)
+
+
+def test_copied_axp_is_found_by_its_fingerprint(tmp_path, monkeypatch):
+    cache = axdl_tool.PlanCache(str(tmp_path / "plans.json"))
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    first = axdl_tool.FlashPlan.load(axp, cache=cache)
+    copy = str(tmp_path / "release-copy.axp")
+    shutil.copyfile(axp, copy)
+    parsed = count_parses(monkeypatch)
+    plan = axdl_tool.FlashPlan.load(copy, cache=cache)
+    assert not parsed
+    assert plan.fingerprint == first.fingerprint
+    # The image sources read the copy, not the AXP first cached
+    assert plan.image_sources["spl.img"].archive_path == copy
+
+
+def test_changed_axp_is_parsed_again(tmp_path, monkeypatch):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=1,backing={backing}"
+    code, _ = flash(tmp_path, axp, sim)
+    assert code == 0
+    replace_image(axp, "spl", os.urandom(128 << 10))
+    parsed = count_parses(monkeypatch)
+    code, dev = flash(tmp_path, axp, sim)
+    assert code == 0 and dev["ok"]
+    assert len(parsed) == 1
+    assert_written(str(backing), axp)
+
+
+def test_no_plan_cache_leaves_no_cache(tmp_path, monkeypatch, cache_dir):
+    parsed = count_parses(monkeypatch)
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    for _ in range(2):
+        code, _ = flash(tmp_path, axp, "latency_ms=0", "--no-plan-cache")
+        assert code == 0
+        assert "plan-cache" not in setup_phases(tmp_path)
+    assert len(parsed) == 2
+    assert not (cache_dir / "axdl_tool" / "plans.json").exists()
@@ -0,0 +1,71 @@
+"""--resume: an interrupted flash continues at its first unfinished image."""
+
+import pytest
+
+from conftest import flash, image_bytes, image_phases, make_axp, read_partition
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+# Past the FDLs and SPL, part way through KERNEL
+DISCONNECT_AFTER = 900000
+
+
+@pytest.mark.parametrize("mode", [[], ["--async"]], ids=["sync", "async"])
+def test_resume_after_disconnect(tmp_path, mode):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=0,backing={backing},serial=SN1"
+
+    code, dev = flash(
+        tmp_path, axp, f"{sim},disconnect_after={DISCONNECT_AFTER}", *mode
+    )
+    assert code == 1
+    assert not dev["ok"] and dev["failed_phase"] == "image:KERNEL"
+
+    code, dev = flash(tmp_path, axp, sim, "--resume", *mode)
+    assert code == 0
+    assert image_phases(dev) == ["KERNEL", "ROOTFS"]
+    for part_id in ("spl", "kernel", "rootfs"):
+        data = image_bytes(axp, part_id)
+        assert read_partition(str(backing), part_id, len(data)) == data
+
+
+def test_finished_flash_leaves_nothing_to_resume(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = f"latency_ms=0,backing={tmp_path / 'flash.bin'}"
+    assert flash(tmp_path, axp, sim)[0] == 0
+
+    code, dev = flash(tmp_path, axp, sim, "--resume")
+    assert code == 0
+    assert image_phases(dev) == ["SPL", "KERNEL", "ROOTFS"]
+
+
+def test_checkpoint_of_another_axp_is_ignored(tmp_path):
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=0,backing={backing}"
+    old = make_axp(tmp_path / "old.axp", SPEC, seed=1)
+    code, _ = flash(tmp_path, old, f"{sim},disconnect_after={DISCONNECT_AFTER}")
+    assert code == 1
+
+    axp = make_axp(tmp_path / "a.axp", SPEC, seed=2)
+    code, dev = flash(tmp_path, axp, sim, "--resume")
+    assert code == 0
+    assert image_phases(dev) == ["SPL", "KERNEL", "ROOTFS"]
+    data = image_bytes(axp, "spl")
+    assert read_partition(str(backing), "spl", len(data)) == data
+
+
+def test_board_without_serial_is_only_resumed_with_force(tmp_path):
+    # Without a serial number the checkpoint is keyed by the port alone
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = f"latency_ms=1,backing={tmp_path / 'flash.bin'}"
+    code, _ = flash(tmp_path, axp, f"{sim},disconnect_after={DISCONNECT_AFTER}")
+    assert code == 1
+    code, dev = flash(tmp_path, axp, sim, "--resume")
+    assert code == 0
+    assert image_phases(dev) == ["SPL", "KERNEL", "ROOTFS"]
+
+    code, _ = flash(tmp_path, axp, f"{sim},disconnect_after={DISCONNECT_AFTER}")
+    assert code == 1
+    code, dev = flash(tmp_path, axp, sim, "--force-resume")
+    assert code == 0
+    assert image_phases(dev) == ["KERNEL", "ROOTFS"]
@@ -0,0 +1,19 @@
+"""--sim: simulator options given on the command line."""
+
+import pytest
+
+import axdl_station
+import axdl_tool
+from conftest import make_axp
+
+
+@pytest.mark.parametrize("spec", ["bogus=1", "latency_ms=fast"])
+@pytest.mark.parametrize("main", [axdl_tool.main, axdl_station.main])
+def test_bad_simulator_option_is_a_usage_error(tmp_path, capsys, main, spec):
+    axp = make_axp(tmp_path / "a.axp", "spl:64K")
+    with pytest.raises(SystemExit) as info:
+        main(["--axp", axp, "--sim", spec])
+    assert info.value.code == 2
+    err = capsys.readouterr().err
+    assert f"error: --sim {spec}:" in err
+    assert "Traceback" not in err
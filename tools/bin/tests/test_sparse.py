@@ -0,0 +1,107 @@
+"""Sparse images: the reader, unsparse flashing and the size checks."""
+
+import io
+import os
+import random
+import sys
+
+import pytest
+
+import axdl_bench
+import axdl_sparse
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash, image_bytes, make_axp, read_partition, replace_image
+
+SPEC = "spl:256K,rootfs:1M:sparse"
+
+
+def expanded(sparse: bytes) -> bytes:
+    reader = axdl_sparse.SparseReader(io.BytesIO(sparse))
+    out = bytearray(reader.expanded_size)
+
+    def write(offset, data):
+        out[offset : offset + len(data)] = data
+
+    axdl_sparse.expand(reader, write)
+    return bytes(out)
+
+
+@pytest.mark.parametrize("crc", [False, True])
+def test_make_sparse_round_trip(crc):
+    rng = random.Random(1)
+    blocks = [
+        bytes(4096),
+        rng.randbytes(4096),
+        b"\xaa\x55\x00\xff" * 1024,
+        bytes(4096),
+        rng.randbytes(4096),
+    ]
+    raw = b"".join(blocks)
+    sparse = axdl_sparse.make_sparse(raw, crc=crc)
+    assert axdl_sparse.is_sparse(sparse)
+    assert expanded(sparse) == raw
+
+
+@pytest.mark.parametrize("fill", ["random", "mixed", "zero"])
+def test_sparse_image_is_expanded(tmp_path, fill):
+    axp = make_axp(tmp_path / "a.axp", SPEC, fill=fill)
+    backing = tmp_path / "flash.bin"
+    code, dev = flash(tmp_path, axp, f"latency_ms=0,unsparse=1,backing={backing}")
+    assert code == 0 and dev["ok"]
+    raw = expanded(image_bytes(axp, "rootfs"))
+    assert read_partition(str(backing), "rootfs", len(raw)) == raw
+
+
+def test_raw_sparse_image_larger_than_partition_fails(tmp_path):
+    # Without unsparse the FDL stores the sparse file as it is
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, dev = flash(tmp_path, axp, "latency_ms=0")
+    assert code == 1 and not dev["ok"]
+
+
+def test_expanded_size_is_checked_before_flashing(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    replace_image(axp, "rootfs", axdl_sparse.make_sparse(os.urandom(2 << 20)))
+    code, dev = flash(tmp_path, axp, "latency_ms=0,unsparse=1")
+    assert code == 1 and dev is None
+
+
+def test_simulator_checks_the_expanded_size(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sparse = axdl_sparse.make_sparse(os.urandom(2 << 20))
+    replace_image(axp, "rootfs", sparse)
+    plan = axdl_tool.FlashPlan.load(axp)
+    tool = axdl_tool.AXDLTool()
+    tool.progress_enabled = False
+    port = SimulatedDevice(unsparse=True)
+    with pytest.raises(axdl_tool.ImageError):
+        with axdl_tool.FlashSession(plan, port, tool=tool) as session:
+            session.run()
+    # Refused at the first chunk, not after taking the whole image
+    assert port.stats["data_bytes"] < len(sparse)
+
+
+def run_bench(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["axdl_bench.py"] + list(argv))
+    try:
+        axdl_bench.main()
+    except SystemExit as e:
+        return e.code
+    return 0
+
+
+def test_bench_flashes_sparse_partitions(monkeypatch, capsys):
+    code = run_bench(monkeypatch, "--partitions", SPEC, "--sim", "latency_ms=0")
+    assert code == 0
+    assert "(1/1 runs ok)" in capsys.readouterr().out
+
+
+def test_bench_reports_failed_runs(monkeypatch, capsys):
+    code = run_bench(
+        monkeypatch, "--partitions", SPEC, "--sim", "latency_ms=0,unsparse=0"
+    )
+    out = capsys.readouterr().out
+    assert code == 1
+    assert "run 1/1: FAILED in phase" in out
+    assert "all 1 runs failed" in out
@@ -0,0 +1,160 @@
+"""Stalled boards, failed erases and learnt reply timeouts."""
+
+import asyncio
+import json
+import logging
+import time
+
+import pytest
+
+import axdl_async
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash, make_axp
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+# Past the FDLs, part way through the images
+STALL_AFTER = 1200000
+
+
+def test_stalled_board_fails_without_retrying(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    # Stalls are told apart from slow replies by the timeouts learnt here
+    assert flash(tmp_path, axp, "latency_ms=0")[0] == 0
+    started = time.monotonic()
+    code, dev = flash(
+        tmp_path,
+        axp,
+        f"latency_ms=0,stall_after={STALL_AFTER}",
+        "--chunk-retries",
+        "2",
+        "--on-stall",
+        "fail",
+    )
+    assert code == 1 and not dev["ok"]
+    assert dev["failed_phase"].startswith("image:")
+    assert dev["retries"] == 0
+    # One learnt reply timeout, not 120 s per attempt
+    assert time.monotonic() - started < 10
+
+
+@pytest.mark.parametrize("window", ["1", "4"])
+def test_board_waited_for_through_a_stall(tmp_path, window):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    assert flash(tmp_path, axp, "latency_ms=0", "--window", window)[0] == 0
+    # Longer than the learnt DATA timeout (at least TIMEOUT_FLOOR); waiting
+    # is the default
+    stall_ms = 2 * axdl_tool.TIMEOUT_FLOOR + 500
+    sim = f"latency_ms=0,stall_after={STALL_AFTER},stall_ms={stall_ms}"
+    code, dev = flash(tmp_path, axp, sim, "--window", window)
+    assert code == 0 and dev["ok"]
+
+
+def learnt(cache_dir) -> dict:
+    with open(cache_dir / "axdl_tool" / "timeouts.json", "r", encoding="utf-8") as f:
+        (model,) = json.load(f)["models"].values()
+    return model["commands"]
+
+
+def test_timeouts_are_learnt_per_window(tmp_path, cache_dir):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=1"
+    assert flash(tmp_path, axp, sim)[0] == 0
+    assert flash(tmp_path, axp, sim, "--window", "4", "--verify")[0] == 0
+    commands = learnt(cache_dir)
+    for key in ("DATA/1", "MIDST_DATA/1", "DATA/4", "MIDST_DATA/4"):
+        assert key in commands
+    assert "READ_FLASH_MIDST/4" in commands and "CONNECT/1" in commands
+
+    # Timeouts learnt at window 1 do not apply to a window of 4
+    tool = axdl_tool.AXDLTool(data_window=4)
+    tool.handshake_versions["ROM CODE"] = "AX620E rom"
+    tool.command_timeouts = axdl_tool.CommandTimeouts(str(tmp_path / "t.json"))
+    tool.command_timeouts.timeouts = lambda model: {"DATA/1": 1000}
+    assert tool.reply_timeout("DATA", 120000) == 120000
+    tool.chunk_retries = 1
+    assert tool.reply_timeout("DATA", 120000) == 1000
+
+
+class WriteTimeouts(SimulatedDevice):
+    def write(self, data, timeout=2000):
+        self.write_timeouts.append(timeout)
+        return super().write(data, timeout)
+
+
+def test_data_writes_never_take_a_learnt_timeout(tmp_path):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    tool = axdl_tool.AXDLTool(data_window=4)
+    tool.progress_enabled = False
+    tool.on_stall = "fail"
+    tool.command_timeouts = axdl_tool.CommandTimeouts(str(tmp_path / "t.json"))
+    tool.command_timeouts.timeouts = lambda model: {"DATA/4": 1000}
+    port = WriteTimeouts()
+    port.write_timeouts = []
+    with axdl_tool.FlashSession(plan, port, tool=tool) as session:
+        session.run()
+    assert session.status.ok
+    assert max(port.write_timeouts) == 120000
+    assert 1000 not in port.write_timeouts
+
+
+class EraseFails(SimulatedDevice):
+    def _erase(self, payload):
+        self._respond(axdl_tool.BSL_REP_OPERATION_FAILED)
+
+
+def test_failed_erase_fails_the_flash(tmp_path):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    tool = axdl_tool.AXDLTool()
+    tool.progress_enabled = False
+    port = EraseFails()
+    with pytest.raises(axdl_tool.ImageError):
+        with axdl_tool.FlashSession(plan, port, tool=tool) as session:
+            session.run()
+    # The flash stops at the erase instead of going on with KERNEL
+    assert tool.timer.report()[-1]["name"] == "erase:kernel"
+
+
+@pytest.mark.parametrize("mode", ["sync", "async"])
+def test_flash_error_is_kept_in_the_status(tmp_path, mode):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    args = (plan.cfg, plan.image_sources, plan.fdl1_src, plan.fdl2_src)
+    tool = axdl_tool.AXDLTool()
+    tool.progress_enabled = False
+    status = axdl_tool.FlashStatus("sim-1")
+    logger = logging.getLogger("test_stall")
+    if mode == "sync":
+        port = EraseFails()
+        port.open()
+        try:
+            ok = axdl_tool.flash_device(tool, port, logger, *args, status=status)
+        finally:
+            port.close()
+    else:
+
+        async def run():
+            port = axdl_async.AsyncPort(EraseFails())
+            await port.open()
+            try:
+                return await axdl_async.flash_device_async(
+                    tool, port, logger, *args, status=status
+                )
+            finally:
+                await port.close()
+
+        ok = asyncio.run(run())
+    assert not ok
+    assert status.error == "Failed during image downloads."
+
+
+def test_size_bound_commands_are_not_learnt(tmp_path, cache_dir):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    assert flash(tmp_path, axp, "latency_ms=0")[0] == 0
+    commands = learnt(cache_dir)
+    assert "DATA/1" in commands
+    for name in axdl_tool.TIMEOUT_UNLEARNT:
+        assert axdl_tool.CommandTimeouts.key(name, 1) not in commands
+
+    # An erase far slower than any learnt timeout still succeeds
+    code, dev = flash(tmp_path, axp, "latency_ms=0,erase_ms=1500")
+    assert code == 0 and dev["ok"]
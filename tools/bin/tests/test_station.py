@@ -0,0 +1,124 @@
+"""axdl_station.py: boards flashed as they arrive, once per arrival."""
+
+import json
+import logging
+import time
+
+import axdl_station
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from axdl_station import DeviceEvent
+from conftest import make_axp
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+
+
+def run_station(tmp_path, *args) -> list:
+    """Run axdl_station.main on simulated boards; return its report lines."""
+    report = tmp_path / "report.jsonl"
+    argv = ["--watch", "poll", "--settle", "0.05", "--report", str(report)]
+    axdl_station.main(argv + list(args))
+    with open(report, "r", encoding="utf-8") as f:
+        return sorted((json.loads(line) for line in f), key=lambda e: e["device"])
+
+
+def test_station_flashes_boards_as_they_arrive(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=2,devices=3"
+    entries = run_station(tmp_path, "--axp", axp, "--sim", sim, "--count", "3")
+    assert [e["device"] for e in entries] == ["sim-1", "sim-2", "sim-3"]
+    assert all(e["ok"] for e in entries)
+
+
+def test_routes_pick_the_axp_of_each_port(tmp_path):
+    a = make_axp(tmp_path / "a.axp", "spl:256K", seed=1)
+    b = make_axp(tmp_path / "b.axp", "spl:256K,kernel:512K", seed=2)
+    prom = tmp_path / "station.prom"
+    args = ["--axp", a, "--axp", b, "--route", "sim-2=b", "--count", "2"]
+    args += ["--sim", "latency_ms=1,devices=2", "--prometheus", str(prom)]
+    entries = run_station(tmp_path, *args)
+    assert [(e["device"], e["axp"]) for e in entries] == [("sim-1", a), ("sim-2", b)]
+    assert [e["image_bytes"] for e in entries] == [256 << 10, 768 << 10]
+    metrics = prom.read_text(encoding="utf-8")
+    assert 'axdl_flash_success{device="sim-1",axp="a.axp"} 1' in metrics
+    assert 'axdl_flash_success{device="sim-2",axp="b.axp"} 1' in metrics
+
+
+class EraseFails(SimulatedDevice):
+    def _erase(self, payload):
+        self._respond(axdl_tool.BSL_REP_OPERATION_FAILED)
+
+
+def make_station(tmp_path, failing=()):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    finished = []
+
+    def make_port(path, logger):
+        board = EraseFails if path in failing else SimulatedDevice
+        return board(path=path, latency=0.001, logger=logger)
+
+    def make_tool(plan):
+        tool = axdl_tool.AXDLTool()
+        tool.progress_enabled = False
+        return tool
+
+    station = axdl_station.FlashStation(
+        logging.getLogger("test_station"),
+        [plan],
+        make_port,
+        make_tool,
+        settle=0.0,
+        on_finished=lambda status, plan: finished.append((status.device, status.ok)),
+    )
+    return station, finished
+
+
+def settle(station):
+    """Let the station start the settled boards and wait for their workers."""
+    station.poll()
+    for future, _, _ in list(station.active.values()):
+        future.result()
+    station.poll()
+
+
+def test_board_re_enumerating_is_flashed_once(tmp_path):
+    station, finished = make_station(tmp_path)
+    station.handle(DeviceEvent("add", "sim-1"))
+    station.handle(DeviceEvent("add", "sim-1"))
+    settle(station)
+    assert finished == [("sim-1", True)]
+    # Still plugged in: a new arrival on its port is the same board
+    station.handle(DeviceEvent("add", "sim-1"))
+    settle(station)
+    assert finished == [("sim-1", True)]
+    # Once unplugged, the next board on the port is flashed
+    station.handle(DeviceEvent("remove", "sim-1"))
+    station.handle(DeviceEvent("add", "sim-1"))
+    settle(station)
+    assert finished == [("sim-1", True), ("sim-1", True)]
+    station.pool.shutdown()
+
+
+def test_board_unplugged_while_settling_is_not_flashed(tmp_path):
+    station, finished = make_station(tmp_path)
+    station.settle = 0.2
+    station.handle(DeviceEvent("add", "sim-1"))
+    station.handle(DeviceEvent("remove", "sim-1"))
+    time.sleep(0.3)
+    settle(station)
+    assert finished == [] and not station.pending
+    station.pool.shutdown()
+
+
+def test_failed_board_is_flashed_again_on_its_next_arrival(tmp_path):
+    station, finished = make_station(tmp_path, failing=("sim-2",))
+    station.handle(DeviceEvent("add", "sim-1"))
+    station.handle(DeviceEvent("add", "sim-2"))
+    settle(station)
+    assert sorted(finished) == [("sim-1", True), ("sim-2", False)]
+    assert (station.finished, station.failed) == (2, 1)
+    # Reset back into download mode without being unplugged
+    station.handle(DeviceEvent("add", "sim-2"))
+    settle(station)
+    assert sorted(finished) == [("sim-1", True), ("sim-2", False), ("sim-2", False)]
+    station.pool.shutdown()
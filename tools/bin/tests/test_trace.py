@@ -0,0 +1,133 @@
+"""--trace: sessions recorded as binary traces, summarized and replayed."""
+
+import json
+import sys
+
+import pytest
+
+import axdl_sim
+import axdl_trace
+import axdl_tool
+from conftest import flash, flash_boards, make_axp
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+
+
+def record(tmp_path, sim: str, *args) -> str:
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    trace = tmp_path / "session.axtrace"
+    code, dev = flash(tmp_path, axp, sim, "--trace", str(trace), *args)
+    assert code == 0 and dev["ok"]
+    return f"{trace}.{dev['device']}"
+
+
+def test_trace_records_the_session(tmp_path):
+    trace = record(tmp_path, "latency_ms=2", "--window", "4")
+    meta, records = axdl_trace.read_trace(trace)
+    assert meta["device"] == "sim-1" and meta["axp"] == "a.axp"
+    summary = axdl_trace.analyze(meta, records)
+    assert summary["failed"] == 0
+    names = [seg["name"] for seg in summary["segments"]]
+    assert [n for n in names if not n.startswith("fdl@")] == [
+        "handshake",
+        "repartition",
+        "spl",
+        "kernel",
+        "rootfs",
+    ]
+    # Every image byte went out through the traced port
+    assert summary["bytes_out"] > (256 + 512 + 1024) << 10
+    # Each data chunk waited at least the link latency for its ACK
+    data = summary["commands"]["DATA"]
+    assert data["count"] > 0 and data["p50"] >= 0.002
+
+
+def test_trace_digest_tells_identical_runs_apart_from_changed_ones(tmp_path):
+    first = tmp_path / "first"
+    first.mkdir()
+    second = tmp_path / "second"
+    second.mkdir()
+
+    def digests(path) -> list:
+        _, records = axdl_trace.read_trace(path)
+        return [r.digest for r in records if r.digest is not None]
+
+    a = digests(record(first, "latency_ms=0", "--trace-digest"))
+    b = digests(record(second, "latency_ms=0", "--trace-digest"))
+    assert a and a == b
+    third = tmp_path / "third"
+    third.mkdir()
+    axp = make_axp(third / "a.axp", SPEC, seed=1)
+    trace = third / "session.axtrace"
+    code, _ = flash(third, axp, "latency_ms=0", "--trace", str(trace), "--trace-digest")
+    assert code == 0
+    assert digests(f"{trace}.sim-1") != a
+
+
+def test_each_board_gets_its_own_trace(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    trace = tmp_path / "station.axtrace"
+    sim = "latency_ms=1,devices=2,fdl_chunk_max=1000,fdl_split=1"
+    code, devices = flash_boards(tmp_path, axp, sim, "--trace", str(trace))
+    assert code == 0
+    for dev in devices:
+        meta, records = axdl_trace.read_trace(f"{trace}.{dev['device']}")
+        assert meta["device"] == dev["device"]
+        assert axdl_trace.analyze(meta, records)["failed"] == 0
+
+
+def test_replay_reproduces_the_replies(tmp_path):
+    trace = record(tmp_path, "latency_ms=1")
+    _, records = axdl_trace.read_trace(trace)
+    port = axdl_sim.make_sim_device(axdl_sim.parse_sim_spec("latency_ms=0"))
+    port.open()
+    try:
+        result = axdl_trace.replay(records, port, timeout=2000)
+    finally:
+        port.close()
+    assert result["stopped"] is None
+    assert result["transfers"] == len(records)
+    assert result["mismatched"] == 0
+
+
+def test_replay_stops_at_a_failed_transfer(tmp_path):
+    trace = record(tmp_path, "latency_ms=0")
+    _, records = axdl_trace.read_trace(trace)
+    # Mark a transfer halfway through as failed in the recording
+    i = len(records) // 2
+    records[i] = records[i]._replace(flags=records[i].flags | axdl_tool.TRACE_FAILED)
+    port = axdl_sim.make_sim_device(axdl_sim.parse_sim_spec("latency_ms=0"))
+    port.open()
+    try:
+        result = axdl_trace.replay(records, port, timeout=2000)
+    finally:
+        port.close()
+    assert result["transfers"] == i
+    assert result["stopped"] == f"transfer {i} failed in the recorded session"
+
+
+def test_cut_short_trace_keeps_its_complete_records(tmp_path):
+    trace = record(tmp_path, "latency_ms=0")
+    _, records = axdl_trace.read_trace(trace)
+    with open(trace, "rb") as f:
+        blob = f.read()
+    cut = tmp_path / "cut.axtrace"
+    cut.write_bytes(blob[: len(blob) - 3])
+    _, kept = axdl_trace.read_trace(str(cut))
+    assert kept == records[: len(kept)] and len(records) - 1 <= len(kept)
+
+    cut.write_bytes(b"not a trace at all")
+    with pytest.raises(axdl_trace.TraceFormatError):
+        axdl_trace.read_trace(str(cut))
+
+
+def test_summary_command_prints_json(tmp_path, monkeypatch, capsys):
+    trace = record(tmp_path, "latency_ms=1")
+    capsys.readouterr()
+    monkeypatch.setattr(sys, "argv", ["axdl_trace.py", "summary", trace, "--json"])
+    with pytest.raises(SystemExit) as e:
+        axdl_trace.main()
+    assert e.value.code == 0
+    summary = json.loads(capsys.readouterr().out)[trace]
+    assert summary["device"] == "sim-1"
+    assert "MIDST_DATA" in summary["commands"]
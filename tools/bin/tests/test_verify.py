@@ -0,0 +1,53 @@
+"""--verify: written partitions are read back and compared with their images."""
+
+import pytest
+
+from conftest import flash, make_axp
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+MODES = pytest.mark.parametrize("mode", [[], ["--async"]], ids=["sync", "async"])
+
+
+def verified(dev: dict) -> dict:
+    """Bytes read back per image, e.g. {"SPL": 262144}."""
+    return {
+        p["name"][len("verify:") :]: p["bytes"]
+        for p in dev["phases"]
+        if p["name"].startswith("verify:")
+    }
+
+
+@MODES
+def test_verify_reads_back_every_image(tmp_path, mode):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, dev = flash(tmp_path, axp, "latency_ms=0", "--verify", *mode)
+    assert code == 0 and dev["ok"]
+    assert verified(dev) == {"SPL": 256 << 10, "KERNEL": 512 << 10, "ROOTFS": 1 << 20}
+
+
+@MODES
+def test_verify_sample_reads_back_part_of_every_image(tmp_path, mode):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, dev = flash(tmp_path, axp, "latency_ms=0", "--verify-sample", "2", *mode)
+    assert code == 0 and dev["ok"]
+    sizes = verified(dev)
+    assert sorted(sizes) == ["KERNEL", "ROOTFS", "SPL"]
+    assert sizes["ROOTFS"] < 1 << 20
+
+
+@MODES
+def test_verify_catches_corrupted_writes(tmp_path, mode):
+    # Every data chunk is corrupted and nothing checks chunks on the way
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    code, dev = flash(tmp_path, axp, "latency_ms=0,corrupt=1", "--verify", *mode)
+    assert code == 1 and not dev["ok"]
+    assert dev["failed_phase"] == "verify:SPL"
+
+
+def test_chunk_checksums_repair_what_verify_would_catch(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=0,corrupt=0.3"
+    args = ["--verify", "--chunk-checksum", "--chunk-retries", "10"]
+    code, dev = flash(tmp_path, axp, sim, *args)
+    assert code == 0 and dev["ok"]
+    assert dev["retries"] > 0
@@ -0,0 +1,97 @@
+"""--window: MIDST_DATA chunks kept in flight, their ACKs matched in order."""
+
+import pytest
+
+import axdl_tool
+from axdl_sim import SimulatedDevice
+from conftest import flash, flash_boards, image_bytes, make_axp, read_partition
+
+SPEC = "spl:256K,kernel:512K:erase,rootfs:1M:deflate"
+PARTS = ("spl", "kernel", "rootfs")
+
+
+def assert_written(backing: str, axp: str):
+    for part_id in PARTS:
+        data = image_bytes(axp, part_id)
+        assert read_partition(backing, part_id, len(data)) == data
+
+
+@pytest.mark.parametrize("window", ["1", "4", "8"])
+def test_windowed_images_are_written_intact(tmp_path, window):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=1,backing={backing}"
+    code, dev = flash(tmp_path, axp, sim, "--window", window)
+    assert code == 0 and dev["ok"]
+    assert_written(str(backing), axp)
+
+
+def image_wall(dev: dict, name: str) -> float:
+    (wall,) = [p["wall"] for p in dev["phases"] if p["name"] == f"image:{name}"]
+    return wall
+
+
+def test_window_hides_the_link_latency(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", "rootfs:1M")
+    # Probed FDL uploads keep the run short; only the image phase is timed
+    args = ["latency_ms=3", "--fdl-probe", "--window"]
+    code, lockstep = flash(tmp_path, axp, *args, "1")
+    assert code == 0
+    code, windowed = flash(tmp_path, axp, *args, "8")
+    assert code == 0
+    # Lock-step waits for two replies per chunk; a window of 8 waits for
+    # them while later chunks go out (simulated writes still take their
+    # latency one after the other, so close to half the time is saved)
+    assert image_wall(windowed, "ROOTFS") < 0.75 * image_wall(lockstep, "ROOTFS")
+
+
+class FailsFifthChunk(SimulatedDevice):
+    """Answers the data of the fifth image chunk with OPERATION_FAILED."""
+
+    image_chunks = 0
+
+    def _take_midst_data(self):
+        size = self._midst[0]
+        if len(self._rx) < size or "data" in self._download:
+            return super()._take_midst_data()
+        self.image_chunks += 1
+        if self.image_chunks != 5:
+            return super()._take_midst_data()
+        del self._rx[:size]
+        self._midst = None
+        self._respond(axdl_tool.BSL_REP_OPERATION_FAILED)
+        return True
+
+
+def test_failed_chunk_in_a_window_fails_the_partition(tmp_path, caplog):
+    plan = axdl_tool.FlashPlan.load(make_axp(tmp_path / "a.axp", SPEC))
+    tool = axdl_tool.AXDLTool(data_window=4)
+    tool.progress_enabled = False
+    port = FailsFifthChunk(latency=0.001)
+    with pytest.raises(axdl_tool.ImageError):
+        with axdl_tool.FlashSession(plan, port, tool=tool) as session:
+            session.run()
+    # The failure is the fifth chunk's, reported with what was in flight
+    assert session.status.phase == "images"
+    assert "No ACK after data chunk for partition 'SPL'" in caplog.text
+    assert "chunk(s) in flight" in caplog.text
+
+
+def test_chunk_retries_send_lockstep(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    sim = "latency_ms=1,corrupt=0.2"
+    args = ["--window", "8", "--chunk-checksum", "--chunk-retries", "10"]
+    code, dev = flash(tmp_path, axp, sim, *args, "--verify")
+    assert code == 0 and dev["ok"]
+    assert dev["retries"] > 0
+
+
+def test_boards_with_picky_fdl_stages_stream_windowed(tmp_path):
+    axp = make_axp(tmp_path / "a.axp", SPEC)
+    backing = tmp_path / "flash.bin"
+    sim = f"latency_ms=2,devices=3,fdl_chunk_max=1000,fdl_split=1,backing={backing}"
+    code, devices = flash_boards(tmp_path, axp, sim, "--window", "4")
+    assert code == 0
+    for dev in devices:
+        assert dev["ok"]
+        assert_written(f"{backing}.{dev['device']}", axp)